@@ -14,35 +14,267 @@ A user may delay exiting in order to transmit a message
 """
 
 import argparse
+import collections
+import heapq
+import itertools
 import logging
 import math
+import numpy
+import os
 import pickle
 import random
+from anonymity_sets import AnonymitySets, GroupAnonymitySets
+from attack_analysis import attack, METHODS
+from checkpoint import pack_lists, read_checkpoint, replay, unpack_lists, \
+    write_checkpoint
+from columnar_dataset import ColumnarDataset, is_columnar
+from delays import DelayStats, write_hours
 from extended_rounds import Round_Keeper
+from metrics import FORMATS, MetricsWriter
+from profiler import Profiler
+from ranks import RANK_ENGINES, RANK_MODES, resolve_rank_mode
+from result_cache import ResultCache, SNAPSHOTS
+from results import write_results
+
+# Arguments that determine the printed results, along with the data set
+CACHE_PARAMS = ["policy", "min_anon", "pseudonyms_per_client",
+    "round_time_span", "start", "end", "trainer", "split_size", "rank_mode",
+    "attack"]
+
+# Policies whose clients share their anonymity sets by group
+SPLIT_POLICIES = ["dynamic_split", "extended_rounds", "static_split"]
 
 class DefaultParse:
-  def __init__(self, filename, end):
-    self.events = []
+  """ Streams a data set from disk.  A light first pass assigns uids to
+  users in the order they first join, events() then re-reads the data set
+  remapping users on the fly so it never has to be held in memory.  Columnar
+  data sets are memory mapped instead and message payloads are never
+  decoded.  Given join_order, the users in the order they first join as an
+  earlier pass found them, the first pass is skipped and the messages of a
+  pickled data set are left uncounted, as None. """
+  def __init__(self, filename, end, join_order = None):
+    self.filename = filename
+    self.end = end
     self.users = {}
-    f = open(filename, "rb")
-
-    while True:
-      try:
-        event = pickle.load(f)
-        if 0 < end and end < event[0]:
+    self.messages = 0
+    self.dataset = None
+    # Byte offset of the event read() last yielded
+    self.offset = None
+
+    if is_columnar(filename):
+      self.dataset = ColumnarDataset(filename)
+      if join_order is None:
+        join_order = self.dataset.join_order(end).tolist()
+      for uid in join_order:
+        self.users[uid] = len(self.users)
+      self.messages = self.dataset.message_count(end)
+      return
+
+    if join_order is not None:
+      for uid in join_order:
+        self.users[uid] = len(self.users)
+      self.messages = None
+      return
+
+    for event in self.read():
+      if event[1] == "join" and event[2] not in  self.users:
+        self.users[event[2]] = len(self.users)
+      elif event[1] == "msg":
+        self.messages += 1
+
+  def join_order(self):
+    """ The users in the order they first join """
+    return sorted(self.users, key=self.users.get)
+
+  def read(self, offset = 0):
+    """ Yields the raw events up to the end time, from the one at byte
+    offset.  Once done, self.offset is where the event after the last one
+    would be. """
+    f = open(self.filename, "rb")
+    f.seek(offset)
+    try:
+      while True:
+        self.offset = f.tell()
+        try:
+          event = pickle.load(f)
+        except EOFError:
           break
-        if event[1] == "join" and event[2] not in  self.users:
-          self.users[event[2]] = len(self.users)
-        # Remap users
-        if event[1] == "msg":
-          event = (event[0], event[1], (self.users[event[2][0]], event[2][1]))
-        else:
-          event = (event[0], event[1], self.users[event[2]])
+        if 0 < self.end and self.end < event[0]:
+          break
+        yield event
+    finally:
+      f.close()
+
+  def events(self, first = 0, offset = None):
+    """ Yields the events with users remapped to uids, from the one at index
+    first.  A pickled data set is read from the byte offset of that event if
+    it is known rather than unpickled from the start. """
+    if self.dataset is not None:
+      uid_map = numpy.empty(int(self.dataset.uids.max()) + 1 \
+          if len(self.dataset) > 0 else 0, dtype=numpy.int64)
+      uid_map.fill(-1)
+      for uid, idx in self.users.items():
+        uid_map[uid] = idx
+      for event in self.dataset.events(self.end, uid_map, payloads=False,
+          first=first):
+        yield event
+      return
+
+    if offset is not None:
+      events = self.read(offset)
+    else:
+      events = itertools.islice(self.read(), first, None)
+    for event in events:
+      if event[1] == "msg":
+        event = (event[0], event[1], (self.users[event[2][0]], event[2][1]))
+      else:
+        event = (event[0], event[1], self.users[event[2]])
+      yield event
+
+def round_batches(events, round_time_span):
+  """ Lazily groups time ordered events into rounds, yields the end time of
+  each round along with the events that happen during it """
+  batch = []
+  next_time = None
+  for event in events:
+    if next_time is not None and event[0] >= next_time:
+      yield next_time, batch
+      batch = []
+      next_time = None
+    if next_time is None:
+      next_time = event[0] + round_time_span - (event[0] % round_time_span)
+    batch.append(event)
+  if next_time is not None:
+    yield next_time, batch
+
+class RoundDelta:
+  """ What a round's events change: the joins that a quit earlier in the
+  round does not cancel, the messages, both also in the order they happen,
+  and the quits, applied at the end of the round.  It does not depend on the
+  policy, so simulations over the same rounds can share it. """
+  def __init__(self, batch):
+    self.batch = batch
+    self.events = []
+    self.joins = []
+    self.msgs = []
+
+    quit = {}
+    for event in batch:
+      if event[1] == "join":
+        if event[2] in quit:
+          del quit[event[2]]
+          continue
+        self.joins.append(event)
+        self.events.append(event)
+      elif event[1] == "msg":
+        self.msgs.append(event)
         self.events.append(event)
-      except EOFError:
+      elif event[1] == "quit":
+        quit[event[2]] = event[0]
+      else:
+        assert(False)
+    # (uid, time) pairs
+    self.quits = quit.items()
+
+class OnlineTracker:
+  """ Online state of every client, which does not depend on the policy:
+  it is replayed over the events before the start of a simulation and then
+  followed round by round, so simulations that start together can share a
+  single tracker """
+  def __init__(self, total):
+    self.online = [False] * total
+    self.online_time = [0] * total
+    self.last_time = [-1] * total
+    self.position = 0
+    # Events read by the replay and the index of those it handed back
+    self.consumed = 0
+    self.prepended = []
+    # Byte offset of the first_needed() event in a pickled data set
+    self.offset = None
+
+  def replay(self, events, start_time, round_time_span):
+    """ Consumes the events before start_time, returns the remaining ones """
+    if start_time == 0:
+      start_time = round_time_span
+
+    to_prepend = []
+    consumed = 0
+    events = iter(events)
+    for event in events:
+      consumed += 1
+      if start_time <= event[0]:
+        to_prepend.append(event)
+        self.prepended.append(consumed - 1)
         break
 
-    f.close()
+      if event[1] == "join":
+        self.join(event[0], event[2])
+      elif event[1] == "quit":
+        self.quit(event[0], event[2])
+      elif event[1] == "msg":
+        if start_time == round_time_span:
+          to_prepend.append(event)
+          self.prepended.append(consumed - 1)
+      else:
+        assert(False)
+
+    self.position = consumed - len(to_prepend)
+    self.consumed = consumed
+    return itertools.chain(to_prepend, events)
+
+  def join(self, etime, uid):
+    self.online[uid] = True
+    self.last_time[uid] = etime
+
+  def quit(self, etime, uid):
+    self.online[uid] = False
+    self.online_time[uid] += etime - self.last_time[uid]
+    self.last_time[uid] = -1
+
+  def apply_joins(self, delta):
+    """ Brings the clients that join during a RoundDelta online """
+    for event in delta.joins:
+      self.join(event[0], event[2])
+
+  def online_time_at(self, uid, ctime = 0):
+    if ctime == 0 or self.last_time[uid] == -1:
+      return self.online_time[uid]
+    return self.online_time[uid] + ctime - self.last_time[uid]
+
+  def first_needed(self):
+    """ Index of the first event the simulation needs after the replay """
+    return min(self.prepended + [self.consumed])
+
+  def remaining(self, events, first):
+    """ The events replay returned, from the stream starting at index
+    first, which is at most first_needed() """
+    events = iter(events)
+    prepended = set(self.prepended)
+    to_prepend = [event for idx, event in enumerate(itertools.islice(events,
+        self.consumed - first), first) if idx in prepended]
+    return itertools.chain(to_prepend, events)
+
+  def get_state(self):
+    """ The replayed state as a dict of arrays, to skip the replay """
+    return {
+        "online" : numpy.array(self.online, dtype=numpy.bool_),
+        "online_time" : numpy.array(self.online_time, dtype=numpy.float64),
+        "last_time" : numpy.array(self.last_time, dtype=numpy.float64),
+        "position" : numpy.array(self.position),
+        "consumed" : numpy.array(self.consumed),
+        "prepended" : numpy.array(self.prepended, dtype=numpy.int64),
+        "offset" : numpy.array(-1 if self.offset is None else self.offset),
+        }
+
+  def set_state(self, state):
+    self.online = state["online"].tolist()
+    self.online_time = state["online_time"].tolist()
+    self.last_time = state["last_time"].tolist()
+    self.position = int(state["position"])
+    self.consumed = int(state["consumed"])
+    self.prepended = state["prepended"].tolist()
+    offset = int(state["offset"]) if "offset" in state else -1
+    self.offset = None if offset < 0 else offset
 
 def main():
   parser = argparse.ArgumentParser(description="The AnonymitySimulator")
@@ -75,211 +307,302 @@ def main():
       help="defines the buddy sizes for the splitting algorithm")
   parser.add_argument("--output", default=None,
       help="where output pickles can be written (default: disabled)")
+  parser.add_argument("--attack", default="greedy", choices=METHODS,
+      help="how suspects are assigned to pseudonyms after the simulation: "
+      "greedy or optimal (default: greedy)")
+  parser.add_argument("--rank_mode", default="auto", choices=RANK_MODES,
+      help="how ranks are accounted: matrix accumulates them every round, "
+      "interval derives them from offline intervals when read, group keeps "
+      "the anonymity sets and ranks per group for the splitting policies, "
+      "auto is matrix unless its matrices would be large (default: auto)")
+  parser.add_argument("--checkpoint", default=None,
+      help="where the simulator state is periodically saved "
+      "(default: disabled)")
+  parser.add_argument("--checkpoint_interval", type=float, default=3600.0,
+      help="seconds of trace time between checkpoints (default: 3600.0)")
+  parser.add_argument("--resume", default=False, action="store_const",
+      const=True, help="continue from the last checkpoint, the other "
+      "arguments must match the checkpointed run")
+  parser.add_argument("--results", default=None,
+      help="where compact numpy results are written (default: disabled)")
+  parser.add_argument("--results_top_k", type=int, default=0,
+      help="keep only the top k ranks of each pseudonym in --results, "
+      "0 keeps the whole rank matrix (default: 0)")
+  parser.add_argument("--metrics", default=None,
+      help="where per-round metrics are written (default: disabled)")
+  parser.add_argument("--metrics_every", type=int, default=1,
+      help="record the metrics of one in this many rounds (default: 1)")
+  parser.add_argument("--metrics_format", default="csv", choices=FORMATS,
+      help="csv or binary metrics records (default: csv)")
+  parser.add_argument("--delay_hours", default=None,
+      help="where the delay statistics of every hour are written "
+      "(default: disabled)")
+  parser.add_argument("--profile", default=False, action="store_const",
+      const=True, help="report the time spent in each phase of the run")
+  parser.add_argument("--profile_dump", default=None,
+      help="where a cProfile dump of the run is written, implies --profile "
+      "(default: disabled)")
+  parser.add_argument("--no_cache", "--no-cache", default=False,
+      action="store_const", const=True, help="always simulate and "
+      "bootstrap, neither reading nor storing cached results or snapshots")
+  parser.add_argument("--cache_dir", default=os.path.join(
+      os.path.expanduser("~"), ".cache", "anon_sim"),
+      help="where results are cached (default: ~/.cache/anon_sim)")
+  parser.add_argument("--cache_size", type=float, default=256.0,
+      help="megabytes of cached results kept (default: 256.0)")
+  parser.add_argument("--snapshot_cache_size", type=float, default=256.0,
+      help="megabytes of cached bootstrap snapshots kept, apart from the "
+      "results (default: 256.0)")
   args = parser.parse_args()
+  error = rank_mode_error(args.policy, args.rank_mode)
+  if error is not None:
+    parser.error(error)
 
   logging.basicConfig(level=args.log_level)
 
-  msg_parser = DefaultParse(filename=args.input, end=args.end)
-  total = len(msg_parser.users)
-
-  if args.policy == "min_anon":
-    anon_sim = AnonymitySimulator(total, msg_parser.events,
-        min_anon = args.min_anon,
-        pseudonyms_per_client = args.pseudonyms_per_client,
-        round_time_span = args.round_time_span,
-        start_time = args.start)
-  elif args.policy == "dynamic_split":
-    anon_sim = DynamicSplitting(total, msg_parser.events,
-        min_anon = args.min_anon,
-        pseudonyms_per_client = args.pseudonyms_per_client,
-        round_time_span = args.round_time_span,
-        start_time = args.start,
-        trainer = args.trainer,
-        split_size = args.split_size)
-  elif args.policy == "static_split":
-    anon_sim = StaticSplitting(total, msg_parser.events,
-        min_anon = args.min_anon,
-        pseudonyms_per_client = args.pseudonyms_per_client,
-        round_time_span = args.round_time_span,
-        start_time = args.start,
-        trainer = args.trainer,
-        split_size = args.split_size)
-  elif args.policy == "extended_rounds":
-    anon_sim = DynamicSplitting(total, msg_parser.events,
+  profiler = None
+  if args.profile or args.profile_dump:
+    profiler = Profiler(args.profile_dump)
+
+  store = None
+  snapshots = None
+  if not args.no_cache:
+    store = ResultCache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+    snapshots = store.subcache(SNAPSHOTS,
+        int(args.snapshot_cache_size * 1024 * 1024))
+
+  # Runs writing anything but the printed results are always simulated
+  cache = None
+  summary = None
+  if store is not None and not (args.output or args.results or \
+      args.metrics or args.checkpoint or args.resume or profiler is not None):
+    cache = store
+    key = cache.key(args.input, [(name, getattr(args, name)) \
+        for name in CACHE_PARAMS])
+    summary = cache.get(key)
+    if summary is not None:
+      logging.info("Cached results of %s" % (args.input, ))
+
+  if summary is None:
+    msg_parser, tracker = bootstrap_tracker(snapshots, args.input, args.end,
+        args.start, args.round_time_span)
+    total = len(msg_parser.users)
+
+    anon_sim = create_simulator(args.policy, total, (),
         min_anon = args.min_anon,
         pseudonyms_per_client = args.pseudonyms_per_client,
         round_time_span = args.round_time_span,
         start_time = args.start,
         trainer = args.trainer,
-        split_size = args.split_size)
- 
-  anon_sim.run()
-
-  total_clients = total 
-  total_pseudonyms = total * args.pseudonyms_per_client
+        split_size = args.split_size,
+        rank_mode = args.rank_mode)
+    anon_sim.start_from(tracker, tracker.remaining(
+        msg_parser.events(tracker.first_needed(), tracker.offset),
+        tracker.first_needed()))
+    if args.output:
+      # The output pickles hold every delay
+      anon_sim.delayed_times = []
+    if args.resume and not args.checkpoint:
+      parser.error("--resume requires --checkpoint")
+    if args.metrics:
+      # Before restoring, which truncates them back to the checkpoint
+      anon_sim.metrics = MetricsWriter(args.metrics, args.metrics_every,
+          args.metrics_format, append = args.resume)
+    if args.checkpoint:
+      anon_sim.set_checkpoints(args.checkpoint, args.checkpoint_interval)
+      if args.resume:
+        anon_sim.restore(args.checkpoint, msg_parser.events())
+    if profiler is not None:
+      profiler.attach(anon_sim)
+      profiler.start()
+    anon_sim.run()
+    if anon_sim.metrics is not None:
+      anon_sim.metrics.close()
+
+    if profiler is not None:
+      analysis = profiler.timed(attack, "analysis")(anon_sim, args.attack)
+      profiler.stop()
+    else:
+      analysis = attack(anon_sim, args.attack)
+    summary = summarize(anon_sim, total, analysis)
+    if cache is not None:
+      cache.put(key, summary)
+
+    if args.results:
+      write_results(args.results, anon_sim, repr(sorted(vars(args).items())),
+          args.results_top_k)
+
+    if args.output:
+      output = open(args.output, "w+")
+      pickle.dump(anon_sim.on_time, output)
+      pickle.dump(len(anon_sim.lost_messages), output)
+      pickle.dump(anon_sim.delayed_times, output)
+      pickle.dump(anon_sim.pseudonyms, output)
+      pickle.dump(anon_sim.clients, output)
+
+  total_clients = int(summary["total"])
+  total_pseudonyms = total_clients * args.pseudonyms_per_client
 
   print "Total clients: %s" % (total_clients, )
   print "Total pseudonyms: %s" % (total_pseudonyms, )
-  print "Delivered messages: %s" % (anon_sim.on_time, )
-  print "Delayed messages: %s" % (len(anon_sim.delayed_times), )
-  print "Lost messages: %s" % (len(anon_sim.lost_messages), )
+  print "Delivered messages: %s" % (int(summary["on_time"]), )
+  delays = DelayStats()
+  delays.set_state(dict((name[len("delays_"):], value) \
+      for name, value in summary.items() if name.startswith("delays_")))
+  print "Delayed messages: %s" % (delays.count, )
+  print "Lost messages: %s" % (int(summary["lost"]), )
   
 #  print "Delays: %s" % (anon_sim.delayed_times)
-  avg_delay = 0
-  std_dev = 0
-  if len(anon_sim.delayed_times)> 0:
-    avg_delay = sum(anon_sim.delayed_times)/len(anon_sim.delayed_times)
-    var_list = [(i-avg_delay) ** 2 for i in anon_sim.delayed_times]
-    varience = sum(var_list)/len(var_list)
-    std_dev = math.sqrt(varience)  
-
-  print "Average Delay: %f" % avg_delay
-  print "Standard Deviation of Delays: %f" % std_dev 
+  print "Average Delay: %f" % delays.average()
+  print "Standard Deviation of Delays: %f" % delays.std_dev()
+  for name, value in delays.summary()[3:]:
+    print "Delay %s: %f" % (name, value)
+  if args.delay_hours:
+    write_hours(args.delay_hours, delays)
   
-  to_print = []
-  for client in anon_sim.clients:
-    if(total_pseudonyms == len(client.pseudonyms)):
-      continue
-    to_print.append(len(client.pseudonyms))
-  #print "Clients: %s" % (to_print,)
-
-  to_print = []
-  for pseudonym in anon_sim.pseudonyms:
-    if(total_clients == len(pseudonym.clients)):
-      continue
-    to_print.append(len(pseudonym.clients))
- # print "Pseudonyms: %s" % (to_print,)
-
-  to_print = []
-  result = {}
-  for pseudonym in anon_sim.pseudonyms:
-    if(total_clients == len(pseudonym.clients)):
-      continue
-    own_rank = 0
-    accumulated = 0
-    same = 0
-    near = 0
-    own_value = pseudonym.client_rank[pseudonym.uid]
-    max_idx = pseudonym.uid
-    max_value = own_value
-    up_own = own_value * 1.1
-    down_own = own_value * 0.9
-    for cuid in pseudonym.client_rank.keys():
-      cvalue = pseudonym.client_rank[cuid]
-      accumulated += cvalue
-      if max_value < cvalue:
-        max_value = cvalue
-        max_idx = cuid
-      if own_value < cvalue:
-        own_rank += 1
-      if cvalue == own_value:
-        same += 1
-      if cvalue > down_own and cvalue < up_own:
-        near += 1
-    result[pseudonym.uid] = max_idx
-    if accumulated == 0:
-      prob = 1 / len(pseudonym.clients)
-    else:
-      prob = float(own_value) / float(accumulated)
-    to_print.append((pseudonym.uid, max_idx, max_value, own_rank, own_value, same, near, prob))
-
-  change = True
-  kdx = 0
-  while change:
-    jdx = 0
-    change = False
-    kdx += 1
-    for item0 in result.keys():
-      jdx += 1
-      for item1 in result.keys():
-        if item0 == item1:
-          continue
-        if result[item0] != result[item1]:
-          continue
-        idx = result[item0]
-        val0 = anon_sim.pseudonyms[item0].client_rank[idx]
-        val1 = anon_sim.pseudonyms[item1].client_rank[idx]
-        to_swap = item0
-        val_swap = val0
-        if val1 < val0:
-          to_swap = item1
-          val_swap = val1
-        else:
-          continue
-
-        next_val = 0
-        next_idx = -1
-        for uid in anon_sim.pseudonyms[to_swap].client_rank.keys():
-          if uid == idx:
-            continue
-          rank =  anon_sim.pseudonyms[to_swap].client_rank[uid]
-          if rank >= val_swap or rank <= next_val:
-            continue
-          next_val = rank
-          next_idx = uid
-
-        if next_idx == -1:
-          continue
-        result[to_swap] = next_idx
-        change = True
-
-#  print "Pseudonyms' Ranks: "
-  found0 = 0
-  found1 = 0
-  for top in to_print:
-    found0_0 = top[0] == top[1]
-    found1_0 = result[top[0]] == top[0]
- #   print "\t%s -- %s -- %s -- %s" % (found0_0, found1_0, top, result[top[0]])
-    if found1_0:
-      found1 += 1
-    if found0_0:
-      found0 += 1
-  #print "Found: %s -- %s" % (found0, found1)
-
-  if args.output:
-    output = open(args.output, "w+")
-    pickle.dump(anon_sim.on_time, output)
-    pickle.dump(len(anon_sim.lost_messages), output)
-    pickle.dump(anon_sim.delayed_times, output)
-    pickle.dump(anon_sim.pseudonyms, output)
-    pickle.dump(anon_sim.clients, output)
+  print "Attacked pseudonyms: %s" % (int(summary["attacked"]), )
+  print "Found by top rank: %s" % (int(summary["found_top"]), )
+  print "Found by %s assignment: %s" % (args.attack, int(summary["found"]))
+
+  if profiler is not None:
+    for line in profiler.report():
+      print line
+
+def bootstrap_tracker(store, filename, end, start_time, round_time_span):
+  """ Parses the data set up to end and replays the events before the start,
+  or loads the snapshot of an earlier replay from store, None to always
+  replay.  A snapshot also holds the users in the order they join, which
+  spares the light first pass of DefaultParse.  Returns the DefaultParse and
+  the OnlineTracker. """
+  if store is None:
+    msg_parser = DefaultParse(filename=filename, end=end)
+    tracker = OnlineTracker(len(msg_parser.users))
+    tracker.replay(msg_parser.events(), start_time, round_time_span)
+    return msg_parser, tracker
+
+  # The replay stops at the first event from the first round, handing back
+  # the messages before it too if that is where the simulation starts
+  start_time = start_time if start_time != 0 else round_time_span
+  key = store.key(filename, [("snapshot", True), ("end", end),
+      ("start", start_time), ("messages", start_time == round_time_span)])
+  state = store.get(key)
+  if state is not None and "users" in state:
+    logging.info("Bootstrap snapshot of %s" % (filename, ))
+    msg_parser = DefaultParse(filename=filename, end=end,
+        join_order=state["users"].tolist())
+    tracker = OnlineTracker(len(msg_parser.users))
+    tracker.set_state(state)
+    return msg_parser, tracker
+
+  msg_parser = DefaultParse(filename=filename, end=end)
+  tracker = OnlineTracker(len(msg_parser.users))
+  tracker.replay(located(tracker, msg_parser), start_time, round_time_span)
+  if tracker.offset is None:
+    # Either the replay stopped at the first event it handed back or it
+    # read the whole data set, read() is where the remaining events start
+    tracker.offset = msg_parser.offset
+  state = tracker.get_state()
+  users = numpy.array(msg_parser.join_order())
+  # Users of mixed types would only be stored pickled, which numpy will not
+  # load back, those data sets are parsed every time
+  if users.dtype != numpy.object_:
+    state["users"] = users
+  store.put(key, state)
+  return msg_parser, tracker
+
+def located(tracker, msg_parser):
+  """ The events of msg_parser, noting the byte offset of the first one the
+  replay hands back in tracker.offset so a snapshot can seek back to it """
+  for event in msg_parser.events():
+    yield event
+    if tracker.offset is None and len(tracker.prepended) > 0:
+      # Handed back the event it was just given, read() has not moved on yet
+      tracker.offset = msg_parser.offset
+
+def summarize(sim, total, analysis):
+  """ The printed results of a finished simulation and its attack as a dict
+  of arrays """
+  summary = {
+      "total" : numpy.array(total),
+      "on_time" : numpy.array(sim.on_time),
+      "lost" : numpy.array(len(sim.lost_messages)),
+      "attacked" : numpy.array(len(analysis.pseudonyms)),
+      "found_top" : numpy.array(analysis.found_top()),
+      "found" : numpy.array(analysis.found()),
+      }
+  for name, value in sim.delays.get_state().items():
+    summary["delays_" + name] = value
+  return summary
+
+def rank_mode_error(policy, rank_mode):
+  """ Why the policy cannot be simulated in the rank mode, None if it can """
+  if rank_mode == "group" and policy not in SPLIT_POLICIES:
+    return "the group rank mode needs a splitting policy: %s" % \
+        (", ".join(SPLIT_POLICIES), )
+  return None
+
+def create_simulator(policy, total, events, min_anon = 0,
+    pseudonyms_per_client = 1, round_time_span = 2.0, start_time = 0,
+    trainer = None, split_size = 1, rank_mode = "auto"):
+  """ Builds the simulator for a policy: min_anon, dynamic_split,
+  static_split or extended_rounds """
+  if policy == "min_anon":
+    return AnonymitySimulator(total, events,
+        min_anon = min_anon,
+        pseudonyms_per_client = pseudonyms_per_client,
+        round_time_span = round_time_span,
+        start_time = start_time,
+        rank_mode = rank_mode)
+  elif policy == "dynamic_split" or policy == "extended_rounds":
+    return DynamicSplitting(total, events,
+        min_anon = min_anon,
+        pseudonyms_per_client = pseudonyms_per_client,
+        round_time_span = round_time_span,
+        start_time = start_time,
+        trainer = trainer,
+        split_size = split_size,
+        rank_mode = rank_mode)
+  elif policy == "static_split":
+    return StaticSplitting(total, events,
+        min_anon = min_anon,
+        pseudonyms_per_client = pseudonyms_per_client,
+        round_time_span = round_time_span,
+        start_time = start_time,
+        trainer = trainer,
+        split_size = split_size,
+        rank_mode = rank_mode)
+  raise ValueError("Unknown policy: %s" % (policy, ))
 
 class AnonymitySimulator:
   """ Processes a data set to calculate both the clients' and their
   respective message pseudonyms' anonymity over time. """
+  # Whether clients share their anonymity sets by group, as the group rank
+  # mode requires
+  group_granular = False
+
   class Client:
-    """ Represents a single client """
-    def __init__(self, uid, total):
+    """ Represents a single client, whose online state is kept by an
+    OnlineTracker """
+    def __init__(self, uid, anonymity_sets, tracker):
       self.uid = uid
-      self.pseudonyms = {num: True for num in range(total)}
-      self.coins = {num: -1 for num in range(total)}
-      self.online = False
-
-      self.online_time = 0
-      self.last_time = -1 
+      self.anonymity_sets = anonymity_sets
+      self.pseudonyms = anonymity_sets.client_view(uid)
+      self.coins = {}
+      self.tracker = tracker
 
       self.rand = random.Random()
       self.rand.seed(uid)
 
-    def set_online(self, ctime):
-      """ Set the client as online """
-      self.online = True
-      self.last_time = ctime
-
-    def set_offline(self, ctime):
-      """ Set the client as offline """
-      self.online = False
-      self.online_time += ctime - self.last_time
-      self.last_time = -1
-
     def get_online_time(self, ctime = 0):
-      if ctime == 0 or self.last_time == -1:
-        return self.online_time
-      return self.online_time + ctime - self.last_time
+      return self.tracker.online_time_at(self.uid, ctime)
+
+    def get_last_time(self):
+      """ Start of the client's session, -1 while offline """
+      return self.tracker.last_time[self.uid]
 
     def get_online(self):
       """ Return the client's online state """
-      return self.online
+      return self.tracker.online[self.uid]
 
     def remove_if(self, idx):
       """ Returns the count if the nym was removed """
@@ -290,22 +613,37 @@ class AnonymitySimulator:
 
     def remove_nym(self, idx):
       """ Remove a nym from the client's anonymity set """
-      if idx in self.pseudonyms:
-        del self.pseudonyms[idx]
+      self.anonymity_sets.remove(idx, self.uid)
 
     def flip_coins(self, uids, prob = .1):
       for uid in uids:
-        if self.coins[uid] != -1:
+        if self.coins.get(uid, -1) != -1:
           continue
         self.coins[uid] = self.rand.random() < prob
 
+    def __getstate__(self):
+      """ Pickled as plain dicts, without the shared anonymity sets """
+      total_pseudonyms = len(self.anonymity_sets.pseudonym_sizes)
+      return {
+          "uid" : self.uid,
+          "pseudonyms" : dict((nym, True) for nym in self.pseudonyms),
+          "coins" : dict((nym, self.coins.get(nym, -1)) \
+              for nym in range(total_pseudonyms)),
+          "online" : self.get_online(),
+          "online_time" : self.get_online_time(),
+          "last_time" : self.get_last_time(),
+          "rand" : self.rand,
+          }
+
   class Pseudonym:
     """ Represents a single message session """
-    def __init__(self, uid, total):
+    def __init__(self, uid, anonymity_sets, ranks):
       self.uid = uid
-      self.clients = {num: True for num in range(total)}
-      self.client_rank = {num: 0 for num in range(total)}
-      self.client_subrank = {num: 0 for num in range(total)}
+      self.anonymity_sets = anonymity_sets
+      self.clients = anonymity_sets.pseudonym_view(uid)
+      # Read-only views, ranks are accumulated by the simulator
+      self.client_rank = ranks.rank_view(uid)
+      self.client_subrank = ranks.subrank_view(uid)
 
     def remove_if(self, idx):
       """ Returns the count if the client was removed """
@@ -316,13 +654,111 @@ class AnonymitySimulator:
 
     def remove_client(self, idx):
       """ Remove a client from the nym's anonymity set """
-      if idx in self.clients:
-        del self.clients[idx]
-        del self.client_rank[idx]
+      self.anonymity_sets.remove(self.uid, idx)
+
+    def __getstate__(self):
+      """ Pickled as plain dicts, without the shared anonymity sets and
+      rank engine """
+      return {
+          "uid" : self.uid,
+          "clients" : dict((cuid, True) for cuid in self.clients),
+          "client_rank" : dict(self.client_rank.items()),
+          "client_subrank" : dict(self.client_subrank.items()),
+          }
+
+  class DelayedMessages:
+    """ Messages waiting to be delivered, queued per sender in the order
+    they were delayed.  Senders that were online when their message failed
+    the minimum anonymity check are tracked, so that a join only retries the
+    messages it could unblock. """
+    def __init__(self):
+      self.queues = {}
+      self.min_anon_blocked = set()
+      self.count = 0
+      self.next_seq = 0
+
+    def __len__(self):
+      return self.count
+
+    def add(self, event, sender_online):
+      """ Delay a message, sender_online tells whether it was blocked by
+      the minimum anonymity rather than by its sender being offline """
+      uid = event[2][0]
+      if uid not in self.queues:
+        self.queues[uid] = collections.deque()
+      self.queues[uid].append((self.next_seq, event))
+      self.next_seq += 1
+      self.count += 1
+      if sender_online:
+        self.min_anon_blocked.add(uid)
+
+    def pop(self, event):
+      """ Remove a delivered message, it must be the oldest of its sender """
+      uid = event[2][0]
+      queue = self.queues[uid]
+      assert(queue[0][1] is event)
+      queue.popleft()
+      self.count -= 1
+      if len(queue) == 0:
+        del self.queues[uid]
+        self.min_anon_blocked.discard(uid)
+
+    def retry(self, joined, is_online):
+      """ Yields, in the order they were delayed, the messages of online
+      senders that just joined or were blocked by the minimum anonymity.
+      Delivered messages must be pop()'d before resuming. """
+      heap = []
+      for uid in self.min_anon_blocked.union(joined):
+        if uid in self.queues and is_online(uid):
+          heap.append((self.queues[uid][0][0], uid))
+      heapq.heapify(heap)
+
+      while len(heap) > 0:
+        seq, uid = heapq.heappop(heap)
+        yield self.queues[uid][0][1]
+        queue = self.queues.get(uid)
+        if queue is not None and queue[0][0] == seq:
+          # Not delivered, delivering other messages only shrinks the
+          # anonymity sets so this sender's later messages would fail too
+          self.min_anon_blocked.add(uid)
+        elif queue is not None:
+          heapq.heappush(heap, (queue[0][0], uid))
+
+    def messages(self):
+      """ All delayed messages in the order they were delayed """
+      return [event for seq, event in heapq.merge(*self.queues.values())]
+
+    def get_state(self, index):
+      """ The queues as arrays, index maps a message to its position in
+      the event stream """
+      entries = sorted(itertools.chain(*self.queues.values()))
+      return {
+          "delayed_seqs" : numpy.array([seq for seq, event in entries],
+              dtype=numpy.int64),
+          "delayed_events" : numpy.array([index(event) \
+              for seq, event in entries], dtype=numpy.int64),
+          "delayed_blocked" : numpy.array(sorted(self.min_anon_blocked),
+              dtype=numpy.int64),
+          "delayed_next_seq" : numpy.array(self.next_seq),
+          }
+
+    def set_state(self, state, messages):
+      """ Restores the queues, messages maps stream positions to events """
+      self.queues = {}
+      for seq, idx in zip(state["delayed_seqs"].tolist(),
+          state["delayed_events"].tolist()):
+        event = messages[idx]
+        uid = event[2][0]
+        if uid not in self.queues:
+          self.queues[uid] = collections.deque()
+        self.queues[uid].append((seq, event))
+      self.count = len(state["delayed_seqs"])
+      self.min_anon_blocked = set(state["delayed_blocked"].tolist())
+      self.next_seq = int(state["delayed_next_seq"])
 
   def __init__(self, total, events, min_anon = 0,
       pseudonyms_per_client = 1, round_time_span = 2.0,
-      start_time=0):
+      start_time=0, rank_mode = "auto"):
 
     self.event_actions = {
         "join" : self.on_join,
@@ -332,136 +768,298 @@ class AnonymitySimulator:
 
     total_clients = total
     total_pseudonyms = total * pseudonyms_per_client
+    rank_mode = resolve_rank_mode(rank_mode, total_pseudonyms, total_clients)
 
-    self.clients = [AnonymitySimulator.Client(uid, total_pseudonyms) \
-        for uid in range(total_clients)]
-    self.pseudonyms = [AnonymitySimulator.Pseudonym(uid, total_clients) \
+    if rank_mode == "group":
+      if not self.group_granular:
+        raise ValueError("The group rank mode needs a splitting policy")
+      self.anonymity_sets = GroupAnonymitySets(total_pseudonyms,
+          total_clients, min_anon)
+    else:
+      self.anonymity_sets = AnonymitySets(total_pseudonyms, total_clients,
+          min_anon)
+    self.ranks = RANK_ENGINES[rank_mode](self.anonymity_sets)
+    self.tracker = OnlineTracker(total_clients)
+    self.clients = [AnonymitySimulator.Client(uid, self.anonymity_sets,
+        self.tracker) for uid in range(total_clients)]
+    self.pseudonyms = [AnonymitySimulator.Pseudonym(uid, \
+        self.anonymity_sets, self.ranks) \
         for uid in range(total_pseudonyms)]
+    # Offline clients, maintained by on_join / on_quit
+    self.offline_mask = self.anonymity_sets.offline
 
     self.pseudonyms_per_client = pseudonyms_per_client
     self.min_anon = min_anon
     self.round_time_span = round_time_span
     self.total = total
     self.start_time = start_time
+    self.rank_mode = rank_mode
     self.on_time = 0
-    self.delayed_times = []
+    self.delays = DelayStats()
+    # Every delay as well, only if set to a list
+    self.delayed_times = None
+    self.lost_messages = []
+    self.next_time = round_time_span
+    self.delayed_msgs = AnonymitySimulator.DelayedMessages()
+
+    # Position in the event stream of the next event to process, along with
+    # the position of messages, by id, so checkpoints can refer to them
+    self.position = 0
+    self.prepended = {}
+    self.message_index = {}
+    self.checkpoint_file = None
+    self.checkpoint_interval = 0
+    self.next_checkpoint = 0
+    self.resumed = False
+    self.metrics = None
 
     self.events = self.bootstrap(events)
 
   def bootstrap(self, events):
-    start_time = self.start_time if self.start_time != 0 else self.round_time_span
-
-    to_prepend = []
-    idx = 0
-    while idx < len(events) and events[idx][0] < start_time:
-      event = events[idx]
-      idx += 1
-
-      if event[1] == "join":
-        AnonymitySimulator.on_join(self, event[0], event[2])
-      elif event[1] == "quit":
-        AnonymitySimulator.on_quit(self, event[0], event[2])
-      elif event[1] == "msg":
-        if start_time == self.round_time_span:
-          to_prepend.append(event)
-      else:
-        assert(False)
-
-    if len(to_prepend) > 0:
-      to_prepend.extend(events[idx:])
-      return to_prepend
-    return events[idx:]
+    tracker = OnlineTracker(self.total)
+    events = tracker.replay(events, self.start_time, self.round_time_span)
+    self.set_online_state(tracker)
+    return events
+
+  def start_from(self, tracker, events):
+    """ Starts from the online state of an OnlineTracker instead of
+    bootstrapping, events being the ones its replay returned """
+    self.set_online_state(tracker)
+    self.events = events
+
+  def set_online_state(self, tracker):
+    """ Keeps the online state of the clients in an OnlineTracker, as it
+    stands before the first round.  Several simulations can share it, as
+    long as the rounds update it only once, see process_round. """
+    self.tracker = tracker
+    for client in self.clients:
+      client.tracker = tracker
+      self.anonymity_sets.set_online(client.uid, client.get_online())
+    self.position = tracker.position
+    # The events handed back by the replay come first but sit earlier in
+    # the stream, their indices by the positions they are read at
+    self.prepended = dict(zip(range(tracker.position,
+        tracker.position + len(tracker.prepended)), tracker.prepended))
 
   def run(self):
+    self.prepare()
     self.process_events(self.events)
 
-  def process_events(self, events):
-    events.reverse()
-    delayed_msgs = []
-    next_time = self.round_time_span
-
-    while len(events) > 0:
-
-      msgs = []
-
-      # Move us to the period during the next event
-      current_time = next_time
-      next_time = events[-1][0] + self.round_time_span - (events[-1][0] % self.round_time_span)
-      rounds = (next_time - current_time) / self.round_time_span
-
-      if rounds > 1:
-        for nym in self.pseudonyms:
-          for cuid in nym.client_rank.keys():
-            if not self.is_member_online(cuid):
-              nym.client_rank[cuid] += rounds - 1
-              if not self.clients[cuid].get_online():
-                nym.client_subrank[cuid] += rounds - 1
-
-      quit = {}
-      join_event = False
-
-      while len(events) > 0 and events[-1][0] < next_time:
-        event = events.pop()
-        if event[1] == "join":
-          if event[2] in quit:
-            del quit[event[2]]
-            continue
-          self.on_join(event[0], event[2])
-          join_event = True
-        elif event[1] == "msg":
-          msgs.append(event)
-        elif event[1] == "quit":
-          quit[event[2]] = event[0]
-        else:
-          assert(False)
-
-      delivered = {}
-      if join_event:
-        idx = 0
-        while idx < len(delayed_msgs):
-          event = delayed_msgs[idx]
-          if not self.on_msg(event[0], event[2]):
-            idx += 1
-            continue
-          delivered[event[2][0]] = True
-          delayed_msgs.pop(idx)
-          msg_time = event[0] + self.round_time_span - \
-              (event[0] % self.round_time_span)
-          self.delayed_times.append(next_time - msg_time)
-
-      for event in msgs:
-        if self.on_msg(event[0], event[2]):
-          delivered[event[2][0]] = True
-          self.on_time += 1
-        else:
-          delayed_msgs.append(event)
+  def prepare(self):
+    """ Called once bootstrapped, before the first round """
+    pass
 
-      for nym in self.pseudonyms:
-        if nym.uid in delivered:
+  def process_events(self, events):
+    for round_time, batch in round_batches(events, self.round_time_span):
+      self.process_round(round_time, batch)
+    self.finish()
+
+  def process_round(self, round_time, batch):
+    """ Processes the events of the round ending at round_time.  The online
+    state is updated here rather than by the handlers: joins before the round
+    starts, each quit right before on_quit reads it. """
+    delta = RoundDelta(batch)
+    self.tracker.apply_joins(delta)
+    self.start_round(round_time, delta)
+    for uid, etime in delta.quits:
+      self.tracker.quit(etime, uid)
+      self.on_quit(etime, uid)
+    self.end_round(round_time)
+
+  def start_round(self, round_time, delta):
+    """ Handles the joins and messages of the RoundDelta of the round ending
+    at round_time, with its joins already online """
+    delayed_msgs = self.delayed_msgs
+    self.track_batch(delta.batch)
+
+    # Move us to the period during the next event
+    current_time = self.next_time
+    next_time = round_time
+    rounds = (next_time - current_time) / self.round_time_span
+
+    if rounds > 1:
+      self.update_ranks(rounds - 1)
+
+    joined = []
+    for event in delta.joins:
+      self.on_join(event[0], event[2])
+      joined.append(event[2])
+
+    delivered = {}
+    if len(joined) > 0:
+      for event in delayed_msgs.retry(joined, self.is_member_online):
+        if not self.on_msg(event[0], event[2]):
           continue
-        for cuid in nym.client_rank.keys():
-          if not self.is_member_online(cuid):
-            nym.client_rank[cuid] += 1
-            if not self.clients[cuid].get_online():
-              nym.client_subrank[cuid] += 1
+        delivered[event[2][0]] = True
+        delayed_msgs.pop(event)
+        msg_time = event[0] + self.round_time_span - \
+            (event[0] % self.round_time_span)
+        self.record_delay(next_time - msg_time, msg_time)
+
+    for event in delta.msgs:
+      if self.on_msg(event[0], event[2]):
+        delivered[event[2][0]] = True
+        self.on_time += 1
+      else:
+        delayed_msgs.add(event, self.is_member_online(event[2][0]))
 
-      for uid, etime in quit.items():
-        self.on_quit(etime, uid)
+    self.update_ranks(1, delivered)
 
+  def finish(self):
+    """ Called once the event stream is exhausted """
     # No more join / quit events and there are still message posting events
     # add these to lost messages and break
-    self.lost_messages = delayed_msgs
+    self.lost_messages = self.delayed_msgs.messages()
 #    if self.policy == self.splitting:
 #      for msg in msgs:
 #        self.splitting(msg[0],msg[2][0], msg[2][1], True)
 
+  def record_delay(self, delay, msg_time):
+    """ Records the delay of a message sent in the round ending at
+    msg_time """
+    self.delays.add(delay, msg_time)
+    if self.delayed_times is not None:
+      self.delayed_times.append(delay)
+
+  def set_checkpoints(self, filename, interval):
+    """ Checkpoint to filename every interval seconds of trace time """
+    self.checkpoint_file = filename
+    self.checkpoint_interval = interval
+    self.next_checkpoint = self.next_time + interval
+
+  def track_batch(self, batch):
+    """ Advances the stream position past a round's events, remembering the
+    position of its messages while checkpointing """
+    if self.checkpoint_file is not None:
+      for idx, event in enumerate(batch):
+        if event[1] == "msg":
+          position = self.position + idx
+          self.message_index[id(event)] = self.prepended.get(position,
+              position)
+    self.position += len(batch)
+
+  def end_round(self, round_time):
+    """ Called once all of the events of the round ending at round_time
+    are processed """
+    self.next_time = round_time
+    if self.metrics is not None:
+      self.metrics.record(self)
+    if self.checkpoint_file is None or self.next_time < self.next_checkpoint:
+      return
+    self.checkpoint(self.checkpoint_file)
+    self.next_checkpoint = self.next_time + self.checkpoint_interval
+
+  def checkpoint(self, filename):
+    """ Writes the simulator state between two rounds to filename """
+    index = {}
+    for event in self.pending_messages():
+      index[id(event)] = self.message_index[id(event)]
+    # Delivered messages are never referred to again
+    self.message_index = index
+    state = self.get_state(lambda event: index[id(event)])
+    if self.metrics is not None:
+      offset, rounds = self.metrics.checkpoint()
+      state["metrics_offset"] = numpy.array(offset)
+      state["metrics_rounds"] = numpy.array(rounds)
+    write_checkpoint(filename, state)
+
+  def restore(self, filename, events):
+    """ Continues from the checkpoint in filename, events must be the whole
+    event stream the checkpointed simulation was started with """
+    state = read_checkpoint(filename)
+    if str(state["config"]) != repr(self.config()):
+      raise ValueError("%s was written by a different simulation: %s" % \
+          (filename, state["config"]))
+    # Arrays named *_events hold stream positions of pending messages
+    indices = [idx for name in state if name.endswith("_events") \
+        for idx in state[name].tolist()]
+    messages, self.events = replay(events, int(state["position"]), indices)
+    self.set_state(state, messages)
+    if self.metrics is not None and "metrics_offset" in state:
+      self.metrics.resume(int(state["metrics_offset"]),
+          int(state["metrics_rounds"]))
+    self.message_index = dict((id(event), idx) \
+        for idx, event in messages.items())
+    self.next_checkpoint = self.next_time + self.checkpoint_interval
+    self.resumed = True
+
+  def config(self):
+    """ The parameters a checkpoint is only valid for """
+    return (self.__class__.__name__, self.total, self.pseudonyms_per_client,
+        self.min_anon, self.round_time_span, self.start_time, self.rank_mode)
+
+  def pending_messages(self):
+    """ Messages that have been read but not delivered """
+    return self.delayed_msgs.messages()
+
+  def queued_messages(self):
+    """ Number of pending messages """
+    return len(self.delayed_msgs)
+
+  def get_state(self, index):
+    """ The simulator state as a dict of arrays, index maps a pending
+    message to its position in the event stream """
+    state = {
+        "config" : numpy.array(repr(self.config())),
+        "position" : numpy.array(self.position),
+        "next_time" : numpy.array(self.next_time),
+        "on_time" : numpy.array(self.on_time),
+        "client_online" : numpy.array(self.tracker.online,
+            dtype=numpy.bool_),
+        "client_online_time" : numpy.array(self.tracker.online_time,
+            dtype=numpy.float64),
+        # Clients keep integer times until they first go offline
+        "client_timed" : numpy.array([isinstance(online_time, float) \
+            for online_time in self.tracker.online_time], dtype=numpy.bool_),
+        "client_last_time" : numpy.array(self.tracker.last_time,
+            dtype=numpy.float64),
+        }
+    if self.delayed_times is not None:
+      state["delayed_times"] = numpy.array(self.delayed_times,
+          dtype=numpy.float64)
+    for name, value in self.delays.get_state().items():
+      state["delays_" + name] = value
+    state.update(self.delayed_msgs.get_state(index))
+    for prefix, owner in [("sets_", self.anonymity_sets),
+        ("ranks_", self.ranks)]:
+      for name, value in owner.get_state().items():
+        state[prefix + name] = value
+    return state
+
+  def set_state(self, state, messages):
+    """ Restores the state returned by get_state, messages maps stream
+    positions to the pending messages """
+    self.position = int(state["position"])
+    self.next_time = float(state["next_time"])
+    self.on_time = int(state["on_time"])
+    self.delays.set_state(dict((name[len("delays_"):], value) \
+        for name, value in state.items() if name.startswith("delays_")))
+    if self.delayed_times is not None:
+      if "delayed_times" not in state:
+        raise ValueError("The checkpoint does not hold every delay")
+      self.delayed_times = state["delayed_times"].tolist()
+    tracker = self.tracker
+    tracker.online = state["client_online"].tolist()
+    tracker.online_time = [online_time if timed else int(online_time) \
+        for online_time, timed in zip(state["client_online_time"].tolist(),
+        state["client_timed"].tolist())]
+    tracker.last_time = [last_time if last_time != -1 else -1 \
+        for last_time in state["client_last_time"].tolist()]
+    self.delayed_msgs.set_state(state, messages)
+    for prefix, owner in [("sets_", self.anonymity_sets),
+        ("ranks_", self.ranks)]:
+      owner.set_state(dict((name[len(prefix):], value) \
+          for name, value in state.items() if name.startswith(prefix)))
+
   def on_join(self, etime, uid):
     """ Handler for the client join event """
-    self.clients[uid].set_online(etime)
+    self.anonymity_sets.set_online(uid, True)
+    self.ranks.changed(uid, self.is_member_online(uid), True)
 
   def on_quit(self, etime, uid):
     """ Handler for the client quit event """
-    self.clients[uid].set_offline(etime)
+    self.anonymity_sets.set_online(uid, False)
+    self.ranks.changed(uid, self.is_member_online(uid), False)
 
   def on_msg(self, etime, (uid, msg)):
     """ Handler for the client message post event """
@@ -472,44 +1070,132 @@ class AnonymitySimulator:
     if not self.check_min_anon(uid):
       return False
 
-    for client in self.clients:
-      if not self.is_member_online(client.uid):
-        client.remove_nym(uid)
-        self.pseudonyms[uid].remove_client(client.uid)
+    self.anonymity_sets.remove_offline(uid)
     return True
 
+  def update_ranks(self, rounds, delivered = ()):
+    """ Adds rounds to the rank of each offline member in the anonymity set
+    of every nym that did not deliver a message """
+    self.ranks.add_rounds(rounds, delivered, self.member_offline_mask(),
+        self.offline_mask)
+
   def is_member_online(self, uid):
     return self.clients[uid].get_online()
 
+  def member_offline_mask(self):
+    """ Clients that are not online as seen by is_member_online """
+    return self.offline_mask
+
   def check_min_anon(self, uid):
-    clients_offline = 0
-    for client in self.clients:
-      if not self.is_member_online(client.uid):
-        if client.remove_if(uid) < self.min_anon:
-          return False
-        if client.uid in self.pseudonyms[uid].clients:
-          clients_offline += 1
-          if len(self.pseudonyms[uid].clients) - clients_offline < self.min_anon:
-            return False
-    return True
+    return self.anonymity_sets.check_min_anon(uid)
 
 class DynamicSplitting(AnonymitySimulator):
+  # Members of a group, and clients waiting for one, are removed together
+  group_granular = True
+
+  class OnlineTimeIndex:
+    """ Group 0 members ordered by their online time, kept in two heaps with
+    lazy invalidation.  Online members are keyed by online_time - last_time,
+    to which the current time is added when comparing, offline members by
+    online_time.  The version of a uid outlives its removal, so that the
+    entries pushed before cannot come back if it is added again. """
+    def __init__(self, clients):
+      self.clients = clients
+      self.online = []
+      self.offline = []
+      self.versions = {}
+      self.live = set()
+
+    def __len__(self):
+      return len(self.live)
+
+    def current(self, entry):
+      """ Whether a heap entry is the latest one of a member """
+      return entry[1] in self.live and self.versions[entry[1]] == entry[2]
+
+    def update(self, uid):
+      """ Adds uid or re-keys it after its online state changed """
+      client = self.clients[uid]
+      version = self.versions.get(uid, 0) + 1
+      self.versions[uid] = version
+      self.live.add(uid)
+      if client.get_online():
+        heapq.heappush(self.online,
+            (client.get_online_time() - client.get_last_time(), uid, version))
+      else:
+        heapq.heappush(self.offline, (client.get_online_time(), uid, version))
+      if len(self.online) + len(self.offline) > 4 * len(self.live) + 64:
+        self.compact()
+
+    def remove(self, uid):
+      self.live.discard(uid)
+
+    def compact(self):
+      self.online = [entry for entry in self.online if self.current(entry)]
+      self.offline = [entry for entry in self.offline if self.current(entry)]
+      heapq.heapify(self.online)
+      heapq.heapify(self.offline)
+
+    def smallest(self, count, etime):
+      """ The uids of the count members with the least online time at etime,
+      lower uids first among equal times, as sorting all members by
+      get_online_time(etime) would return them """
+      # Online keys are compared approximately, so every member within a
+      # tolerance of the count-th one is pulled and then ordered exactly
+      if count <= 0:
+        return []
+      tolerance = 1e-9 * max(1.0, abs(etime))
+      pulled = []
+      limit = None
+      while True:
+        while len(self.online) > 0 and not self.current(self.online[0]):
+          heapq.heappop(self.online)
+        while len(self.offline) > 0 and not self.current(self.offline[0]):
+          heapq.heappop(self.offline)
+        online = self.online[0][0] + etime if len(self.online) > 0 else None
+        offline = self.offline[0][0] if len(self.offline) > 0 else None
+        if online is None and offline is None:
+          break
+        if offline is None or (online is not None and online <= offline):
+          key, heap = online, self.online
+        else:
+          key, heap = offline, self.offline
+        if limit is not None and key > limit:
+          break
+        pulled.append((heap, heapq.heappop(heap)))
+        if len(pulled) == count:
+          limit = key + tolerance
+
+      for heap, entry in pulled:
+        heapq.heappush(heap, entry)
+      uids = [entry[1] for heap, entry in pulled]
+      uids.sort(key=lambda uid: (self.clients[uid].get_online_time(etime),
+          uid))
+      return uids[:count]
+
   def __init__(self, total, events, min_anon = 0,
       pseudonyms_per_client = 1, round_time_span = 2.0,
-      start_time = 0, trainer = None, split_size = 1):
+      start_time = 0, trainer = None, split_size = 1, rank_mode = "auto"):
+    # Needed by is_member_online while bootstrapping
+    self.member_online = numpy.zeros(total, dtype=numpy.bool_)
     AnonymitySimulator.__init__(self, total, events, min_anon,
-        pseudonyms_per_client, round_time_span, start_time)
+        pseudonyms_per_client, round_time_span, start_time, rank_mode)
 
     self.group_online = []
     self.split_group = []
     self.splits = {}
     self.join_queue = []
     self.offline_clients = []
+    # Members of offline groups along with offline_clients
+    self.undeliverable = numpy.zeros(total, dtype=numpy.bool_)
     self.split_size = split_size
-    self.member_online = {}
     self.round_keeper = Round_Keeper()
+    self.group0_index = DynamicSplitting.OnlineTimeIndex(self.clients)
+
+  def prepare(self):
+    if self.resumed:
+      return
 
-  def run(self):
     group = []
     for client in self.clients:
       self.member_online[client.uid] = client.get_online()
@@ -521,99 +1207,126 @@ class DynamicSplitting(AnonymitySimulator):
     self.split_group.append(group)
     self.group_online.append(True)
     self.round_keeper.add_group(group[:],group[:])
-    AnonymitySimulator.run(self)
+    self.anonymity_sets.separate(self.offline_clients)
+    self.index_group0()
+    self.update_undeliverable()
+
+  def index_group0(self):
+    """ Rebuilds the online time index of group 0 """
+    self.group0_index = DynamicSplitting.OnlineTimeIndex(self.clients)
+    if len(self.split_group) > 0:
+      for uid in self.split_group[0]:
+        self.group0_index.update(uid)
 
   def is_member_online(self, uid):
     return self.member_online[uid]
+
+  def member_offline_mask(self):
+    return ~self.member_online
     
-  def process_events(self, events):
-    events.reverse()
-    delayed_msgs =[]
-    unsent_msgs = []
-    next_time = self.round_time_span
-
-    while len(events) > 0:
-         
-      # Move us to the period during the next event
-      current_time = next_time
-      next_time = events[-1][0] + self.round_time_span - (events[-1][0] % self.round_time_span)
-      rounds = (next_time - current_time) / self.round_time_span
-
-      if rounds > 1:
-        for nym in self.pseudonyms:
-          for cuid in nym.client_rank.keys():
-            if not self.is_member_online(cuid):
-              nym.client_rank[cuid] += rounds - 1
-              if not self.clients[cuid].get_online():
-                nym.client_subrank[cuid] += rounds - 1
-      
-      
-      quit = {}
-      join_event = False
-
-      delayed_msgs = self.round_keeper.get_all_round_messages()
-
-      while len(events) > 0 and events[-1][0] < next_time:
-        event = events.pop()
-        if event[1] == "join":
-          if event[2] in quit:
-            del quit[event[2]]
-            continue
-          self.on_join(event[0], event[2])
-        elif event[1] == "msg":
-          uid = event[2][0]
-          if uid in self.splits:
-            gid = self.splits[uid]
-            self.round_keeper.add_message_to_group(gid,uid,event)
-          else:
-            self.round_keeper.add_message_from_offline_user(event)
-        elif event[1] == "quit":
-          quit[event[2]] = event[0]
-        else:
-          assert(False)
-
-      delivered = {}
-      for gid in range(len(self.split_group)):
-        if self.group_online[gid]:
-          for message in self.round_keeper.get_messages_for_group(gid)[:]:
-             if self.on_msg(message[0],message[2]):
-                self.round_keeper.remove_message_from_group(message,gid)
-                delivered[message[2][0]] = True
-                if message not in delayed_msgs:
-                  self.on_time += 1
-                else:
-                  msg_time = message[0] + self.round_time_span - \
-                                    (message[0] % self.round_time_span)
-                  self.delayed_times.append(next_time - msg_time)
-          self.round_keeper.end_group_round(gid)
-          self.group_online[gid] = \
-                self.round_keeper.get_num_online_members_for_group(gid) \
-                                         == len(self.split_group[gid])
-          if not self.group_online[gid]:
-            assert (gid != 0)
-        else:
-          self.round_keeper.end_global_round_for_group(gid)
- 
-      for nym in self.pseudonyms:
-        if nym.uid in delivered:
-          continue
-        for cuid in nym.client_rank.keys():
-          if not self.is_member_online(cuid):
-            nym.client_rank[cuid] += 1
-            if not self.clients[cuid].get_online():
-              nym.client_subrank[cuid] += 1
+  def start_round(self, round_time, delta):
+    self.track_batch(delta.batch)
+       
+    # Move us to the period during the next event
+    current_time = self.next_time
+    next_time = round_time
+    rounds = (next_time - current_time) / self.round_time_span
 
+    if rounds > 1:
+      self.update_ranks(rounds - 1)
+    
+    
+    self.round_keeper.start_round()
 
-      for uid, etime in quit.items():
-        self.on_quit(etime, uid)
+    # A join can form a group, which routes the messages after it
+    for event in delta.events:
+      if event[1] == "join":
+        self.on_join(event[0], event[2])
+      else:
+        uid = event[2][0]
+        if uid in self.splits:
+          gid = self.splits[uid]
+          self.round_keeper.add_message_to_group(gid,uid,event)
+        else:
+          self.round_keeper.add_message_from_offline_user(event)
+
+    delivered = {}
+    for gid in range(len(self.split_group)):
+      if self.group_online[gid]:
+        for msg_id, message in \
+              self.round_keeper.get_indexed_messages_for_group(gid):
+           if self.on_msg(message[0],message[2]):
+              self.round_keeper.remove_message_id_from_group(msg_id,gid)
+              delivered[message[2][0]] = True
+              if not self.round_keeper.is_delayed(msg_id):
+                self.on_time += 1
+              else:
+                msg_time = message[0] + self.round_time_span - \
+                                  (message[0] % self.round_time_span)
+                self.record_delay(next_time - msg_time, msg_time)
+        self.round_keeper.end_group_round(gid)
+        self.set_group_online(gid,
+              self.round_keeper.get_num_online_members_for_group(gid) \
+                                       == len(self.split_group[gid]))
+        if not self.group_online[gid]:
+          assert (gid != 0)
+      else:
+        self.round_keeper.end_global_round_for_group(gid)
+ 
+    self.update_ranks(1, delivered)
 
+  def finish(self):
     # No more join / quit events and there are still message posting events
     # add these to lost messages and break
     self.lost_messages = self.round_keeper.get_all_messages()
+
+  def config(self):
+    return AnonymitySimulator.config(self) + (self.split_size, )
+
+  def pending_messages(self):
+    return self.round_keeper.get_all_messages()
+
+  def queued_messages(self):
+    return self.round_keeper.get_num_messages()
+
+  def get_state(self, index):
+    state = AnonymitySimulator.get_state(self, index)
+    uids = sorted(self.splits.keys())
+    state.update({
+        "member_online" : self.member_online,
+        "group_online" : numpy.array(self.group_online, dtype=numpy.bool_),
+        "split_uids" : numpy.array(uids, dtype=numpy.int64),
+        "split_gids" : numpy.array([self.splits[uid] for uid in uids],
+            dtype=numpy.int64),
+        "join_queue" : numpy.array(self.join_queue, dtype=numpy.int64),
+        "offline_clients" : numpy.array(self.offline_clients,
+            dtype=numpy.int64),
+        })
+    state["split_group"], state["split_group_offsets"] = \
+        pack_lists(self.split_group)
+    for name, value in self.round_keeper.get_state(index).items():
+      state["keeper_" + name] = value
+    return state
+
+  def set_state(self, state, messages):
+    AnonymitySimulator.set_state(self, state, messages)
+    self.member_online[:] = state["member_online"]
+    self.group_online = state["group_online"].tolist()
+    self.splits = dict(zip(state["split_uids"].tolist(),
+        state["split_gids"].tolist()))
+    self.join_queue = state["join_queue"].tolist()
+    self.offline_clients = state["offline_clients"].tolist()
+    self.split_group = unpack_lists(state["split_group"],
+        state["split_group_offsets"])
+    self.index_group0()
+    self.update_undeliverable()
+    self.round_keeper.set_state(dict((name[len("keeper_"):], value) \
+        for name, value in state.items() if name.startswith("keeper_")),
+        messages)
     
   def on_join(self, etime, uid):
     """ Handler for the client join event """
-    self.clients[uid].set_online(etime)
+    AnonymitySimulator.on_join(self, etime, uid)
     
     if uid not in self.splits:
       if uid not in self.join_queue:
@@ -628,45 +1341,58 @@ class DynamicSplitting(AnonymitySimulator):
           group.append(g_uid)
         self.split_group.append(group)
         self.group_online.append(True)
+        self.anonymity_sets.separate(group)
+        self.undeliverable[group] = False
         self.round_keeper.add_group(group[:],group[:])
         self.join_queue = []
         "some clients came online and I made them a group!"
     else:
       group_idx = self.splits[uid]
+      if group_idx == 0:
+        self.group0_index.update(uid)
       self.round_keeper.add_online_member_to_group(uid,group_idx)
       if self.round_keeper.get_num_round_members_for_group(group_idx) == \
                 len(self.split_group[group_idx]):
-        self.group_online[group_idx] = True
+        self.set_group_online(group_idx, True)
 
   def on_quit(self, etime, uid):
     """ Handler for the client quit event """
-    self.clients[uid].set_offline(etime)
+    AnonymitySimulator.on_quit(self, etime, uid)
 
     if uid not in self.splits:
       # Dynamic splitting bootstrapping code
       assert (uid in self.join_queue)
       self.join_queue.remove(uid)
     elif self.splits[uid] == 0:
-      clients = []
-      for client in self.clients:
-        if client.uid in self.splits  and  self.splits[client.uid] == 0 \
-                and client.uid != uid:
-          clients.append(client)
+      self.group0_index.remove(uid)
+      remaining = len(self.group0_index)
+      count = self.split_size - 1 if (2 * self.split_size - 1 < remaining) \
+            else remaining
+
+      if etime != 0:
+        companions = self.group0_index.smallest(count, etime)
+      else:
+        # get_online_time ignores the current session at time 0
+        clients = [client for client in self.clients \
+            if self.splits.get(client.uid) == 0 and client.uid != uid]
+        clients.sort(key=lambda client: client.get_online_time(etime))
+        companions = [client.uid for client in clients[:count]]
 
-      clients.sort(key=lambda client: client.get_online_time(etime))
       group_idx = len(self.split_group)
       self.splits[uid] = group_idx
       group = [uid]
-
-      count = self.split_size - 1 if (2 * self.split_size - 1 < len(clients)) \
-            else len (clients)
       
-      for idx in range(count):
-        self.splits[clients[idx].uid] = group_idx
-        group.append(clients[idx].uid)
+      for c_uid in companions:
+        self.splits[c_uid] = group_idx
+        self.group0_index.remove(c_uid)
+        group.append(c_uid)
       self.split_group.append(group)
-      self.split_group[0] = [i for i in self.split_group[0] if i not in group]
+      members = set(group)
+      self.split_group[0] = [i for i in self.split_group[0] \
+            if i not in members]
       self.group_online.append(False)
+      self.anonymity_sets.separate(group)
+      self.undeliverable[group] = True
       self.round_keeper.add_group(group[:],filter(self.is_member_online,group))
        
       for idx in group:
@@ -687,20 +1413,8 @@ class DynamicSplitting(AnonymitySimulator):
 
     before = len(self.pseudonyms[uid].clients)
     before_group = self.pseudonyms[uid].clients
-    group_idx = 0
-    # Remove offline groups
-    for online in self.group_online:
-      if not online:
-        for g_uid in self.split_group[group_idx]:
-          self.clients[g_uid].remove_nym(uid)
-          self.pseudonyms[uid].remove_client(g_uid)
-      group_idx += 1
-
-    # Remove non-bootstrapped clients
-    for client in self.offline_clients:
-      self.clients[client].remove_nym(uid)
-      self.pseudonyms[uid].remove_client(client)
-    
+    # Remove offline groups and non-bootstrapped clients
+    self.anonymity_sets.remove_mask(uid, self.undeliverable)
 
     after = len(self.pseudonyms[uid].clients)
     group_idx = self.splits[uid]
@@ -719,17 +1433,30 @@ class DynamicSplitting(AnonymitySimulator):
     return True
 
   def check_min_anon(self, uid):
-    clients_offline = 0
-    for client in self.clients:
-      if (client in self.splits and not self.is_member_group_online(client.uid)) or \
-                   (client not in self.splits):
-        if client.remove_if(uid) < self.min_anon:
-          return False
-        if client.uid in self.pseudonyms[uid].clients:
-          clients_offline += 1
-          if len(self.pseudonyms[uid].clients) - clients_offline < self.min_anon:
-            return False
-    return True
+    # splits is keyed by uid, not by client, so every client is treated as
+    # offline: this fails once any client would drop below min_anon or
+    # once the nym's whole anonymity set is counted as offline
+    if self.min_anon <= 0:
+      return True
+    sets = self.anonymity_sets
+    if numpy.any(sets.client_sizes - sets.members[uid] < self.min_anon):
+      return False
+    return sets.pseudonym_sizes[uid] == 0
+
+  def set_group_online(self, gid, online):
+    """ Updates a group's online state and the undeliverable mask """
+    self.group_online[gid] = online
+    self.undeliverable[self.split_group[gid]] = not online
+
+  def update_undeliverable(self):
+    """ Rebuilds the mask of clients removed from the anonymity set of every
+    delivered message: members of offline groups and clients that are not
+    part of a group yet """
+    self.undeliverable[:] = False
+    for gid in range(len(self.split_group)):
+      if not self.group_online[gid]:
+        self.undeliverable[self.split_group[gid]] = True
+    self.undeliverable[self.offline_clients] = True
     
   def is_member_group_online(self,uid):
       if uid not in self.splits:
@@ -744,15 +1471,18 @@ class StaticSplitting(DynamicSplitting):
   def __init__(self, total, events, min_anon = 0,
       pseudonyms_per_client = 1, round_time_span = 2.0,
       start_time = 0, trainer = None,
-      split_size = 1):
+      split_size = 1, rank_mode = "auto"):
 
     DynamicSplitting.__init__(self, total, events, min_anon,
         pseudonyms_per_client, round_time_span,
-        start_time, None, split_size)
+        start_time, None, split_size, rank_mode)
 
     self.trainer = trainer
 
-  def run(self):
+  def prepare(self):
+    if self.resumed:
+      return
+
     if self.trainer == "rank":
       splitting_order = self.rank_trainer()
     elif self.trainer == "join":
@@ -760,14 +1490,20 @@ class StaticSplitting(DynamicSplitting):
     else:
       splitting_order = self.random_trainer()
 
-    groups = len(splitting_order) / self.split_size
+    groups = max(len(splitting_order) / self.split_size, 1)
     remaining = len(splitting_order) % self.split_size
     split_size = self.split_size + remaining / groups
     remaining = remaining % groups
 
+    # Group 0 is where the dynamic policy keeps the clients it has not split
+    # yet, here it stays empty and every client is in a group of its own
+    self.split_group.append([])
+    self.group_online.append(True)
+    self.round_keeper.add_group([], [])
+
     count = 0
     group = []
-    group_idx = 0
+    group_idx = 1
     online = True
 
     for uid in splitting_order:
@@ -782,12 +1518,18 @@ class StaticSplitting(DynamicSplitting):
         else:
           self.split_group.append(group)
           self.group_online.append(online)
+          # Members are online as a group, as the group rank mode needs
+          self.member_online[group] = online
+          self.anonymity_sets.separate(group)
+          self.round_keeper.add_group(group[:],
+              [member for member in group if self.clients[member].get_online()])
           group_idx += 1
           count = 0
           group = []
           online = True
 
-    AnonymitySimulator.run(self)
+    self.index_group0()
+    self.update_undeliverable()
 
   def rank_trainer(self):
     clients = list(self.clients)
@@ -817,7 +1559,7 @@ class CoinFlip(AnonymitySimulator):
     AnonymitySimulator.__init__(total, events, min_anon,
         pseudonyms_per_client, round_time_span, start_time)
 
-  def run(self):
+  def prepare(self):
     uids = []
     for client in self.clients:
       if not client.get_online():
@@ -827,11 +1569,9 @@ class CoinFlip(AnonymitySimulator):
       if client.get_online():
         client.flip_coins(uids, 1.0 / float(len(self.clients)))
 
-    AnonymitySimulator.run(self)
-
   def on_join(self, etime, uid):
     """ Handler for the client join event """
-    self.clients[uid].set_online(etime)
+    AnonymitySimulator.on_join(self, etime, uid)
 
     if self.policy == self.coin_flip:
       for client in self.clients:
@@ -842,7 +1582,7 @@ class CoinFlip(AnonymitySimulator):
 
   def on_quit(self, etime, uid):
     """ Handler for the client quit event """
-    self.clients[uid].set_offline(etime)
+    AnonymitySimulator.on_quit(self, etime, uid)
 
     if self.policy == self.coin_flip:
       for client in self.clients:
@@ -854,7 +1594,7 @@ class CoinFlip(AnonymitySimulator):
     for client in self.clients:
       if client.get_online():
         continue
-      assert(pclient.coins[client.uid] != -1)
+      assert(pclient.coins.get(client.uid, -1) != -1)
       if pclient.coins[client.uid]:
         return False
     return self.maintain_min_anon(etime, uid, msg)
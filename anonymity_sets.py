@@ -0,0 +1,374 @@
+#!/usr/bin/python2
+
+"""
+Compact anonymity sets for the AnonymitySimulator
+
+Membership of every client in every pseudonym's anonymity set is kept in a
+single pseudonym x client boolean matrix.  A pseudonym's anonymity set is a
+row, a client's set of possible pseudonyms is a column, so removing all
+offline clients from a pseudonym is a single AND-NOT against an offline mask.
+
+The offline mask is kept here as well along with, for every pseudonym, the
+number of its members that are offline and the number of offline members that
+sit exactly at the minimum anonymity.  Checking whether a pseudonym may
+deliver a message is then a constant time comparison.
+
+GroupAnonymitySets keeps the same sets for the splitting policies, whose
+group members always share their memberships, with one column per group
+instead of one per client.
+"""
+
+import numpy
+
+class AnonymitySets:
+  """ Pseudonym x client membership matrix along with the current size of
+  each pseudonym's and each client's anonymity set """
+  def __init__(self, total_pseudonyms, total_clients, min_anon = 0):
+    self.members = numpy.ones((total_pseudonyms, total_clients),
+        dtype=numpy.bool_)
+    self.pseudonym_sizes = numpy.empty(total_pseudonyms, dtype=numpy.int64)
+    self.pseudonym_sizes.fill(total_clients)
+    self.client_sizes = numpy.empty(total_clients, dtype=numpy.int64)
+    self.client_sizes.fill(total_pseudonyms)
+    # Objects with a removed(nym, cuids) method notified on every removal
+    self.listeners = []
+
+    # Clients start offline until their first join
+    self.offline = numpy.ones(total_clients, dtype=numpy.bool_)
+    self.offline_members = self.pseudonym_sizes.copy()
+
+    # Offline clients with fewer than min_anon nyms (starved) and with
+    # exactly min_anon nyms (edge), along with the number of edge clients in
+    # each nym's anonymity set
+    self.min_anon = min_anon
+    self.starved = numpy.zeros(total_clients, dtype=numpy.bool_)
+    self.starved_count = 0
+    self.edge = numpy.zeros(total_clients, dtype=numpy.bool_)
+    self.edge_members = numpy.zeros(total_pseudonyms, dtype=numpy.int64)
+    self.update_min_anon(numpy.arange(total_clients))
+
+  def set_online(self, cuid, online):
+    """ Update the offline state of a client """
+    if self.offline[cuid] != online:
+      return
+    self.offline[cuid] = not online
+    if online:
+      self.offline_members -= self.members[:, cuid]
+    else:
+      self.offline_members += self.members[:, cuid]
+    self.update_min_anon([cuid])
+
+  def check_min_anon(self, nym):
+    """ Returns True if removing every offline client from the nym's
+    anonymity set leaves both the nym and all offline clients with at least
+    min_anon members """
+    if self.min_anon <= 0:
+      return True
+    if self.starved_count > 0 or self.edge_members[nym] > 0:
+      return False
+    offline = self.offline_members[nym]
+    return offline == 0 or \
+        self.pseudonym_sizes[nym] - offline >= self.min_anon
+
+  def update_min_anon(self, cuids):
+    """ Re-evaluates the starved and edge state of the clients in cuids """
+    if self.min_anon <= 0:
+      return
+    cuids = numpy.asarray(cuids)
+    offline = self.offline[cuids]
+    sizes = self.client_sizes[cuids]
+    starved = offline & (sizes < self.min_anon)
+    edge = offline & (sizes == self.min_anon)
+    self.starved_count += int(numpy.count_nonzero(starved)) - \
+        int(numpy.count_nonzero(self.starved[cuids]))
+    self.starved[cuids] = starved
+
+    was_edge = self.edge[cuids]
+    leaving = cuids[was_edge & ~edge]
+    entering = cuids[~was_edge & edge]
+    if len(leaving) > 0:
+      self.edge_members -= self.members[:, leaving].sum(axis=1)
+    if len(entering) > 0:
+      self.edge_members += self.members[:, entering].sum(axis=1)
+    self.edge[cuids] = edge
+
+  def remove(self, nym, cuid):
+    """ Remove a single client from a nym's anonymity set, returns True if
+    the client was a member """
+    if not self.members[nym, cuid]:
+      return False
+    if self.edge[cuid]:
+      self.edge_members[nym] -= 1
+    if self.offline[cuid]:
+      self.offline_members[nym] -= 1
+    self.members[nym, cuid] = False
+    self.pseudonym_sizes[nym] -= 1
+    self.client_sizes[cuid] -= 1
+    self.update_min_anon([cuid])
+    for listener in self.listeners:
+      listener.removed(nym, [cuid])
+    return True
+
+  def remove_offline(self, nym):
+    """ Remove every offline client from the nym's anonymity set, returns
+    the uids of the clients that were removed """
+    if self.offline_members[nym] == 0:
+      return numpy.empty(0, dtype=numpy.int64)
+    return self.remove_mask(nym, self.offline)
+
+  def remove_mask(self, nym, mask):
+    """ Remove every client set in mask from the nym's anonymity set,
+    returns the uids of the clients that were removed """
+    row = self.members[nym]
+    removed = numpy.flatnonzero(row & mask)
+    if len(removed) > 0:
+      self.edge_members[nym] -= numpy.count_nonzero(self.edge[removed])
+      self.offline_members[nym] -= numpy.count_nonzero(self.offline[removed])
+      row &= ~mask
+      self.pseudonym_sizes[nym] -= len(removed)
+      self.client_sizes[removed] -= 1
+      self.update_min_anon(removed)
+      for listener in self.listeners:
+        listener.removed(nym, removed)
+    return removed
+
+  def separate(self, cuids):
+    """ Every client has a column of its own already """
+    pass
+
+  def get_state(self):
+    """ The state of the sets as a dict of arrays for checkpointing """
+    return {
+        "members" : numpy.packbits(self.members, axis=1),
+        "pseudonym_sizes" : self.pseudonym_sizes,
+        "client_sizes" : self.client_sizes,
+        "offline" : self.offline,
+        "offline_members" : self.offline_members,
+        "starved" : self.starved,
+        "starved_count" : numpy.array(self.starved_count),
+        "edge" : self.edge,
+        "edge_members" : self.edge_members,
+        }
+
+  def set_state(self, state):
+    """ Restores the state returned by get_state, in place so that views
+    and masks handed out remain valid """
+    total_clients = len(self.client_sizes)
+    self.members[:] = numpy.unpackbits(state["members"],
+        axis=1)[:, :total_clients]
+    self.pseudonym_sizes[:] = state["pseudonym_sizes"]
+    self.client_sizes[:] = state["client_sizes"]
+    self.offline[:] = state["offline"]
+    self.offline_members[:] = state["offline_members"]
+    self.starved[:] = state["starved"]
+    self.starved_count = int(state["starved_count"])
+    self.edge[:] = state["edge"]
+    self.edge_members[:] = state["edge_members"]
+
+  def pseudonym_view(self, nym):
+    return AnonymitySets.PseudonymView(self, nym)
+
+  def client_view(self, cuid):
+    return AnonymitySets.ClientView(self, cuid)
+
+  class PseudonymView:
+    """ Read-only, dict-like view of the clients in a nym's anonymity set """
+    def __init__(self, sets, nym):
+      self.sets = sets
+      self.nym = nym
+
+    def __contains__(self, cuid):
+      if cuid < 0 or cuid >= len(self.sets.client_sizes):
+        return False
+      return bool(self.sets.members[self.nym, cuid])
+
+    def __len__(self):
+      return int(self.sets.pseudonym_sizes[self.nym])
+
+    def __iter__(self):
+      return iter(self.keys())
+
+    def __getitem__(self, cuid):
+      if cuid not in self:
+        raise KeyError(cuid)
+      return True
+
+    def keys(self):
+      return numpy.flatnonzero(self.sets.members[self.nym]).tolist()
+
+    def __repr__(self):
+      return repr(self.keys())
+
+  class ClientView:
+    """ Read-only, dict-like view of the nyms in a client's anonymity set """
+    def __init__(self, sets, cuid):
+      self.sets = sets
+      self.cuid = cuid
+
+    def __contains__(self, nym):
+      if nym < 0 or nym >= len(self.sets.pseudonym_sizes):
+        return False
+      return bool(self.sets.members[nym, self.cuid])
+
+    def __len__(self):
+      return int(self.sets.client_sizes[self.cuid])
+
+    def __iter__(self):
+      return iter(self.keys())
+
+    def __getitem__(self, nym):
+      if nym not in self:
+        raise KeyError(nym)
+      return True
+
+    def keys(self):
+      return numpy.flatnonzero(self.sets.members[:, self.cuid]).tolist()
+
+    def __repr__(self):
+      return repr(self.keys())
+
+class GroupAnonymitySets:
+  """ Anonymity sets of clients grouped into columns, the clients of a
+  column sharing every membership.  All clients start in a single column,
+  separate() moves clients into a column of their own, a copy of the one
+  they leave, so the pseudonym x column matrix only grows with the number
+  of groups.  Masks handed to remove_mask (and the rank engine) are indexed
+  by client but must be the same for every client of a column.
+
+  members and client_sizes are expanded to clients when read, the views of
+  AnonymitySets work on top of them. """
+  def __init__(self, total_pseudonyms, total_clients, min_anon = 0):
+    capacity = 16
+    self.group_members = numpy.ones((total_pseudonyms, capacity),
+        dtype=numpy.bool_)
+    self.columns = 1
+    self.column = numpy.zeros(total_clients, dtype=numpy.int64)
+    self.weights = numpy.zeros(capacity, dtype=numpy.int64)
+    self.weights[0] = total_clients
+    self.column_sizes = numpy.zeros(capacity, dtype=numpy.int64)
+    self.column_sizes[0] = total_pseudonyms
+    # A client of every column, to read masks by column
+    self.representative = numpy.zeros(capacity, dtype=numpy.int64)
+    self.pseudonym_sizes = numpy.empty(total_pseudonyms, dtype=numpy.int64)
+    self.pseudonym_sizes.fill(total_clients)
+    self.offline = numpy.ones(total_clients, dtype=numpy.bool_)
+    self.min_anon = min_anon
+    # Objects with removed(nym, columns) and separated(src, dst, cuids)
+    # methods notified on every change
+    self.listeners = []
+    self.members = GroupAnonymitySets.Members(self)
+
+  @property
+  def client_sizes(self):
+    return self.column_sizes[self.column]
+
+  def set_online(self, cuid, online):
+    """ Update the offline state of a client """
+    self.offline[cuid] = not online
+
+  def separate(self, cuids):
+    """ Moves the clients in cuids out of the columns they share with
+    other clients """
+    cuids = numpy.asarray(cuids, dtype=numpy.int64)
+    if len(cuids) == 0:
+      return
+    sources = self.column[cuids]
+    for src in numpy.unique(sources).tolist():
+      moving = cuids[sources == src]
+      if len(moving) == self.weights[src]:
+        continue
+      dst = self.new_column()
+      self.group_members[:, dst] = self.group_members[:, src]
+      self.column_sizes[dst] = self.column_sizes[src]
+      self.weights[src] -= len(moving)
+      self.weights[dst] = len(moving)
+      self.column[moving] = dst
+      self.representative[dst] = moving[0]
+      if self.column[self.representative[src]] != src:
+        self.representative[src] = numpy.flatnonzero(self.column == src)[0]
+      for listener in self.listeners:
+        listener.separated(src, dst, moving)
+
+  def new_column(self):
+    if self.columns == len(self.weights):
+      self.grow(2 * self.columns)
+    self.columns += 1
+    return self.columns - 1
+
+  def grow(self, capacity):
+    """ Makes room for capacity columns """
+    columns = self.columns
+    group_members = numpy.empty((len(self.pseudonym_sizes), capacity),
+        dtype=numpy.bool_)
+    group_members[:, :columns] = self.group_members[:, :columns]
+    self.group_members = group_members
+    for name in ["weights", "column_sizes", "representative"]:
+      values = numpy.zeros(capacity, dtype=numpy.int64)
+      values[:columns] = getattr(self, name)[:columns]
+      setattr(self, name, values)
+
+  def remove_mask(self, nym, mask):
+    """ Remove every client set in mask from the nym's anonymity set,
+    returns the columns that were removed """
+    columns = self.columns
+    row = self.group_members[nym, :columns]
+    removed = numpy.flatnonzero(row & mask[self.representative[:columns]])
+    if len(removed) > 0:
+      row[removed] = False
+      self.pseudonym_sizes[nym] -= self.weights[removed].sum()
+      self.column_sizes[removed] -= 1
+      for listener in self.listeners:
+        listener.removed(nym, removed)
+    return removed
+
+  def get_state(self):
+    """ The state of the sets as a dict of arrays for checkpointing """
+    columns = self.columns
+    return {
+        "group_members" : numpy.packbits(self.group_members[:, :columns],
+            axis=1),
+        "column" : self.column,
+        "weights" : self.weights[:columns],
+        "column_sizes" : self.column_sizes[:columns],
+        "representative" : self.representative[:columns],
+        "pseudonym_sizes" : self.pseudonym_sizes,
+        "offline" : self.offline,
+        }
+
+  def set_state(self, state):
+    """ Restores the state returned by get_state, the offline mask in place
+    so that it remains valid """
+    columns = len(state["weights"])
+    if len(self.weights) < columns:
+      self.grow(columns)
+    self.columns = columns
+    self.group_members[:, :columns] = numpy.unpackbits(state["group_members"],
+        axis=1)[:, :columns]
+    for name in ["weights", "column_sizes", "representative"]:
+      getattr(self, name)[:columns] = state[name]
+    self.column[:] = state["column"]
+    self.pseudonym_sizes[:] = state["pseudonym_sizes"]
+    self.offline[:] = state["offline"]
+
+  def pseudonym_view(self, nym):
+    return AnonymitySets.PseudonymView(self, nym)
+
+  def client_view(self, cuid):
+    return AnonymitySets.ClientView(self, cuid)
+
+  class Members:
+    """ Read-only pseudonym x client membership, indexed like
+    AnonymitySets.members """
+    def __init__(self, sets):
+      self.sets = sets
+
+    @property
+    def shape(self):
+      return (len(self.sets.pseudonym_sizes), len(self.sets.column))
+
+    def __getitem__(self, key):
+      sets = self.sets
+      if isinstance(key, tuple):
+        nyms, cuids = key
+        return sets.group_members[nyms][..., sets.column[cuids]]
+      return sets.group_members[key][..., sets.column]
@@ -0,0 +1,220 @@
+#!/usr/bin/python2
+
+"""
+De-anonymization attack against the ranks left behind by the
+AnonymitySimulator
+
+Every pseudonym whose anonymity set shrank is attacked.  Its top suspect is
+the member of its anonymity set with the highest client_rank (its own client
+on a tie).  Collisions, where several pseudonyms suspect the same client, are
+then resolved by one of:
+  greedy - the pseudonym with the strictly higher rank keeps the client, the
+    others fall back to their next lower rank, processed from a heap
+  optimal - an assignment of pseudonyms to distinct clients maximizing the
+    total rank (Hungarian algorithm, O(P^2 x N))
+"""
+
+import heapq
+import numpy
+
+METHODS = ["greedy", "optimal"]
+
+def attack(anon_sim, method = "greedy"):
+  """ Runs the attack against a finished simulation """
+  total_clients = len(anon_sim.clients)
+  nyms = [nym.uid for nym in anon_sim.pseudonyms \
+      if len(nym.clients) != total_clients]
+  ranks = anon_sim.ranks.rank_rows(nyms)
+  members = anon_sim.anonymity_sets.members[nyms]
+  return AttackAnalysis(nyms, ranks, members, method)
+
+class AttackAnalysis:
+  """ Attack over the rank rows of the attacked pseudonyms, ranks and
+  members are len(pseudonyms) x clients arrays.  Per pseudonym results are
+  arrays aligned with pseudonyms. """
+  def __init__(self, pseudonyms, ranks, members, method = "greedy"):
+    self.pseudonyms = numpy.asarray(pseudonyms, dtype=numpy.int64)
+    self.method = method
+    count = len(self.pseudonyms)
+
+    self.top_client = numpy.zeros(count, dtype=numpy.int64)
+    self.top_rank = numpy.zeros(count)
+    self.own_rank = numpy.zeros(count)
+    self.rank_position = numpy.zeros(count, dtype=numpy.int64)
+    self.same = numpy.zeros(count, dtype=numpy.int64)
+    self.near = numpy.zeros(count, dtype=numpy.int64)
+    self.probability = numpy.zeros(count)
+    self.candidates = []
+
+    for idx in range(count):
+      self.rank_row(idx, ranks[idx], members[idx])
+
+    if method == "greedy":
+      self.assignment = self.greedy()
+    elif method == "optimal":
+      self.assignment = self.optimal(ranks, members)
+    else:
+      raise ValueError("Unknown attack method: %s" % (method, ))
+
+  def rank_row(self, idx, ranks, members):
+    """ Evaluates a single pseudonym against its own client """
+    uid = self.pseudonyms[idx]
+    cuids = numpy.flatnonzero(members)
+    values = ranks[cuids]
+    own_member = uid < len(members) and members[uid]
+    own_value = ranks[uid] if own_member else 0.0
+
+    top = uid
+    top_value = own_value
+    if len(values) > 0 and (not own_member or values.max() > own_value):
+      top = cuids[values.argmax()]
+      top_value = values.max()
+
+    self.top_client[idx] = top
+    self.top_rank[idx] = top_value
+    self.own_rank[idx] = own_value
+    self.rank_position[idx] = numpy.count_nonzero(values > own_value)
+    self.same[idx] = numpy.count_nonzero(values == own_value)
+    self.near[idx] = numpy.count_nonzero((values > own_value * 0.9) & \
+        (values < own_value * 1.1))
+    accumulated = values.sum()
+    if accumulated == 0:
+      self.probability[idx] = 1.0 / len(values) if len(values) > 0 else 0.0
+    else:
+      self.probability[idx] = own_value / accumulated
+
+    # Fallback suspects, highest rank first and lowest uid among equals
+    order = numpy.lexsort((cuids, -values))
+    self.candidates.append((-values[order], cuids[order]))
+
+  def next_candidate(self, idx, value):
+    """ The first suspect with a rank strictly below value (and above 0),
+    returns (-1, 0) if there is none """
+    neg_values, cuids = self.candidates[idx]
+    pos = numpy.searchsorted(neg_values, -value, side="right")
+    if pos >= len(cuids) or neg_values[pos] >= 0:
+      return -1, 0
+    return cuids[pos], -neg_values[pos]
+
+  def greedy(self):
+    """ Each pseudonym proposes to its suspects in descending rank order, a
+    client keeps the proposers with the highest rank and rejects the
+    others.  A rejected pseudonym without a lower suspect keeps its
+    current one. """
+    assignment = self.top_client.copy()
+    holders = {}
+    heap = [(-self.top_rank[idx], idx, self.top_client[idx]) \
+        for idx in range(len(self.pseudonyms))]
+    heapq.heapify(heap)
+
+    while len(heap) > 0:
+      neg_value, idx, cuid = heapq.heappop(heap)
+      value = -neg_value
+      assignment[idx] = cuid
+      best = holders.get(cuid)
+      if best is None or best[0] < value:
+        holders[cuid] = (value, [idx])
+        rejected = best[1] if best is not None else []
+      elif best[0] == value:
+        best[1].append(idx)
+        rejected = []
+      else:
+        rejected = [idx]
+
+      for ridx in rejected:
+        next_cuid, next_value = self.next_candidate(ridx, \
+            value if ridx == idx else best[0])
+        if next_cuid != -1:
+          heapq.heappush(heap, (-next_value, ridx, next_cuid))
+    return assignment
+
+  def optimal(self, ranks, members):
+    """ Maximum total rank assignment of pseudonyms to distinct members of
+    their anonymity sets """
+    count, total_clients = ranks.shape
+    if count == 0:
+      return numpy.zeros(0, dtype=numpy.int64)
+    # Clients outside of an anonymity set are never worth picking
+    forbidden = (numpy.abs(ranks).max() + 1) * (count + 1)
+    cost = numpy.where(members, -ranks, forbidden)
+    return linear_assignment(cost)
+
+  def found(self):
+    """ Pseudonyms assigned to their own client """
+    return int(numpy.count_nonzero(self.assignment == self.pseudonyms))
+
+  def found_top(self):
+    """ Pseudonyms whose top suspect is their own client """
+    return int(numpy.count_nonzero(self.top_client == self.pseudonyms))
+
+  def summary(self):
+    return {
+        "attacked" : len(self.pseudonyms),
+        "method" : self.method,
+        "found_top" : self.found_top(),
+        "found" : self.found(),
+        "not_found" : len(self.pseudonyms) - self.found(),
+        }
+
+  def results(self):
+    """ Per pseudonym results as a list of dicts """
+    results = []
+    for idx in range(len(self.pseudonyms)):
+      results.append({
+          "pseudonym" : int(self.pseudonyms[idx]),
+          "top_client" : int(self.top_client[idx]),
+          "top_rank" : float(self.top_rank[idx]),
+          "own_rank" : float(self.own_rank[idx]),
+          "rank_position" : int(self.rank_position[idx]),
+          "same" : int(self.same[idx]),
+          "near" : int(self.near[idx]),
+          "probability" : float(self.probability[idx]),
+          "assigned" : int(self.assignment[idx]),
+          })
+    return results
+
+def linear_assignment(cost):
+  """ Minimum cost assignment of every row to a distinct column for a
+  rows <= columns cost matrix, returns the column of each row """
+  rows, columns = cost.shape
+  assert(rows <= columns)
+  # 1-indexed potentials and matching as in the classic formulation, column
+  # 0 is a virtual column
+  u = numpy.zeros(rows + 1)
+  v = numpy.zeros(columns + 1)
+  match = numpy.zeros(columns + 1, dtype=numpy.int64)
+  way = numpy.zeros(columns + 1, dtype=numpy.int64)
+
+  for row in range(1, rows + 1):
+    match[0] = row
+    col0 = 0
+    minv = numpy.empty(columns + 1)
+    minv.fill(numpy.inf)
+    used = numpy.zeros(columns + 1, dtype=numpy.bool_)
+    while True:
+      used[col0] = True
+      row0 = match[col0]
+      reduced = cost[row0 - 1] - u[row0] - v[1:]
+      free = ~used[1:]
+      better = free & (reduced < minv[1:])
+      minv[1:][better] = reduced[better]
+      way[1:][better] = col0
+      candidates = numpy.where(free, minv[1:], numpy.inf)
+      col1 = int(candidates.argmin()) + 1
+      delta = candidates[col1 - 1]
+      u[match[used]] += delta
+      v[used] -= delta
+      minv[1:][free] -= delta
+      col0 = col1
+      if match[col0] == 0:
+        break
+    while col0 != 0:
+      col1 = way[col0]
+      match[col0] = match[col1]
+      col0 = col1
+
+  assignment = numpy.zeros(rows, dtype=numpy.int64)
+  for col in range(1, columns + 1):
+    if match[col] != 0:
+      assignment[match[col] - 1] = col - 1
+  return assignment
@@ -0,0 +1,179 @@
+#!/usr/bin/python2
+
+"""
+Batch simulation of every channel in an irc_parse.py output directory
+
+Channels are simulated in parallel worker processes, largest first so that
+the biggest channels do not end up running alone at the end.  Channels with
+too few users or messages are skipped before they are simulated.  The counts
+come straight from the header of columnar data sets, but pickled ones are
+read whole by the light first pass of DefaultParse to count them, so for
+those the --min_users and --min_messages thresholds only save the
+simulation.  Convert a crawl with columnar_dataset.py to skip channels
+without reading them.
+
+python2 batch.py [--policy=min_anon] [--min_users=0] [--min_messages=0]
+                 [--processes=0] [--output=batch.tsv] crawl.data_data
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+import anon_sim
+from delays import DelayStats, write_hours
+from ranks import RANK_MODES
+
+COLUMNS = ["channel", "users", "messages", "delivered", "delayed", "lost",
+    "avg_delay", "std_delay", "p50_delay", "p90_delay", "p99_delay",
+    "max_delay", "run_time", "status"]
+
+def main():
+  parser = argparse.ArgumentParser(description="Runs the AnonymitySimulator "
+      "over every channel of a parsed crawl")
+  parser.add_argument("directory", help="directory of channel data sets")
+  parser.add_argument("-p", "--pseudonyms_per_client", type=int, default=1,
+      help="the number of pseudonyms per client (default: 1)")
+  parser.add_argument("-m", "--min_anon", type=int, default=0,
+      help="minimum value for the anonymity meter, (default: 0)")
+  parser.add_argument("-r", "--round_time_span", type=float, default=2.0,
+      help="specifies the duration of a round in seconds (default: 2.0)")
+  parser.add_argument("-s", "--start", type=float, default=0.0,
+      help="specifies the region between bootstrapping and evaluation "
+      "(default: 0)")
+  parser.add_argument("-e", "--end", type=float, default=-1,
+      help="specifies the end time for evaluation (default: all / -1)")
+  parser.add_argument("-t", "--trainer", default=None,
+      help="specifies a trainer for the anonymity data for static splitting "
+      "groups: join, rank, or random (default: None)")
+  parser.add_argument("-x", "--policy", default="min_anon",
+      help="specifies the policy for the simulator: "
+      "min_anon, split (default: min_anon)")
+  parser.add_argument("-z", "--split_size", type=int, default=1,
+      help="defines the buddy sizes for the splitting algorithm")
+  parser.add_argument("--rank_mode", default="auto", choices=RANK_MODES,
+      help="how ranks are accounted (default: auto)")
+  parser.add_argument("--min_users", type=int, default=0,
+      help="skip channels with fewer users (default: 0)")
+  parser.add_argument("--min_messages", type=int, default=0,
+      help="skip channels with fewer messages (default: 0)")
+  parser.add_argument("-j", "--processes", type=int, default=0,
+      help="worker processes (default: one per cpu / 0)")
+  parser.add_argument("-o", "--output", default="batch.tsv",
+      help="where the per channel report is written (default: batch.tsv)")
+  parser.add_argument("--delay_hours", default=None,
+      help="where the delay statistics of every hour, over all channels, "
+      "are written (default: disabled)")
+  parser.add_argument("-d", "--debug", dest="log_level", action="store_const",
+      const=logging.DEBUG, help="sets the logging level to 'debug'")
+  parser.add_argument("--info", dest="log_level", action="store_const",
+      const=logging.INFO, help="sets the logging level to 'info'")
+  args = parser.parse_args()
+  error = anon_sim.rank_mode_error(args.policy, args.rank_mode)
+  if error is not None:
+    parser.error(error)
+
+  logging.basicConfig(level=args.log_level)
+
+  params = {
+      "min_anon" : args.min_anon,
+      "pseudonyms_per_client" : args.pseudonyms_per_client,
+      "round_time_span" : args.round_time_span,
+      "start_time" : args.start,
+      "trainer" : args.trainer,
+      "split_size" : args.split_size,
+      "rank_mode" : args.rank_mode,
+      }
+  tasks = [(path, args.policy, params, args.end, args.min_users,
+      args.min_messages) for path in channels(args.directory)]
+  results = run_batch(tasks, args.processes)
+  results.sort(key=lambda result: result["channel"])
+  write_report(args.output, results)
+
+  simulated = [r for r in results if r["status"] == "ok"]
+  skipped = [r for r in results if r["status"] == "skipped"]
+  delays = DelayStats()
+  for result in simulated:
+    delays.merge(result["delays"])
+  print "Channels: %s" % (len(results), )
+  print "Simulated channels: %s" % (len(simulated), )
+  print "Skipped channels: %s" % (len(skipped), )
+  print "Failed channels: %s" % \
+      (len(results) - len(simulated) - len(skipped), )
+  print "Delivered messages: %s" % (sum(r["delivered"] for r in simulated), )
+  print "Delayed messages: %s" % (delays.count, )
+  print "Lost messages: %s" % (sum(r["lost"] for r in simulated), )
+  print "Average Delay: %f" % delays.average()
+  print "Standard Deviation of Delays: %f" % delays.std_dev()
+  for name, value in delays.summary()[3:]:
+    print "Delay %s: %f" % (name, value)
+  if args.delay_hours:
+    write_hours(args.delay_hours, delays)
+
+def channels(directory):
+  """ Channel data sets in the directory, largest first """
+  paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+  paths = [path for path in paths if os.path.isfile(path)]
+  paths.sort(key=lambda path: (-os.path.getsize(path), path))
+  return paths
+
+def run_batch(tasks, processes = 0):
+  """ Simulates every channel, in the order of tasks """
+  if processes <= 0:
+    processes = multiprocessing.cpu_count()
+  processes = min(processes, len(tasks))
+  if processes <= 1:
+    return [simulate_channel(task) for task in tasks]
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    # chunksize=1 hands channels out in order, so the largest start first
+    return list(pool.imap_unordered(simulate_channel, tasks, chunksize=1))
+  finally:
+    pool.close()
+    pool.join()
+
+def simulate_channel(task):
+  """ Parses and simulates a single channel """
+  path, policy, params, end, min_users, min_messages = task
+  result = dict((name, "") for name in COLUMNS)
+  result["channel"] = os.path.basename(path)
+  start = time.time()
+  try:
+    msg_parser = anon_sim.DefaultParse(filename=path, end=end)
+    result["users"] = len(msg_parser.users)
+    result["messages"] = msg_parser.messages
+    if result["users"] < min_users or result["messages"] < min_messages:
+      result["status"] = "skipped"
+      return result
+
+    sim = anon_sim.create_simulator(policy, len(msg_parser.users),
+        msg_parser.events(), **params)
+    sim.run()
+    result["delivered"] = sim.on_time
+    result["lost"] = len(sim.lost_messages)
+    # Kept whole so the channels can be merged
+    result["delays"] = sim.delays
+    for name, value in sim.delays.summary():
+      result["delayed" if name == "count" else name + "_delay"] = value
+    result["status"] = "ok"
+  except Exception, e:
+    logging.debug(traceback.format_exc())
+    result["status"] = ("%s: %s" % (type(e).__name__, e)).replace("\t", " ")
+  finally:
+    result["run_time"] = time.time() - start
+  logging.info("Finished %s in %fs" % (result["channel"], result["run_time"]))
+  return result
+
+def write_report(filename, results):
+  """ Writes one tab separated row per channel """
+  output = open(filename, "w+")
+  output.write("\t".join(COLUMNS) + "\n")
+  for result in results:
+    output.write("\t".join(str(result[name]) for name in COLUMNS) + "\n")
+  output.close()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,179 @@
+#!/usr/bin/python2
+
+"""
+Scaling benchmark of the AnonymitySimulator policies
+
+For every population size a synthetic data set is generated (and kept in
+the work directory for later runs), then every policy is simulated over it
+in a fresh process so its peak memory can be measured on its own.  The
+report holds the wall time, events/sec and peak memory of every run and,
+per policy, the scaling exponent of the time between consecutive sizes
+(1.0 is linear, 2.0 quadratic).
+
+python2 benchmark.py [--sizes=100,1000,10000]
+                     [--policies=min_anon,dynamic_split,static_split]
+                     [--duration=86400] [--workdir=bench] [--output=bench.tsv]
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import Queue
+import resource
+import time
+import traceback
+import anon_sim
+import synthetic
+
+COLUMNS = ["policy", "users", "events", "seconds", "events_per_sec",
+    "peak_mb", "delivered", "delayed", "lost", "status"]
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmarks the "
+      "AnonymitySimulator policies over synthetic data sets")
+  parser.add_argument("--sizes", default="100,1000,10000",
+      help="comma separated user counts (default: 100,1000,10000)")
+  parser.add_argument("--policies", default="min_anon,dynamic_split,"
+      "static_split", help="comma separated policies "
+      "(default: min_anon,dynamic_split,static_split)")
+  parser.add_argument("-l", "--duration", type=float, default=86400.0,
+      help="length of the synthetic traces in seconds (default: 86400.0)")
+  parser.add_argument("--session", type=float, default=3600.0,
+      help="mean online session in seconds (default: 3600.0)")
+  parser.add_argument("--offline", type=float, default=7200.0,
+      help="mean offline gap in seconds (default: 7200.0)")
+  parser.add_argument("--message_rate", type=float, default=0.005,
+      help="messages per second of a user online (default: 0.005)")
+  parser.add_argument("--seed", type=int, default=0,
+      help="seed of the synthetic traces (default: 0)")
+  parser.add_argument("-m", "--min_anon", type=int, default=0,
+      help="minimum value for the anonymity meter, (default: 0)")
+  parser.add_argument("-z", "--split_size", type=int, default=4,
+      help="buddy sizes for the splitting policies (default: 4)")
+  parser.add_argument("--rank_mode", default="auto",
+      help="how ranks are accounted (default: auto)")
+  parser.add_argument("--workdir", default="bench",
+      help="where the synthetic data sets are kept (default: bench)")
+  parser.add_argument("-o", "--output", default="bench.tsv",
+      help="where the report is written (default: bench.tsv)")
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.workdir):
+    os.makedirs(args.workdir)
+
+  results = []
+  print "\t".join(COLUMNS)
+  for users in [int(size) for size in args.sizes.split(",")]:
+    # Keep the arrivals within the first tenth of the trace at every size
+    arrival = args.duration / 10.0 / users
+    path = dataset(args.workdir, users, args.duration, arrival, args.session,
+        args.offline, args.message_rate, args.seed)
+    for policy in args.policies.split(","):
+      params = {
+          "min_anon" : args.min_anon,
+          "split_size" : args.split_size,
+          "rank_mode" : args.rank_mode,
+          }
+      result = measure(path, policy, params)
+      result["users"] = users
+      results.append(result)
+      print "\t".join(str(result[name]) for name in COLUMNS)
+
+  write_report(args.output, results)
+  for line in scaling(results):
+    print line
+
+def dataset(workdir, users, duration, arrival, session, offline,
+    message_rate, seed):
+  """ Generates the columnar data set for a size unless it already exists """
+  path = os.path.join(workdir, "synthetic_%d_%g_%g_%g_%g_%g_%d.col" % \
+      (users, duration, arrival, session, offline, message_rate, seed))
+  if not os.path.exists(path):
+    events = synthetic.generate(users, duration,
+        arrival = ("exponential", arrival),
+        session = ("exponential", session),
+        offline = ("exponential", offline),
+        message_rate = message_rate, seed = seed)
+    synthetic.write(path + ".tmp", events, True)
+    os.rename(path + ".tmp", path)
+  return path
+
+def measure(path, policy, params):
+  """ Simulates in a child process, returns its result """
+  queue = multiprocessing.Queue()
+  child = multiprocessing.Process(target=run, args=(queue, path, policy,
+      params))
+  child.start()
+  # Read before joining, a child blocks on exit until its result is read
+  result = None
+  while result is None:
+    try:
+      result = queue.get(timeout=1)
+    except Queue.Empty:
+      if child.is_alive():
+        continue
+      # Dead, but the result may still have been on its way
+      try:
+        result = queue.get(timeout=1)
+      except Queue.Empty:
+        break
+  child.join()
+  if result is None or child.exitcode != 0:
+    result = dict((name, "") for name in COLUMNS)
+    result["policy"] = policy
+    result["status"] = "died with exit code %s" % (child.exitcode, )
+  return result
+
+def run(queue, path, policy, params):
+  result = dict((name, "") for name in COLUMNS)
+  result["policy"] = policy
+  try:
+    start = time.time()
+    msg_parser = anon_sim.DefaultParse(filename=path, end=-1)
+    sim = anon_sim.create_simulator(policy, len(msg_parser.users),
+        msg_parser.events(), **params)
+    sim.run()
+    result["seconds"] = time.time() - start
+    result["events"] = sim.position
+    result["events_per_sec"] = sim.position / max(result["seconds"], 1e-9)
+    result["delivered"] = sim.on_time
+    result["delayed"] = sim.delays.count
+    result["lost"] = len(sim.lost_messages)
+    result["status"] = "ok"
+  except Exception, e:
+    traceback.print_exc()
+    result["status"] = ("%s: %s" % (type(e).__name__, e)).replace("\t", " ")
+  # ru_maxrss is in kilobytes on Linux
+  result["peak_mb"] = \
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  queue.put(result)
+
+def scaling(results):
+  """ Scaling exponents of the time between consecutive sizes """
+  lines = []
+  policies = []
+  for result in results:
+    if result["policy"] not in policies:
+      policies.append(result["policy"])
+  for policy in policies:
+    runs = [r for r in results if r["policy"] == policy and \
+        r["status"] == "ok"]
+    for before, after in zip(runs, runs[1:]):
+      if before["seconds"] <= 0 or before["users"] == after["users"]:
+        continue
+      exponent = math.log(after["seconds"] / before["seconds"]) / \
+          math.log(float(after["users"]) / before["users"])
+      lines.append("Scaling %s %s -> %s users: %.2f" % (policy,
+          before["users"], after["users"], exponent))
+  return lines
+
+def write_report(filename, results):
+  output = open(filename, "w+")
+  output.write("\t".join(COLUMNS) + "\n")
+  for result in results:
+    output.write("\t".join(str(result[name]) for name in COLUMNS) + "\n")
+  output.close()
+
+if __name__ == "__main__":
+  main()
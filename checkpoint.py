@@ -0,0 +1,63 @@
+#!/usr/bin/python2
+
+"""
+Checkpoints of the AnonymitySimulator state
+
+A checkpoint is a compressed numpy archive (.npz) of plain arrays, no object
+is pickled.  Variable length lists, such as groups or per pseudonym rounds,
+are stored flattened along with their offsets.  Messages are not stored,
+only their index in the event stream, so resuming replays the stream up to
+the checkpoint and picks the pending messages up on the way.
+"""
+
+import itertools
+import numpy
+import os
+
+FORMAT_VERSION = 3
+
+def write_checkpoint(filename, state):
+  """ Atomically replaces filename with the arrays in state """
+  state = dict(state)
+  state["format_version"] = numpy.array(FORMAT_VERSION)
+  tmp = filename + ".tmp"
+  output = open(tmp, "wb")
+  numpy.savez_compressed(output, **state)
+  output.close()
+  os.rename(tmp, filename)
+
+def read_checkpoint(filename):
+  """ Returns the arrays of a checkpoint as a dict """
+  archive = numpy.load(filename)
+  state = dict((name, archive[name]) for name in archive.files)
+  archive.close()
+  if int(state.pop("format_version")) != FORMAT_VERSION:
+    raise ValueError("%s has an unsupported checkpoint format" % (filename, ))
+  return state
+
+def pack_lists(lists, dtype = numpy.int64):
+  """ Flattens a list of lists into values and offsets """
+  offsets = numpy.zeros(len(lists) + 1, dtype=numpy.int64)
+  offsets[1:] = numpy.cumsum([len(values) for values in lists])
+  values = numpy.array(list(itertools.chain(*lists)), dtype=dtype)
+  return values, offsets
+
+def unpack_lists(values, offsets):
+  """ Inverse of pack_lists, returns a list of lists """
+  values = values.tolist()
+  offsets = offsets.tolist()
+  return [values[offsets[idx]:offsets[idx + 1]] \
+      for idx in range(len(offsets) - 1)]
+
+def replay(events, position, indices):
+  """ Skips the first position events, returns the events at indices among
+  them as a dict by index along with the iterator over the rest """
+  events = iter(events)
+  wanted = set(indices)
+  found = {}
+  for idx, event in enumerate(itertools.islice(events, position)):
+    if idx in wanted:
+      found[idx] = event
+  if len(found) != len(wanted):
+    raise ValueError("The data set ends before the checkpoint")
+  return found, events
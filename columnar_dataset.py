@@ -0,0 +1,251 @@
+#!/usr/bin/python2
+
+"""
+Columnar binary format for AnonymitySimulator data sets
+
+A data set of (time, "join"|"quit", uid) and (time, "msg", (uid, msg)) events
+is stored as one file:
+  header - magic, event count, distinct users, messages, blob size
+  times - float64 per event
+  uids - uint32 per event
+  types - uint8 per event (join, quit, msg)
+  kinds - uint8 per event, how the message payload is encoded
+  offsets - uint64 per event + 1, offsets of the payloads into the blob
+  blob - the concatenated message payloads
+
+Every section is memory mapped by ColumnarDataset, so loading is independent
+of the size of the data set and payloads are only decoded when asked for.
+Uids are integers below 2^32, as produced by the parsers, data sets keyed by
+user names get uids in the order the names first appear.
+
+python2 columnar_dataset.py [--to_pickle] input output
+  Converts a pickled data set into the columnar format or back
+"""
+
+import argparse
+import array
+import numpy
+import pickle
+import shutil
+import struct
+import tempfile
+
+MAGIC = "ANONCOL1"
+HEADER = struct.Struct("<8sQQQQ")
+HEADER_SIZE = 64
+
+EVENT_TYPES = ["join", "quit", "msg"]
+EVENT_CODES = {name: code for code, name in enumerate(EVENT_TYPES)}
+
+# Message payload encodings
+PAYLOAD_NONE = 0
+PAYLOAD_STR = 1
+PAYLOAD_UNICODE = 2
+PAYLOAD_PICKLE = 3
+
+def main():
+  parser = argparse.ArgumentParser(description="Converts data sets between "
+      "the pickled and the columnar format")
+  parser.add_argument("input", help="data set to convert")
+  parser.add_argument("output", help="where the converted data set is written")
+  parser.add_argument("--to_pickle", default=False, action="store_const",
+      const=True, help="convert a columnar data set back to pickles")
+  args = parser.parse_args()
+
+  if args.to_pickle:
+    dataset = ColumnarDataset(args.input)
+    write_pickle(args.output, dataset.events())
+  else:
+    write_columnar(args.output, read_pickle(args.input))
+
+def is_columnar(filename):
+  """ Returns True if filename holds a columnar data set """
+  f = open(filename, "rb")
+  magic = f.read(len(MAGIC))
+  f.close()
+  return magic == MAGIC
+
+def read_pickle(filename):
+  """ Yields the events of a pickled data set """
+  f = open(filename, "rb")
+  try:
+    while True:
+      try:
+        yield pickle.load(f)
+      except EOFError:
+        break
+  finally:
+    f.close()
+
+def write_pickle(filename, events):
+  output = open(filename, "wb")
+  for event in events:
+    output.write(pickle.dumps(event))
+  output.close()
+
+def align(offset):
+  return (offset + 7) & ~7
+
+def column_array(column, dtype):
+  """ Converts an array.array column into a numpy array of dtype """
+  if len(column) == 0:
+    return numpy.zeros(0, dtype=dtype)
+  return numpy.frombuffer(column, dtype=column.typecode).astype(dtype)
+
+def write_columnar(filename, events):
+  """ Writes events into a columnar data set, payloads are spooled to a
+  temporary file so only the fixed width columns are kept in memory """
+  times = array.array("d")
+  uids = array.array("I")
+  types = array.array("B")
+  kinds = array.array("B")
+  offsets = array.array("L")
+  users = set()
+  names = {}
+  messages = 0
+
+  blob = tempfile.TemporaryFile()
+  blob_size = 0
+  for event in events:
+    code = EVENT_CODES[event[1]]
+    times.append(event[0])
+    types.append(code)
+    offsets.append(blob_size)
+    if code == EVENT_CODES["msg"]:
+      uid, msg = event[2]
+      messages += 1
+      if msg is None:
+        kind, payload = PAYLOAD_NONE, ""
+      elif isinstance(msg, unicode):
+        kind, payload = PAYLOAD_UNICODE, msg.encode("utf-8")
+      elif isinstance(msg, str):
+        kind, payload = PAYLOAD_STR, msg
+      else:
+        kind, payload = PAYLOAD_PICKLE, pickle.dumps(msg, 2)
+      blob.write(payload)
+      blob_size += len(payload)
+    else:
+      uid = event[2]
+      kind = PAYLOAD_NONE
+      if code == EVENT_CODES["join"]:
+        users.add(uid)
+    if isinstance(uid, (int, long)):
+      if len(names) > 0:
+        raise ValueError("Data set mixes integer uids and user names")
+    elif len(names) == 0 and len(uids) > 0:
+      raise ValueError("Data set mixes integer uids and user names")
+    else:
+      if uid not in names:
+        names[uid] = len(names)
+      uid = names[uid]
+    uids.append(uid)
+    kinds.append(kind)
+  offsets.append(blob_size)
+
+  count = len(times)
+  output = open(filename, "wb")
+  output.write(HEADER.pack(MAGIC, count, len(users), messages, blob_size))
+  output.write("\0" * (HEADER_SIZE - HEADER.size))
+  for column, dtype in [(times, numpy.float64), (uids, numpy.uint32),
+      (types, numpy.uint8), (kinds, numpy.uint8), (offsets, numpy.uint64)]:
+    data = column_array(column, dtype).tostring()
+    output.write(data)
+    output.write("\0" * (align(len(data)) - len(data)))
+  blob.seek(0)
+  shutil.copyfileobj(blob, output)
+  blob.close()
+  output.close()
+
+class ColumnarDataset:
+  """ Memory mapped view of a columnar data set """
+  def __init__(self, filename):
+    self.filename = filename
+    f = open(filename, "rb")
+    header = f.read(HEADER.size)
+    f.close()
+    magic, self.count, self.users, self.messages, blob_size = \
+        HEADER.unpack(header)
+    if magic != MAGIC:
+      raise ValueError("%s is not a columnar data set" % (filename, ))
+
+    offset = HEADER_SIZE
+    self.times, offset = self.map(offset, numpy.float64, self.count)
+    self.uids, offset = self.map(offset, numpy.uint32, self.count)
+    self.types, offset = self.map(offset, numpy.uint8, self.count)
+    self.kinds, offset = self.map(offset, numpy.uint8, self.count)
+    self.offsets, offset = self.map(offset, numpy.uint64, self.count + 1)
+    self.blob, offset = self.map(offset, numpy.uint8, blob_size)
+
+  def map(self, offset, dtype, count):
+    """ Maps count items of dtype at offset, returns the array and the
+    offset of the following section """
+    size = numpy.dtype(dtype).itemsize * count
+    if count == 0:
+      return numpy.zeros(0, dtype=dtype), align(offset + size)
+    column = numpy.memmap(self.filename, dtype=dtype, mode="r",
+        offset=offset, shape=(count, ))
+    return column, align(offset + size)
+
+  def __len__(self):
+    return self.count
+
+  def length(self, end = -1):
+    """ Number of events up to the first one after end """
+    if end <= 0:
+      return self.count
+    # Events are in time order, a binary search finds the first one after end
+    return int(numpy.searchsorted(self.times, end, side="right"))
+
+  def message_count(self, end = -1):
+    """ Number of msg events up to end """
+    if end <= 0:
+      return self.messages
+    count = self.length(end)
+    return int(numpy.count_nonzero(self.types[:count] == EVENT_CODES["msg"]))
+
+  def join_order(self, end = -1):
+    """ The raw uids of the users in the order they first join """
+    count = self.length(end)
+    joins = self.types[:count] == EVENT_CODES["join"]
+    uids, first = numpy.unique(self.uids[:count][joins], return_index=True)
+    return uids[numpy.argsort(first, kind="mergesort")].astype(numpy.int64)
+
+  def message(self, idx):
+    """ Decodes the payload of the message event at idx """
+    start = int(self.offsets[idx])
+    payload = self.blob[start:int(self.offsets[idx + 1])].tostring()
+    kind = self.kinds[idx]
+    if kind == PAYLOAD_NONE:
+      return None
+    elif kind == PAYLOAD_UNICODE:
+      return payload.decode("utf-8")
+    elif kind == PAYLOAD_PICKLE:
+      return pickle.loads(payload)
+    return payload
+
+  def events(self, end = -1, uid_map = None, payloads = True,
+      chunk = 65536, first = 0):
+    """ Yields the events up to end as tuples, from the one at index first.
+    uid_map, an array indexed by raw uid, remaps users on the fly.  Without
+    payloads the message of a msg event is its index, which message()
+    resolves. """
+    count = self.length(end)
+    msg_code = EVENT_CODES["msg"]
+    for start in range(first, count, chunk):
+      stop = min(start + chunk, count)
+      times = self.times[start:stop].tolist()
+      types = self.types[start:stop].tolist()
+      uids = self.uids[start:stop]
+      if uid_map is not None:
+        uids = uid_map[uids]
+      # As int64, uint32 would list as longs rather than the ints written
+      uids = uids.astype(numpy.int64).tolist()
+      for idx in range(stop - start):
+        if types[idx] == msg_code:
+          msg = self.message(start + idx) if payloads else start + idx
+          yield (times[idx], "msg", (uids[idx], msg))
+        else:
+          yield (times[idx], EVENT_TYPES[types[idx]], uids[idx])
+
+if __name__ == "__main__":
+  main()
@@ -10,12 +10,25 @@ Event structure:
 
 import argparse
 import math
+import numpy
 import pickle
+from columnar_dataset import ColumnarDataset, EVENT_CODES, EVENT_TYPES, \
+    is_columnar, write_columnar
 
 class DefaultParse:
   def __init__(self, filename):
     self.events = []
     self.users = {}
+    self.dataset = None
+    self.columnar = is_columnar(filename)
+    if self.columnar:
+      # The events stay in the columns rather than in a list
+      self.events = None
+      self.dataset = ColumnarDataset(filename)
+      for uid in self.dataset.join_order().tolist():
+        self.users[uid] = uid
+      return
+
     f = open(filename, "rb")
 
     while True:
@@ -29,6 +42,19 @@ class DefaultParse:
 
     f.close()
 
+  def stream(self):
+    """ Iterates over the events, a chunk of columns at a time for a columnar
+    data set """
+    if self.columnar:
+      return self.dataset.events()
+    return self.events
+
+  def last_time(self):
+    """ Time of the last event """
+    if self.columnar:
+      return self.dataset.times[-1].item()
+    return self.events[-1][0]
+
 def main():
   parser = argparse.ArgumentParser(description="The AnonymitySimulator")
   parser.add_argument("-i", "--input", default="data",
@@ -52,7 +78,10 @@ def main():
   args = parser.parse_args()
 
   msg_parser = DefaultParse(filename=args.input)
-  data_analyzer = DataAnalyzer(msg_parser.events, args.interval, args.end)
+  if msg_parser.columnar:
+    data_analyzer = DataAnalyzer(msg_parser.dataset, args.interval, args.end)
+  else:
+    data_analyzer = DataAnalyzer(msg_parser.events, args.interval, args.end)
 
   if args.filter == None:
     clients = list(data_analyzer.clients.values())
@@ -70,7 +99,7 @@ def main():
 
   to_remove = []
   if args.filter == "interval":
-    intervals = math.ceil(msg_parser.events[-1][0] / args.interval)
+    intervals = math.ceil(msg_parser.last_time() / args.interval)
     if args.percent != 0:
       desired_intervals = math.floor(intervals * args.percent)
     else:
@@ -91,16 +120,20 @@ def main():
         break
       to_remove.append(client.uid)
   elif args.filter == "online_time":
-    percent = args.percent * msg_parser.events[-1][0]
+    percent = args.percent * msg_parser.last_time()
     for client in data_analyzer.clients.values():
       if client.online_time < perent:
         to_remove.append(client.uid)
 
   print "Filtering will remove %s clients" % (len(to_remove))
-  data_filter = DataFilter(msg_parser.events, len(msg_parser.users), to_remove)
+  data_filter = DataFilter(msg_parser.stream(), len(msg_parser.users),
+      to_remove)
   if args.start != 0 or args.end != 0:
     pass
 #    data_filter.set_range(args.start, args.end)
+  if msg_parser.columnar:
+    write_columnar(args.output, data_filter.filtered_events)
+    return
   output = file(args.output, "w+")
   for event in data_filter.filtered_events:
     output.write(pickle.dumps(event))
@@ -108,7 +141,8 @@ def main():
 
 class DataAnalyzer:
   """ Processes a data set to calculate both the clients' and their
-  respective message pseudonyms' anonymity over time. """
+  respective message pseudonyms' anonymity over time.  events is either a
+  list of events or a ColumnarDataset, whose columns are read directly. """
   class Client:
     """ Represents a single client """
     def __init__(self, uid):
@@ -151,12 +185,18 @@ class DataAnalyzer:
 
     self.clients = {}
 
-    if end == -1:
-      self.end = events[-1][0] + 1
-    else:
+    columnar = isinstance(events, ColumnarDataset)
+    if end != -1:
       self.end = end
+    elif columnar:
+      self.end = events.times[-1].item() + 1
+    else:
+      self.end = events[-1][0] + 1
 
-    self.process_events(events)
+    if columnar:
+      self.process_columns(events)
+    else:
+      self.process_events(events)
 
     if interval > 0:
       for client in self.clients.values():
@@ -186,6 +226,27 @@ class DataAnalyzer:
     for client in self.clients.values():
       client.finished(self.end)
 
+  def process_columns(self, dataset, chunk = 65536):
+    """ process_events over the time, type and uid columns of a columnar
+    data set, the messages themselves are never decoded """
+    count = int(numpy.searchsorted(dataset.times, self.end, side="right"))
+    callbacks = [self.event_actions[name] for name in EVENT_TYPES]
+    msg_code = EVENT_CODES["msg"]
+    for start in range(0, count, chunk):
+      stop = min(start + chunk, count)
+      times = dataset.times[start:stop].tolist()
+      types = dataset.types[start:stop].tolist()
+      uids = dataset.uids[start:stop].tolist()
+      for etime, code, uid in zip(times, types, uids):
+        try:
+          callbacks[code](etime, (uid, None) if code == msg_code else uid)
+        except:
+          print (etime, EVENT_TYPES[code], uid)
+          raise
+
+    for client in self.clients.values():
+      client.finished(self.end)
+
   def on_join(self, etime, uid):
     """ Handler for the client join event """
     if uid not in self.clients:
@@ -0,0 +1,154 @@
+#!/usr/bin/python2
+
+"""
+Streaming statistics of message delays
+
+DelayStats keeps, in memory bounded by the range of the delays rather than
+their number:
+  count, mean and standard deviation - Welford's running mean and variance
+  min and max - exact
+  percentiles - from a histogram of logarithmic buckets, each GROWTH times
+    wider than the previous one, so a percentile is within half a bucket
+    (about 0.5%) of the exact value
+  hours - the same statistics for the messages sent in each hour of the
+    trace
+
+Two DelayStats, from parallel runs or different channels, combine with
+merge() exactly as if every delay had been added to one of them.
+"""
+
+import math
+import numpy
+from checkpoint import pack_lists, unpack_lists
+
+GROWTH = 1.01
+LOG_GROWTH = math.log(GROWTH)
+HOUR = 3600.0
+PERCENTILES = [50, 90, 99]
+
+class DelayStats:
+  """ Running count, mean, variance, extremes and histogram of delays """
+  def __init__(self, hourly = True):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.min = float("inf")
+    self.max = float("-inf")
+    # Delays of zero or less, which have no logarithmic bucket
+    self.zeros = 0
+    self.buckets = {}
+    self.hours = {} if hourly else None
+
+  def add(self, delay, msg_time = 0):
+    """ Records the delay of a message sent at msg_time """
+    self.count += 1
+    delta = delay - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (delay - self.mean)
+    self.min = min(self.min, delay)
+    self.max = max(self.max, delay)
+    if delay <= 0:
+      self.zeros += 1
+    else:
+      bucket = int(math.floor(math.log(delay) / LOG_GROWTH))
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    if self.hours is not None:
+      hour = int(msg_time // HOUR)
+      if hour not in self.hours:
+        self.hours[hour] = DelayStats(False)
+      self.hours[hour].add(delay)
+
+  def merge(self, other):
+    """ Adds the delays recorded by other """
+    if other.count == 0:
+      return
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.mean += delta * other.count / count
+    self.m2 += other.m2 + delta * delta * self.count * other.count / count
+    self.count = count
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+    self.zeros += other.zeros
+    for bucket, hits in other.buckets.items():
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + hits
+    if self.hours is not None and other.hours is not None:
+      for hour, stats in other.hours.items():
+        if hour not in self.hours:
+          self.hours[hour] = DelayStats(False)
+        self.hours[hour].merge(stats)
+
+  def std_dev(self):
+    """ Population standard deviation """
+    if self.count == 0:
+      return 0.0
+    return math.sqrt(max(self.m2 / self.count, 0.0))
+
+  def average(self):
+    return self.mean if self.count > 0 else 0.0
+
+  def percentile(self, percent):
+    """ The delay below which percent of the delays fall, 0 if none """
+    if self.count == 0:
+      return 0.0
+    rank = max(int(math.ceil(percent / 100.0 * self.count)), 1)
+    if rank <= self.zeros:
+      return self.min
+    seen = self.zeros
+    for bucket in sorted(self.buckets.keys()):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        value = math.exp((bucket + 0.5) * LOG_GROWTH)
+        return min(max(value, self.min), self.max)
+    return self.max
+
+  def summary(self):
+    """ (name, value) pairs of the statistics """
+    values = [("count", self.count), ("avg", self.average()),
+        ("std", self.std_dev())]
+    for percent in PERCENTILES:
+      values.append(("p%d" % (percent, ), self.percentile(percent)))
+    values.append(("max", self.max if self.count > 0 else 0.0))
+    return values
+
+  def get_state(self):
+    """ The statistics as a dict of arrays for checkpointing """
+    hours = sorted(self.hours.keys()) if self.hours is not None else []
+    stats = [self] + [self.hours[hour] for hour in hours]
+    state = {
+        "hourly" : numpy.array(self.hours is not None),
+        "hours" : numpy.array(hours, dtype=numpy.int64),
+        "moments" : numpy.array([[s.count, s.mean, s.m2, s.min, s.max,
+            s.zeros] for s in stats], dtype=numpy.float64),
+        }
+    keys = [sorted(s.buckets.keys()) for s in stats]
+    state["buckets"], state["bucket_offsets"] = pack_lists(keys)
+    state["bucket_counts"], offsets = pack_lists([[s.buckets[key] \
+        for key in ks] for s, ks in zip(stats, keys)])
+    return state
+
+  def set_state(self, state):
+    hours = state["hours"].tolist()
+    self.hours = {} if bool(state["hourly"]) else None
+    stats = [self]
+    for hour in hours:
+      self.hours[hour] = DelayStats(False)
+      stats.append(self.hours[hour])
+    keys = unpack_lists(state["buckets"], state["bucket_offsets"])
+    counts = unpack_lists(state["bucket_counts"], state["bucket_offsets"])
+    for s, moments, ks, cs in zip(stats, state["moments"].tolist(), keys,
+        counts):
+      count, s.mean, s.m2, s.min, s.max, zeros = moments
+      s.count = int(count)
+      s.zeros = int(zeros)
+      s.buckets = dict(zip(ks, cs))
+
+def write_hours(filename, stats):
+  """ Writes the statistics of every hour as a tab separated table """
+  output = open(filename, "w+")
+  names = [name for name, value in DelayStats().summary()]
+  output.write("\t".join(["hour"] + names) + "\n")
+  for hour in sorted(stats.hours.keys()):
+    values = [value for name, value in stats.hours[hour].summary()]
+    output.write("\t".join(str(value) for value in [hour] + values) + "\n")
+  output.close()
@@ -6,38 +6,38 @@
 #  Copyright (c) 2013 __MyCompanyName__. All rights reserved.
 #
 
+import collections
+import numpy
+from checkpoint import pack_lists, unpack_lists
+
 class Round_Keeper:	
+  #queued messages are kept in Message_Queues keyed by a message id, ids are
+  #handed out in increasing order so a message was delayed exactly when its
+  #id is below the first id of the current round
   def __init__ (self):
     
     self.group_round_keepers = []
-    self.messages_from_offline_users = []	
+    self.messages_from_offline_users = Round_Keeper.Message_Queue()
+    self.next_id = 0
+    self.round_start_id = 0
 
   def add_group(self,group,online_group):
     self.group_round_keepers.append(\
                  Round_Keeper.Group_Round_Keeper(online_group))
+    new_keeper = self.group_round_keepers[-1]
     #add any ungrouped messages belonging to the group
-    for message in self.get_messages_for_group(0)[:]:
-      uid = message[2][0]
-      if uid in group: 
-        self.remove_message_from_group(message,0)
-        self.add_message_to_group(-1,uid,message)
+    base_messages = self.group_round_keepers[0].messages
+    for msg_id, message in base_messages.take_senders(group):
+      new_keeper.add_message(message[2][0],msg_id,message)
  
     #messages sent before the user was online
-    for message in self.messages_from_offline_users[:]:
-      uid = message [2][0]
-      if uid in group:
-        self.messages_from_offline_users.remove(message)
-        self.add_message_to_group(-1,uid,message)
+    for msg_id, message in self.messages_from_offline_users.take_senders(group):
+      new_keeper.add_message(message[2][0],msg_id,message)
     
     if len(self.group_round_keepers) > 1:  
       base_round_keeper = self.group_round_keepers[0]
       for uid in group:
-        if uid in base_round_keeper.online_members:
-          base_round_keeper.online_members.remove(uid)
-        if uid in base_round_keeper.round_members:
-          base_round_keeper.round_members.remove(uid)
-        if uid in base_round_keeper.new_round_members:
-          base_round_keeper.new_round_members.remove(uid)
+        base_round_keeper.discard_member(uid)
 
   def add_online_member_to_group(self,member,gid):
     self.group_round_keepers[gid].add_online_member(member)
@@ -49,19 +49,43 @@ class Round_Keeper:
     return len(self.group_round_keepers[gid].online_members)
   
   def get_num_round_members_for_group(self,gid):
-    return len(self.group_round_keepers[gid].round_members)
+    return self.group_round_keepers[gid].get_num_round_members()
+
+  def new_message_id(self):
+    msg_id = self.next_id
+    self.next_id += 1
+    return msg_id
+
+  def start_round(self):
+    #every message queued so far is delayed from now on
+    self.round_start_id = self.next_id
+
+  def is_delayed(self,msg_id):
+    return msg_id < self.round_start_id
 
   def add_message_to_group(self,gid,uid,message):	
-    self.group_round_keepers[gid].add_message(uid,message)
+    msg_id = self.new_message_id()
+    self.group_round_keepers[gid].add_message(uid,msg_id,message)
+    return msg_id
   
   def add_message_from_offline_user(self,message):
-    self.messages_from_offline_users.append(message)
+    msg_id = self.new_message_id()
+    self.messages_from_offline_users.add(msg_id,message)
+    return msg_id
   
   def remove_message_from_group(self,message,gid):
     self.group_round_keepers[gid].remove_message(message)
+
+  def remove_message_id_from_group(self,msg_id,gid):
+    self.group_round_keepers[gid].messages.remove(msg_id)
     
   def get_messages_for_group(self,gid):
-    return self.group_round_keepers[gid].messages  
+    return self.group_round_keepers[gid].messages.values()
+
+  def get_indexed_messages_for_group(self,gid):
+    #(message id, message) pairs, a copy safe to remove messages while
+    #iterating over
+    return self.group_round_keepers[gid].messages.items()
 
   def end_group_round(self,gid):
     group_round_keeper = self.group_round_keepers[gid]	
@@ -71,51 +95,191 @@ class Round_Keeper:
     self.group_round_keepers[gid].end_global_round()
   
   def get_all_round_messages(self):
-    messages = self.messages_from_offline_users[:]
+    messages = self.messages_from_offline_users.values()
     for group_round_keeper in self.group_round_keepers:
-      messages.extend(group_round_keeper.messages)
+      messages.extend(group_round_keeper.messages.values())
     return messages
 
+  def get_num_messages(self):
+    count = len(self.messages_from_offline_users)
+    for group_round_keeper in self.group_round_keepers:
+      count += len(group_round_keeper.messages)
+      count += len(group_round_keeper.next_messages)
+    return count
+
   def get_all_messages(self):
-    messages = self.messages_from_offline_users [:]
+    messages = self.messages_from_offline_users.values()
     for group_round_keeper in self.group_round_keepers:
-      messages.extend(group_round_keeper.messages)
-      messages.extend(group_round_keeper.next_messages)
+      messages.extend(group_round_keeper.messages.values())
+      messages.extend(group_round_keeper.next_messages.values())
     return messages	
+
+  def get_state(self,index):
+    #messages are stored by their position in the event stream, index maps
+    #a message to it
+    keepers = self.group_round_keepers
+    state = {"offline_events" : numpy.array([index(m) \
+                 for m in self.messages_from_offline_users.values()],
+                 dtype=numpy.int64),
+             "fresh" : numpy.array([k.fresh for k in keepers],dtype=bool)}
+    for name in ["online_members","left_members","joined_members"]:
+      state[name], state[name + "_offsets"] = \
+                 pack_lists([sorted(getattr(k,name)) for k in keepers])
+    for name in ["messages","next_messages"]:
+      state[name + "_events"], state[name + "_offsets"] = \
+                 pack_lists([[index(m) for m in getattr(k,name).values()] \
+                             for k in keepers])
+    return state
+
+  def set_state(self,state,messages):
+    #messages maps stream positions back to the messages, ids are handed out
+    #afresh as every pending message is delayed by the next round
+    self.next_id = 0
+    self.messages_from_offline_users = Round_Keeper.Message_Queue(\
+                 (self.new_message_id(),messages[idx]) \
+                 for idx in state["offline_events"].tolist())
+    self.group_round_keepers = []
+    groups = len(state["online_members_offsets"]) - 1
+    for gid in range(groups):
+      self.group_round_keepers.append(Round_Keeper.Group_Round_Keeper([]))
+    for name in ["online_members","left_members","joined_members"]:
+      lists = unpack_lists(state[name],state[name + "_offsets"])
+      for keeper, members in zip(self.group_round_keepers,lists):
+        setattr(keeper,name,set(members))
+    for keeper, fresh in zip(self.group_round_keepers,state["fresh"].tolist()):
+      keeper.fresh = fresh
+      keeper.left_offline = len(keeper.left_members - keeper.online_members)
+    for name in ["messages","next_messages"]:
+      lists = unpack_lists(state[name + "_events"],state[name + "_offsets"])
+      for keeper, indices in zip(self.group_round_keepers,lists):
+        setattr(keeper,name,Round_Keeper.Message_Queue(\
+                 (self.new_message_id(),messages[idx]) for idx in indices))
+    self.round_start_id = self.next_id
+
+  class Message_Queue:
+    #messages by id in the order they were queued, indexed by sender so the
+    #messages of a few senders are found without going through the queue
+    def __init__(self, entries = ()):
+      self.messages = collections.OrderedDict()
+      self.positions = {}
+      self.next_position = 0
+      self.senders = {}
+      for msg_id, event in entries:
+        self.add(msg_id,event)
+
+    def __len__(self):
+      return len(self.messages)
+
+    def add(self,msg_id,event):
+      self.messages[msg_id] = event
+      self.positions[msg_id] = self.next_position
+      self.next_position += 1
+      uid = event[2][0]
+      if uid not in self.senders:
+        self.senders[uid] = set()
+      self.senders[uid].add(msg_id)
+
+    def remove(self,msg_id):
+      event = self.messages.pop(msg_id)
+      del self.positions[msg_id]
+      uid = event[2][0]
+      sent = self.senders[uid]
+      sent.remove(msg_id)
+      if not sent:
+        del self.senders[uid]
+
+    def extend(self,queue):
+      for msg_id, event in queue.items():
+        self.add(msg_id,event)
+
+    def take_senders(self,uids):
+      #removes and returns, in queue order, the messages sent by uids
+      msg_ids = []
+      for uid in uids:
+        msg_ids.extend(self.senders.pop(uid,()))
+      msg_ids.sort(key=self.positions.__getitem__)
+      taken = []
+      for msg_id in msg_ids:
+        taken.append((msg_id,self.messages.pop(msg_id)))
+        del self.positions[msg_id]
+      return taken
+
+    def find(self,event):
+      for msg_id, queued in self.messages.iteritems():
+        if queued == event:
+          return msg_id
+      raise ValueError("message not queued")
+
+    def items(self):
+      return self.messages.items()
+
+    def values(self):
+      return self.messages.values()
 	
   class Group_Round_Keeper:
+    #the members of a round are the members online at its start and those
+    #that joined since, kept as the online members plus the ones that left
+    #during the round.  Messages go to the current round if their sender was
+    #online at the start of the global round, that is every round member
+    #while no global round has ended since the group round (fresh), and
+    #otherwise only the members that joined since the global round
     def __init__(self, online_group):
-      self.online_members = online_group[:]
-      self.round_members = online_group[:]
-      self.new_round_members = online_group[:]
-      self.messages = []
-      self.next_messages = []
+      self.online_members = set(online_group)
+      self.left_members = set()
+      self.left_offline = 0
+      self.joined_members = set()
+      self.fresh = True
+      self.messages = Round_Keeper.Message_Queue()
+      self.next_messages = Round_Keeper.Message_Queue()
 	
     def add_online_member(self,member):
-      if member not in self.online_members:
-        self.online_members.append(member)
-      if member not in self.new_round_members:
-        self.new_round_members.append(member)
-      if member not in self.round_members:
-        self.round_members.append(member)
+      if member in self.left_members and member not in self.online_members:
+        self.left_offline -= 1
+      self.online_members.add(member)
+      if not self.fresh:
+        self.joined_members.add(member)
    
     def remove_offline_member (self,member):
-       self.online_members.remove(member)	
+      self.online_members.remove(member)
+      self.left_members.add(member)
+      self.left_offline += 1
+
+    def discard_member(self,member):
+      online = member in self.online_members
+      self.online_members.discard(member)
+      if member in self.left_members:
+        self.left_members.remove(member)
+        if not online:
+          self.left_offline -= 1
+      self.joined_members.discard(member)
+
+    def get_num_round_members(self):
+      return len(self.online_members) + self.left_offline
+
+    def is_new_round_member(self,member):
+      if self.fresh:
+        return member in self.online_members or member in self.left_members
+      return member in self.joined_members
     
-    def add_message(self,uid,event):
-      if (uid in self.new_round_members):
-        self.messages.append(event)
+    def add_message(self,uid,msg_id,event):
+      if self.is_new_round_member(uid):
+        self.messages.add(msg_id,event)
       else:
-        self.next_messages.append(event)
+        self.next_messages.add(msg_id,event)
     
     def remove_message(self,message):
-      self.messages.remove(message)
+      self.messages.remove(self.messages.find(message))
         
     def end_global_round(self):
-      self.new_round_members = []
+      self.fresh = False
+      self.joined_members = set()
 
     def end_group_round(self):
-      self.round_members = self.online_members[:]
-      self.new_round_members = self.online_members[:]
-      self.messages.extend(self.next_messages)
-      self.next_messages = []
+      self.left_members = set()
+      self.left_offline = 0
+      self.fresh = True
+      if self.messages:
+        self.messages.extend(self.next_messages)
+        self.next_messages = Round_Keeper.Message_Queue()
+      else:
+        self.messages, self.next_messages = self.next_messages, self.messages
@@ -0,0 +1,117 @@
+#!/usr/bin/python2
+
+"""
+Per-round metrics of the AnonymitySimulator
+
+Every k-th round the simulator hands its state to a MetricsWriter, which
+keeps a small record of it:
+  round_time - the end of the round
+  online - clients online
+  min_size, median_size, max_size - pseudonym anonymity set sizes
+  delivered - messages delivered on time so far
+  delayed - messages delivered late so far
+  queued - messages waiting to be delivered
+
+Records are buffered in a fixed size array and written either as CSV or as
+raw little endian records behind a short header, read_metrics loads both.
+Simulator checkpoints flush the records and keep the length of the file, a
+resumed run truncates the file back to it.
+"""
+
+import numpy
+
+RECORD = numpy.dtype([
+    ("round_time", "<f8"),
+    ("online", "<i8"),
+    ("min_size", "<i8"),
+    ("median_size", "<f8"),
+    ("max_size", "<i8"),
+    ("delivered", "<i8"),
+    ("delayed", "<i8"),
+    ("queued", "<i8"),
+    ])
+
+MAGIC = "ANONMET1"
+FORMATS = ["csv", "binary"]
+
+class MetricsWriter:
+  """ Buffered sink of per-round records, every selects one in every rounds """
+  def __init__(self, filename, every = 1, format = "csv", append = False,
+      buffer_size = 4096):
+    if format not in FORMATS:
+      raise ValueError("Unknown metrics format: %s" % (format, ))
+    self.format = format
+    self.every = max(every, 1)
+    self.rounds = 0
+    self.buffer = numpy.zeros(buffer_size, dtype=RECORD)
+    self.count = 0
+
+    self.output = open(filename, "ab" if append else "wb")
+    if self.output.tell() == 0:
+      if format == "csv":
+        self.output.write(",".join(RECORD.names) + "\n")
+      else:
+        self.output.write(MAGIC)
+
+  def record(self, sim):
+    """ Called at the end of every round """
+    self.rounds += 1
+    if (self.rounds - 1) % self.every != 0:
+      return
+
+    sizes = sim.anonymity_sets.pseudonym_sizes
+    row = self.buffer[self.count]
+    row["round_time"] = sim.next_time
+    # The clients themselves, the splitting policies only update their
+    # member_offline_mask when groups change
+    row["online"] = len(sim.clients) - numpy.count_nonzero(sim.offline_mask)
+    if len(sizes) > 0:
+      row["min_size"] = sizes.min()
+      row["median_size"] = numpy.median(sizes)
+      row["max_size"] = sizes.max()
+    row["delivered"] = sim.on_time
+    row["delayed"] = sim.delays.count
+    row["queued"] = sim.queued_messages()
+    self.count += 1
+    if self.count == len(self.buffer):
+      self.flush()
+
+  def flush(self):
+    records = self.buffer[:self.count]
+    if self.format == "csv":
+      for row in records.tolist():
+        self.output.write(",".join(repr(value) for value in row) + "\n")
+    else:
+      records.tofile(self.output)
+    self.output.flush()
+    self.buffer[:self.count] = 0
+    self.count = 0
+
+  def checkpoint(self):
+    """ Flushes, returns the file offset and round counter a resumed run
+    continues from """
+    self.flush()
+    return self.output.tell(), self.rounds
+
+  def resume(self, offset, rounds):
+    """ Drops what was written after the checkpoint at offset """
+    self.flush()
+    self.output.truncate(offset)
+    self.output.seek(offset)
+    self.rounds = rounds
+
+  def close(self):
+    self.flush()
+    self.output.close()
+
+def read_metrics(filename):
+  """ Returns the records of a metrics file as a structured array """
+  f = open(filename, "rb")
+  magic = f.read(len(MAGIC))
+  if magic == MAGIC:
+    records = numpy.fromfile(f, dtype=RECORD)
+    f.close()
+    return records
+  f.close()
+  return numpy.atleast_1d(numpy.genfromtxt(filename, delimiter=",",
+      names=True, dtype=RECORD))
@@ -0,0 +1,93 @@
+#!/usr/bin/python2
+
+"""
+Several AnonymitySimulator runs driven by a single pass over the events
+
+Runs that share round_time_span and start_time see the same rounds, so the
+events are decoded, replayed up to the start and grouped into rounds once,
+then every round is handed to each simulator in turn.  Only the policy
+specific state, the anonymity sets, ranks and message queues, is kept per
+run.  The online state of the clients is a single OnlineTracker shared by
+every simulator: each round is turned into one RoundDelta, whose joins are
+applied once before the simulators handle it.  Its quits are applied one at
+a time with every simulator handling each in turn, as the splitting policies
+read the online times of the other clients while handling a quit.
+
+A run that raises is dropped from the following rounds, the others carry on.
+"""
+
+import logging
+import time
+import traceback
+from anon_sim import create_simulator, OnlineTracker, round_batches, \
+    RoundDelta
+
+class Multiplexer:
+  """ Simulates every (policy, params) of runs over one event stream """
+  def __init__(self, total, events, runs):
+    self.round_time_span = 2.0
+    self.start_time = 0
+    if len(runs) > 0:
+      self.round_time_span = runs[0][1].get("round_time_span", 2.0)
+      self.start_time = runs[0][1].get("start_time", 0)
+    for policy, params in runs:
+      if params.get("round_time_span", 2.0) != self.round_time_span or \
+          params.get("start_time", 0) != self.start_time:
+        raise ValueError("Multiplexed runs must share round_time_span and "
+            "start_time")
+
+    self.tracker = OnlineTracker(total)
+    self.events = self.tracker.replay(events, self.start_time,
+        self.round_time_span)
+
+    self.sims = [None] * len(runs)
+    self.errors = [None] * len(runs)
+    # Seconds spent in each simulator
+    self.times = [0.0] * len(runs)
+    for idx, (policy, params) in enumerate(runs):
+      start = time.time()
+      try:
+        # Bootstrapped from the tracker rather than from the events
+        self.sims[idx] = create_simulator(policy, total, (), **params)
+        self.sims[idx].set_online_state(self.tracker)
+      except Exception, e:
+        self.fail(idx, e)
+      self.times[idx] += time.time() - start
+
+  def fail(self, idx, e):
+    logging.debug(traceback.format_exc())
+    self.sims[idx] = None
+    self.errors[idx] = e
+
+  def step(self, idx, method, *args):
+    """ Calls a method of a live simulator, dropping it if it raises """
+    start = time.time()
+    try:
+      getattr(self.sims[idx], method)(*args)
+    except Exception, e:
+      self.fail(idx, e)
+    self.times[idx] += time.time() - start
+
+  def live(self):
+    return [idx for idx, sim in enumerate(self.sims) if sim is not None]
+
+  def run(self):
+    """ Simulates every run, the simulators are left in self.sims, None
+    for the runs that failed, whose exception is in self.errors """
+    for idx in self.live():
+      self.step(idx, "prepare")
+    for round_time, batch in round_batches(self.events,
+        self.round_time_span):
+      # As AnonymitySimulator.process_round, the tracker updated once
+      delta = RoundDelta(batch)
+      self.tracker.apply_joins(delta)
+      for idx in self.live():
+        self.step(idx, "start_round", round_time, delta)
+      for uid, etime in delta.quits:
+        self.tracker.quit(etime, uid)
+        for idx in self.live():
+          self.step(idx, "on_quit", etime, uid)
+      for idx in self.live():
+        self.step(idx, "end_round", round_time)
+    for idx in self.live():
+      self.step(idx, "finish")
@@ -0,0 +1,135 @@
+#!/usr/bin/python2
+
+"""
+Phase profiling of the AnonymitySimulator
+
+Profiler.attach wraps the hot methods of a single simulator instance with
+timers, so an unprofiled simulator runs its methods untouched and pays
+nothing.  Times are inclusive, check_min_anon is also counted in on_msg for
+example.  Phases:
+  intake - reading events from the data set
+  rank_update - update_ranks
+  on_join, on_quit, on_msg, check_min_anon - the event handlers
+  retry - picking delayed messages to retry
+  round_keeper - Round_Keeper bookkeeping of the splitting policies
+  round - end of round work (metrics, checkpoints), counts rounds
+  analysis - the post-run attack
+"""
+
+import cProfile
+import time
+
+class Profiler:
+  """ Accumulates calls and wall time per phase """
+  def __init__(self, dump = None):
+    self.phases = {}
+    self.order = []
+    self.dump = dump
+    self.cprofile = None
+    self.started = None
+    self.elapsed = 0.0
+
+  def phase(self, name):
+    if name not in self.phases:
+      self.phases[name] = [0, 0.0]
+      self.order.append(name)
+    return self.phases[name]
+
+  def attach(self, sim):
+    """ Instruments the simulator, call after it is fully set up """
+    for name, phase in [("update_ranks", "rank_update"),
+        ("on_join", "on_join"), ("on_quit", "on_quit"),
+        ("on_msg", "on_msg"), ("check_min_anon", "check_min_anon"),
+        ("end_round", "round")]:
+      setattr(sim, name, self.timed(getattr(sim, name), phase))
+
+    delayed_msgs = getattr(sim, "delayed_msgs", None)
+    if delayed_msgs is not None:
+      delayed_msgs.retry = self.timed_generator(delayed_msgs.retry, "retry")
+
+    round_keeper = getattr(sim, "round_keeper", None)
+    if round_keeper is not None:
+      for name in dir(round_keeper):
+        method = getattr(round_keeper, name)
+        if not name.startswith("_") and callable(method) and \
+            hasattr(method, "im_self"):
+          setattr(round_keeper, name, self.timed(method, "round_keeper"))
+
+    sim.events = self.timed_iterator(sim.events, "intake")
+
+  def timed(self, function, name):
+    phase = self.phase(name)
+    def wrapper(*args, **kwargs):
+      start = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        phase[0] += 1
+        phase[1] += time.time() - start
+    return wrapper
+
+  def timed_generator(self, function, name):
+    """ Times a generator function, only the time spent inside it """
+    phase = self.phase(name)
+    def wrapper(*args, **kwargs):
+      phase[0] += 1
+      return self.iterate(function(*args, **kwargs), phase)
+    return wrapper
+
+  def timed_iterator(self, iterable, name):
+    """ Times every item drawn from the iterable, counting items """
+    phase = self.phase(name)
+    def counted():
+      iterator = iter(iterable)
+      while True:
+        start = time.time()
+        try:
+          item = next(iterator)
+        except StopIteration:
+          phase[1] += time.time() - start
+          return
+        phase[0] += 1
+        phase[1] += time.time() - start
+        yield item
+    return counted()
+
+  def iterate(self, iterator, phase):
+    while True:
+      start = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        phase[1] += time.time() - start
+        return
+      phase[1] += time.time() - start
+      yield item
+
+  def start(self):
+    if self.dump:
+      self.cprofile = cProfile.Profile()
+      self.cprofile.enable()
+    self.started = time.time()
+
+  def stop(self):
+    self.elapsed += time.time() - self.started
+    if self.cprofile is not None:
+      self.cprofile.disable()
+      self.cprofile.dump_stats(self.dump)
+      self.cprofile = None
+
+  def report(self):
+    """ Returns the report lines """
+    lines = ["Profile: %s %s %s %s" % ("phase".ljust(16), "calls".rjust(10),
+        "seconds".rjust(12), "us/call".rjust(10))]
+    for name in self.order:
+      calls, seconds = self.phases[name]
+      per_call = seconds * 1e6 / calls if calls > 0 else 0.0
+      lines.append("Profile: %s %10d %12.6f %10.2f" % (name.ljust(16), calls,
+          seconds, per_call))
+    elapsed = self.elapsed if self.elapsed > 0 else float("inf")
+    lines.append("Profile: run time %f" % (self.elapsed, ))
+    lines.append("Profile: events/sec %f" % \
+        (self.phase("intake")[0] / elapsed, ))
+    lines.append("Profile: rounds/sec %f" % \
+        (self.phase("round")[0] / elapsed, ))
+    return lines
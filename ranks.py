@@ -0,0 +1,554 @@
+#!/usr/bin/python2
+
+"""
+Rank accounting for the AnonymitySimulator
+
+A pseudonym's client_rank[cuid] counts the rounds in which the pseudonym did
+not deliver a message while cuid was offline and still in its anonymity set,
+client_subrank[cuid] counts the subset of those rounds where the client itself
+(and not just its group) was offline.
+
+Three engines are available, all exposing the same dict-like views:
+  matrix - RankMatrix, accumulates the ranks round by round
+  interval - RankIntervals, records offline intervals and delivered rounds
+    and derives the ranks by interval arithmetic when they are read
+  group - GroupRanks, for the splitting policies over a GroupAnonymitySets,
+    accumulates client_rank per group rather than per client
+
+matrix costs 17 bytes per pseudonym x client cell on top of the membership
+matrix of the anonymity sets: two float64 matrices and a bool scratch one,
+6.8GB at 20000 clients with a pseudonym each.  interval keeps memory in
+proportion to the events instead and gives the same ranks, up to floating
+point rounding.  The auto rank mode picks matrix up to MATRIX_CELLS cells
+and interval above.
+"""
+
+import numpy
+from checkpoint import pack_lists, unpack_lists
+
+class RankMatrix:
+  """ Accumulates client_rank and client_subrank of every pseudonym in
+  pseudonym x client matrices, one masked add per round """
+  def __init__(self, anonymity_sets):
+    shape = anonymity_sets.members.shape
+    self.anonymity_sets = anonymity_sets
+    self.rank = numpy.zeros(shape)
+    self.subrank = numpy.zeros(shape)
+    self.scratch = numpy.empty(shape, dtype=numpy.bool_)
+
+  def add_rounds(self, rounds, delivered, member_offline, client_offline):
+    """ Adds rounds to every offline member of the anonymity set of each
+    nym not in delivered """
+    scratch = self.scratch
+    numpy.logical_and(self.anonymity_sets.members, member_offline, out=scratch)
+    if len(delivered) > 0:
+      scratch[list(delivered)] = False
+    numpy.add(self.rank, rounds, out=self.rank, where=scratch)
+    scratch &= client_offline
+    numpy.add(self.subrank, rounds, out=self.subrank, where=scratch)
+
+  def changed(self, uid, member_online, client_online):
+    """ Ranks are derived from the offline masks on every round """
+    pass
+
+  def removed(self, nym, cuids):
+    """ Removed clients are masked out of the following rounds """
+    pass
+
+  def rank_rows(self, nyms):
+    """ client_rank of all clients for each of the nyms """
+    return self.rank[nyms]
+
+  def get_state(self):
+    return {"rank" : self.rank, "subrank" : self.subrank}
+
+  def set_state(self, state):
+    self.rank[:] = state["rank"]
+    self.subrank[:] = state["subrank"]
+
+  def rank_view(self, nym):
+    return RankView(self.rank, nym, self.anonymity_sets)
+
+  def subrank_view(self, nym):
+    return RankView(self.subrank, nym, None, self.rank.shape[1])
+
+class RankIntervals:
+  """ Records each client's offline intervals, each pseudonym's delivered
+  rounds and each removal from an anonymity set on a round clock, ranks are
+  computed from those when they are read.  The cost while simulating is
+  proportional to the number of join, quit and msg events instead of
+  rounds x pseudonyms x clients. """
+  def __init__(self, anonymity_sets):
+    self.anonymity_sets = anonymity_sets
+    anonymity_sets.listeners.append(self)
+    total_pseudonyms, total_clients = anonymity_sets.members.shape
+    self.total_clients = total_clients
+    self.clock = 0.0
+    self.started = False
+    # Rounds in which the client counts as offline for client_rank and
+    # for client_subrank
+    self.member_offline = RankIntervals.Intervals(self, total_clients)
+    self.sub_offline = RankIntervals.Intervals(self, total_clients)
+    self.delivered = [[] for nym in range(total_pseudonyms)]
+    self.removals = [[] for nym in range(total_pseudonyms)]
+    self.version = 0
+    self.cache = {}
+
+  def add_rounds(self, rounds, delivered, member_offline, client_offline):
+    """ Advances the round clock, delivered nyms are exempt from the first
+    round """
+    if not self.started:
+      # Anything before the first round does not contribute to the ranks
+      self.started = True
+      for uid in numpy.flatnonzero(member_offline).tolist():
+        self.member_offline.flip(uid, True)
+      for uid in numpy.flatnonzero(member_offline & client_offline).tolist():
+        self.sub_offline.flip(uid, True)
+    for nym in delivered:
+      self.delivered[nym].append(self.clock)
+    self.clock += rounds
+    self.version += 1
+
+  def changed(self, uid, member_online, client_online):
+    """ Records a change in the online state of uid """
+    if not self.started:
+      return
+    self.member_offline.flip(uid, not member_online)
+    self.sub_offline.flip(uid, not member_online and not client_online)
+    self.version += 1
+
+  def removed(self, nym, cuids):
+    """ Freezes client_subrank for clients removed from the nym """
+    self.removals[nym].append((self.clock, cuids))
+    self.version += 1
+
+  def rank_rows(self, nyms):
+    """ client_rank of all clients for each of the nyms """
+    rows = numpy.zeros((len(nyms), self.total_clients))
+    for idx, nym in enumerate(nyms):
+      rows[idx] = self.row(nym, False)
+    return rows
+
+  def get_state(self):
+    """ The recorded intervals, rounds and removals as a dict of arrays """
+    state = {
+        "clock" : numpy.array(self.clock),
+        "started" : numpy.array(self.started),
+        }
+    for name, intervals in [("member", self.member_offline),
+        ("sub", self.sub_offline)]:
+      for key, value in intervals.get_state().items():
+        state[name + "_" + key] = value
+    state["delivered"], state["delivered_offsets"] = \
+        pack_lists(self.delivered, numpy.float64)
+
+    removals = [(nym, clock, cuids) for nym in range(len(self.removals)) \
+        for clock, cuids in self.removals[nym]]
+    state["removal_nyms"] = numpy.array([r[0] for r in removals],
+        dtype=numpy.int64)
+    state["removal_clocks"] = numpy.array([r[1] for r in removals],
+        dtype=numpy.float64)
+    state["removal_cuids"], state["removal_offsets"] = \
+        pack_lists([list(r[2]) for r in removals])
+    return state
+
+  def set_state(self, state):
+    self.clock = float(state["clock"])
+    self.started = bool(state["started"])
+    self.member_offline.set_state(state, "member_")
+    self.sub_offline.set_state(state, "sub_")
+    self.delivered = unpack_lists(state["delivered"],
+        state["delivered_offsets"])
+
+    self.removals = [[] for nym in range(len(self.removals))]
+    cuids = unpack_lists(state["removal_cuids"], state["removal_offsets"])
+    for nym, clock, removed in zip(state["removal_nyms"].tolist(),
+        state["removal_clocks"].tolist(), cuids):
+      self.removals[nym].append((clock, numpy.array(removed,
+          dtype=numpy.int64)))
+    self.version += 1
+
+  def rank_view(self, nym):
+    return RankView(RankIntervals.Rows(self, False), nym,
+        self.anonymity_sets)
+
+  def subrank_view(self, nym):
+    return RankView(RankIntervals.Rows(self, True), nym, None,
+        self.total_clients)
+
+  def row(self, nym, sub):
+    """ client_rank (or client_subrank) of all clients for the nym """
+    if self.version != self.cache.get("version"):
+      self.cache = {"version": self.version}
+    key = (nym, sub)
+    if key in self.cache:
+      return self.cache[key]
+
+    intervals = self.sub_offline if sub else self.member_offline
+    if intervals not in self.cache:
+      self.cache[intervals] = intervals.arrays()
+    starts, ends, owners = self.cache[intervals]
+
+    delivered = numpy.array(self.delivered[nym])
+    until = None
+    if sub and len(self.removals[nym]) > 0:
+      # client_subrank stops accumulating once a client is removed
+      until = numpy.empty(self.total_clients)
+      until.fill(self.clock)
+      for clock, cuids in self.removals[nym]:
+        until[cuids] = numpy.minimum(until[cuids], clock)
+
+    row = offline_rounds(starts, ends, owners, delivered, until,
+        self.total_clients)
+    self.cache[key] = row
+    return row
+
+  class Intervals:
+    """ Half-open [start, end) offline intervals on the round clock """
+    def __init__(self, keeper, total):
+      self.keeper = keeper
+      self.since = [None] * total
+      self.starts = []
+      self.ends = []
+      self.owners = []
+
+    def flip(self, uid, offline):
+      since = self.since[uid]
+      if offline and since is None:
+        self.since[uid] = self.keeper.clock
+      elif not offline and since is not None:
+        if since < self.keeper.clock:
+          self.starts.append(since)
+          self.ends.append(self.keeper.clock)
+          self.owners.append(uid)
+        self.since[uid] = None
+
+    def get_state(self):
+      since = numpy.array([numpy.nan if since is None else since \
+          for since in self.since], dtype=numpy.float64)
+      starts, ends, owners = self.arrays()
+      closed = len(self.starts)
+      return {"since" : since, "starts" : starts[:closed],
+          "ends" : ends[:closed], "owners" : owners[:closed]}
+
+    def set_state(self, state, prefix):
+      self.since = [None if numpy.isnan(since) else since \
+          for since in state[prefix + "since"].tolist()]
+      self.starts = state[prefix + "starts"].tolist()
+      self.ends = state[prefix + "ends"].tolist()
+      self.owners = state[prefix + "owners"].tolist()
+
+    def arrays(self):
+      """ starts, ends and owners of all intervals, open intervals end at
+      the current clock """
+      starts = list(self.starts)
+      ends = list(self.ends)
+      owners = list(self.owners)
+      for uid, since in enumerate(self.since):
+        if since is not None:
+          starts.append(since)
+          ends.append(self.keeper.clock)
+          owners.append(uid)
+      return numpy.array(starts, dtype=numpy.float64), \
+          numpy.array(ends, dtype=numpy.float64), \
+          numpy.array(owners, dtype=numpy.int64)
+
+  class Rows:
+    """ Row access into the ranks computed by a RankIntervals """
+    def __init__(self, keeper, sub):
+      self.keeper = keeper
+      self.sub = sub
+
+    def __getitem__(self, nym):
+      return self.keeper.row(nym, self.sub)
+
+class GroupRanks:
+  """ Ranks over a GroupAnonymitySets.  client_rank is accumulated per
+  column, one masked add per round over pseudonyms x columns, member_offline
+  being the same for every client of a column.  client_subrank depends on
+  each client's own online state and is derived from offline intervals as
+  in RankIntervals.  Rows are expanded to clients when read. """
+  def __init__(self, anonymity_sets):
+    self.anonymity_sets = anonymity_sets
+    anonymity_sets.listeners.append(self)
+    total_pseudonyms, capacity = anonymity_sets.group_members.shape
+    total_clients = len(anonymity_sets.column)
+    self.total_clients = total_clients
+    self.rank = numpy.zeros((total_pseudonyms, capacity))
+    self.scratch = numpy.empty((total_pseudonyms, capacity),
+        dtype=numpy.bool_)
+    self.clock = 0.0
+    self.started = False
+    self.sub_offline = RankIntervals.Intervals(self, total_clients)
+    self.delivered = [[] for nym in range(total_pseudonyms)]
+    # Columns removed from each nym as (stamp, clock, columns), along with
+    # the stamps between which each client was in a column, which tell the
+    # clients a removal applied to
+    self.stamp = 0
+    self.removals = [[] for nym in range(total_pseudonyms)]
+    self.since = numpy.zeros(total_clients, dtype=numpy.int64)
+    self.segment_owners = []
+    self.segment_columns = []
+    self.segment_starts = []
+    self.segment_ends = []
+    self.version = 0
+    self.cache = {}
+
+  def fit(self):
+    """ Follows the column capacity of the sets """
+    total_pseudonyms, capacity = self.anonymity_sets.group_members.shape
+    if capacity == self.rank.shape[1]:
+      return
+    rank = numpy.zeros((total_pseudonyms, capacity))
+    rank[:, :self.rank.shape[1]] = self.rank
+    self.rank = rank
+    self.scratch = numpy.empty((total_pseudonyms, capacity),
+        dtype=numpy.bool_)
+
+  def add_rounds(self, rounds, delivered, member_offline, client_offline):
+    """ Adds rounds to every offline column of the anonymity set of each
+    nym not in delivered and advances the round clock """
+    sets = self.anonymity_sets
+    if not self.started:
+      # Anything before the first round does not contribute to the ranks
+      self.started = True
+      for uid in numpy.flatnonzero(member_offline & client_offline).tolist():
+        self.sub_offline.flip(uid, True)
+    columns = sets.columns
+    scratch = self.scratch[:, :columns]
+    numpy.logical_and(sets.group_members[:, :columns],
+        member_offline[sets.representative[:columns]], out=scratch)
+    if len(delivered) > 0:
+      scratch[list(delivered)] = False
+    rank = self.rank[:, :columns]
+    numpy.add(rank, rounds, out=rank, where=scratch)
+    for nym in delivered:
+      self.delivered[nym].append(self.clock)
+    self.clock += rounds
+    self.version += 1
+
+  def changed(self, uid, member_online, client_online):
+    """ Records a change in the online state of uid """
+    if not self.started:
+      return
+    self.sub_offline.flip(uid, not member_online and not client_online)
+    self.version += 1
+
+  def removed(self, nym, columns):
+    """ Freezes client_subrank for the clients of the removed columns """
+    self.stamp += 1
+    self.removals[nym].append((self.stamp, self.clock, columns))
+    self.version += 1
+
+  def separated(self, src, dst, cuids):
+    """ The clients in cuids moved from column src to its copy dst """
+    self.fit()
+    self.rank[:, dst] = self.rank[:, src]
+    self.stamp += 1
+    self.segment_owners.extend(cuids.tolist())
+    self.segment_columns.extend([src] * len(cuids))
+    self.segment_starts.extend(self.since[cuids].tolist())
+    self.segment_ends.extend([self.stamp] * len(cuids))
+    self.since[cuids] = self.stamp
+    self.version += 1
+
+  def rank_rows(self, nyms):
+    """ client_rank of all clients for each of the nyms """
+    return self.rank[nyms][..., self.anonymity_sets.column]
+
+  def get_state(self):
+    """ The ranks, intervals and removals as a dict of arrays """
+    state = {
+        "rank" : self.rank[:, :self.anonymity_sets.columns],
+        "clock" : numpy.array(self.clock),
+        "started" : numpy.array(self.started),
+        "stamp" : numpy.array(self.stamp),
+        "since" : self.since,
+        }
+    for key, value in self.sub_offline.get_state().items():
+      state["sub_" + key] = value
+    state["delivered"], state["delivered_offsets"] = \
+        pack_lists(self.delivered, numpy.float64)
+    for name in ["owners", "columns", "starts", "ends"]:
+      state["segment_" + name] = numpy.array(getattr(self,
+          "segment_" + name), dtype=numpy.int64)
+
+    removals = [(nym, stamp, clock, columns) \
+        for nym in range(len(self.removals)) \
+        for stamp, clock, columns in self.removals[nym]]
+    state["removal_nyms"] = numpy.array([r[0] for r in removals],
+        dtype=numpy.int64)
+    state["removal_stamps"] = numpy.array([r[1] for r in removals],
+        dtype=numpy.int64)
+    state["removal_clocks"] = numpy.array([r[2] for r in removals],
+        dtype=numpy.float64)
+    state["removal_columns"], state["removal_offsets"] = \
+        pack_lists([list(r[3]) for r in removals])
+    return state
+
+  def set_state(self, state):
+    self.fit()
+    columns = state["rank"].shape[1]
+    self.rank[:, :columns] = state["rank"]
+    self.clock = float(state["clock"])
+    self.started = bool(state["started"])
+    self.stamp = int(state["stamp"])
+    self.since[:] = state["since"]
+    self.sub_offline.set_state(state, "sub_")
+    self.delivered = unpack_lists(state["delivered"],
+        state["delivered_offsets"])
+    for name in ["owners", "columns", "starts", "ends"]:
+      setattr(self, "segment_" + name, state["segment_" + name].tolist())
+
+    self.removals = [[] for nym in range(len(self.removals))]
+    removed = unpack_lists(state["removal_columns"], state["removal_offsets"])
+    for nym, stamp, clock, columns in zip(state["removal_nyms"].tolist(),
+        state["removal_stamps"].tolist(), state["removal_clocks"].tolist(),
+        removed):
+      self.removals[nym].append((stamp, clock, numpy.array(columns,
+          dtype=numpy.int64)))
+    self.version += 1
+
+  def rank_view(self, nym):
+    return RankView(RankIntervals.Rows(self, False), nym,
+        self.anonymity_sets)
+
+  def subrank_view(self, nym):
+    return RankView(RankIntervals.Rows(self, True), nym, None,
+        self.total_clients)
+
+  def row(self, nym, sub):
+    """ client_rank (or client_subrank) of all clients for the nym """
+    if self.version != self.cache.get("version"):
+      self.cache = {"version": self.version}
+    key = (nym, sub)
+    if key in self.cache:
+      return self.cache[key]
+
+    if not sub:
+      row = self.rank[nym][self.anonymity_sets.column]
+    else:
+      if "intervals" not in self.cache:
+        self.cache["intervals"] = self.sub_offline.arrays()
+      starts, ends, owners = self.cache["intervals"]
+      row = offline_rounds(starts, ends, owners,
+          numpy.array(self.delivered[nym]), self.removed_until(nym),
+          self.total_clients)
+    self.cache[key] = row
+    return row
+
+  def removed_until(self, nym):
+    """ The clock at which each client was removed from the nym, the
+    current clock for members, None if nothing was removed """
+    if len(self.removals[nym]) == 0:
+      return None
+    columns = self.anonymity_sets.columns
+    stamps = numpy.zeros(columns, dtype=numpy.int64)
+    clocks = numpy.zeros(columns)
+    for stamp, clock, removed in self.removals[nym]:
+      stamps[removed] = stamp
+      clocks[removed] = clock
+
+    if "segments" not in self.cache:
+      # Closed segments followed by the current column of every client
+      self.cache["segments"] = (
+          numpy.array(self.segment_owners + range(self.total_clients),
+              dtype=numpy.int64),
+          numpy.concatenate([numpy.array(self.segment_columns,
+              dtype=numpy.int64), self.anonymity_sets.column]),
+          numpy.concatenate([numpy.array(self.segment_starts,
+              dtype=numpy.int64), self.since]),
+          numpy.concatenate([numpy.array(self.segment_ends,
+              dtype=numpy.int64), numpy.repeat(self.stamp + 1,
+              self.total_clients)]))
+    owners, segment_columns, starts, ends = self.cache["segments"]
+    removal = stamps[segment_columns]
+    hit = (removal > starts) & (removal < ends)
+    until = numpy.empty(self.total_clients)
+    until.fill(self.clock)
+    numpy.minimum.at(until, owners[hit], clocks[segment_columns[hit]])
+    return until
+
+def offline_rounds(starts, ends, owners, delivered, until, total_clients):
+  """ Rounds of the [start, end) offline intervals of each owner, cut at
+  until[owner] when given, leaving out the delivered rounds """
+  if until is not None:
+    ends = numpy.minimum(ends, until[owners])
+    starts = numpy.minimum(starts, ends)
+  rounds = ends - starts
+  if len(delivered) > 0:
+    rounds -= numpy.searchsorted(delivered, ends) - \
+        numpy.searchsorted(delivered, starts)
+  return numpy.bincount(owners, weights=rounds, minlength=total_clients)
+
+RANK_ENGINES = {
+    "matrix" : RankMatrix,
+    "interval" : RankIntervals,
+    "group" : GroupRanks,
+    }
+
+RANK_MODES = ["auto"] + sorted(RANK_ENGINES.keys())
+
+# The most pseudonym x client cells the auto rank mode accounts in matrices,
+# about 570MB of them
+MATRIX_CELLS = 1 << 25
+
+def resolve_rank_mode(rank_mode, total_pseudonyms, total_clients):
+  """ The engine a rank mode stands for, auto being matrix up to
+  MATRIX_CELLS cells and interval above """
+  if rank_mode != "auto":
+    return rank_mode
+  if total_pseudonyms * total_clients <= MATRIX_CELLS:
+    return "matrix"
+  return "interval"
+
+class RankView:
+  """ Read-only, dict-like view of a single pseudonym's ranks, values[nym]
+  must return the ranks of all clients.  If anonymity_sets is given only
+  members of the nym's anonymity set are visible. """
+  def __init__(self, values, nym, anonymity_sets = None, total_clients = 0):
+    self.values = values
+    self.nym = nym
+    self.anonymity_sets = anonymity_sets
+    if anonymity_sets is not None:
+      total_clients = len(anonymity_sets.client_sizes)
+    self.total_clients = total_clients
+
+  def __contains__(self, cuid):
+    if cuid < 0 or cuid >= self.total_clients:
+      return False
+    if self.anonymity_sets is None:
+      return True
+    return bool(self.anonymity_sets.members[self.nym, cuid])
+
+  def __getitem__(self, cuid):
+    if cuid not in self:
+      raise KeyError(cuid)
+    return float(self.values[self.nym][cuid])
+
+  def __len__(self):
+    if self.anonymity_sets is None:
+      return self.total_clients
+    return int(self.anonymity_sets.pseudonym_sizes[self.nym])
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def keys(self):
+    if self.anonymity_sets is None:
+      return range(self.total_clients)
+    return numpy.flatnonzero(self.anonymity_sets.members[self.nym]).tolist()
+
+  def values_array(self):
+    """ The ranks of keys() as an array """
+    if self.anonymity_sets is None:
+      return self.values[self.nym]
+    return self.values[self.nym][self.anonymity_sets.members[self.nym]]
+
+  def items(self):
+    return zip(self.keys(), self.values_array().tolist())
+
+  def get(self, cuid, default = None):
+    if cuid not in self:
+      return default
+    return self[cuid]
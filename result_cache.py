@@ -0,0 +1,185 @@
+#!/usr/bin/python2
+
+"""
+On disk cache of AnonymitySimulator results, along with the snapshots of
+the online state at the start of a simulation, which are kept apart in the
+snapshots subdirectory so that either is bounded on its own
+
+A result is stored as an uncompressed numpy archive (.npz) of plain arrays
+named after the hash of the data set contents and of every parameter of the
+run, so rerunning an identical simulation reads it back instead, whatever
+the path of the data set.  Hashing a data set reads it whole, the hash is
+remembered along with the size and modification time of the file and only
+recomputed once either changes.
+
+The cache is bounded by the total size of its entries, the least recently
+used entries are evicted first.  Use refreshes the modification time of an
+entry, which is what eviction orders by.
+
+The sources of the modules that determine the results are hashed into every
+key as well, so editing the simulator leaves the entries of the old code to
+age out instead of reading them back.  Bump CACHE_VERSION whenever what is
+stored in an entry changes.
+"""
+
+import hashlib
+import json
+import numpy
+import os
+
+CACHE_VERSION = 1
+ENTRY_SUFFIX = ".npz"
+DATASETS = "datasets.json"
+SNAPSHOTS = "snapshots"
+CHUNK = 1 << 20
+# The modules, next to this one, whose code determines the cached results
+SOURCES = ["anon_sim.py", "anonymity_sets.py", "attack_analysis.py",
+    "columnar_dataset.py", "delays.py", "extended_rounds.py", "ranks.py"]
+
+_source_hash = None
+
+def source_hash():
+  """ Hash of the sources of the simulator, computed once per process """
+  global _source_hash
+  if _source_hash is None:
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for name in SOURCES:
+      f = open(os.path.join(directory, name), "rb")
+      try:
+        digest.update(name + "\0" + f.read())
+      finally:
+        f.close()
+    _source_hash = digest.hexdigest()
+  return _source_hash
+
+class ResultCache:
+  """ Results by key, in directory, at most max_bytes in total.  The hashes
+  of the data sets are remembered in the datasets file, by default in
+  directory. """
+  def __init__(self, directory, max_bytes, datasets = None):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.datasets = datasets if datasets is not None else \
+        os.path.join(directory, DATASETS)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def subcache(self, name, max_bytes):
+    """ A cache in the subdirectory name, bounded apart from this one but
+    sharing its data set hashes """
+    return ResultCache(os.path.join(self.directory, name), max_bytes,
+        self.datasets)
+
+  def key(self, dataset, params):
+    """ Key of a run over the dataset file, params being (name, value)
+    pairs """
+    digest = hashlib.sha1()
+    digest.update(repr((CACHE_VERSION, source_hash(),
+        self.dataset_hash(dataset), sorted(params))))
+    return digest.hexdigest()
+
+  def dataset_hash(self, filename):
+    """ Hash of the contents of a data set file """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    known = self.read_datasets()
+    if path in known and known[path][:2] == [stat.st_size, stat.st_mtime]:
+      # As a str, like hexdigest, rather than the unicode json reads
+      return str(known[path][2])
+
+    digest = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+      while True:
+        chunk = f.read(CHUNK)
+        if not chunk:
+          break
+        digest.update(chunk)
+    finally:
+      f.close()
+    # Re-read in case another run added a data set meanwhile
+    known = self.read_datasets()
+    known[path] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+    self.replace(self.datasets, lambda output: json.dump(known, output))
+    return digest.hexdigest()
+
+  def read_datasets(self):
+    try:
+      f = open(self.datasets, "r")
+    except IOError:
+      return {}
+    try:
+      return json.load(f)
+    except ValueError:
+      return {}
+    finally:
+      f.close()
+
+  def path(self, key):
+    return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+  def get(self, key):
+    """ The arrays stored under key as a dict, None if there are none """
+    path = self.path(key)
+    if not os.path.exists(path):
+      return None
+    try:
+      archive = numpy.load(path)
+      arrays = dict((name, archive[name]) for name in archive.files)
+      archive.close()
+    except Exception:
+      # Unreadable, as good as missing
+      self.remove(path)
+      return None
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    return arrays
+
+  def put(self, key, arrays):
+    """ Stores the dict of arrays under key, then evicts down to size """
+    self.replace(self.path(key),
+        lambda output: numpy.savez(output, **arrays))
+    self.evict()
+
+  def replace(self, filename, write):
+    """ Atomically replaces filename with what write puts in the file """
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    output = open(tmp, "wb")
+    try:
+      write(output)
+    finally:
+      output.close()
+    os.rename(tmp, filename)
+
+  def entries(self):
+    """ (modification time, size, path) of every entry """
+    entries = []
+    for name in os.listdir(self.directory):
+      if not name.endswith(ENTRY_SUFFIX):
+        continue
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+  def evict(self):
+    """ Removes the least recently used entries until the cache fits """
+    entries = self.entries()
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      self.remove(path)
+      total -= size
+
+  def remove(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
@@ -0,0 +1,121 @@
+#!/usr/bin/python2
+
+"""
+Compact results of an AnonymitySimulator run
+
+Results are written as an uncompressed numpy archive (.npz) of typed arrays:
+  config - the simulation parameters
+  on_time, lost - delivered and lost message counts
+  delays - count, average, standard deviation, p50, p90, p99 and max of the
+    delays
+  delayed_times - the delay of every delayed message, only if the
+    simulator kept them
+  pseudonym_sizes, client_sizes - final anonymity set sizes
+  own_rank - each pseudonym's client_rank of its own client, the client
+    sharing its uid
+  rank - the full pseudonym x client client_rank matrix, or
+  top_clients, top_ranks - the top_k members of each pseudonym's anonymity
+    set by client_rank, -1 / 0 padded
+  online_time - each client's total online time
+
+Because the archive is stored uncompressed, load_results memory maps every
+array in place instead of reading it.
+"""
+
+import io
+import numpy
+import struct
+import zipfile
+
+# Rank rows computed at once when extracting the top ranks
+CHUNK = 1024
+
+def write_results(filename, sim, config = "", top_k = 0):
+  """ Writes the results of a finished simulation, top_k > 0 keeps only the
+  top_k ranks of each pseudonym instead of the whole rank matrix """
+  sets = sim.anonymity_sets
+  total_pseudonyms, total_clients = sets.members.shape
+  arrays = {
+      "config" : numpy.array(config),
+      "on_time" : numpy.array(sim.on_time),
+      "lost" : numpy.array(len(sim.lost_messages)),
+      "delays" : numpy.array([value for name, value in sim.delays.summary()],
+          dtype=numpy.float64),
+      "pseudonym_sizes" : sets.pseudonym_sizes,
+      "client_sizes" : sets.client_sizes,
+      "online_time" : numpy.array([client.get_online_time() \
+          for client in sim.clients], dtype=numpy.float64),
+      }
+  if sim.delayed_times is not None:
+    arrays["delayed_times"] = numpy.array(sim.delayed_times,
+        dtype=numpy.float64)
+
+  own_rank = numpy.zeros(total_pseudonyms)
+  if top_k > 0:
+    top_k = min(top_k, total_clients)
+    top_clients = numpy.empty((total_pseudonyms, top_k), dtype=numpy.int64)
+    top_ranks = numpy.zeros((total_pseudonyms, top_k))
+  else:
+    rank = numpy.zeros((total_pseudonyms, total_clients))
+
+  for start in range(0, total_pseudonyms, CHUNK):
+    nyms = numpy.arange(start, min(start + CHUNK, total_pseudonyms))
+    rows = sim.ranks.rank_rows(nyms)
+    # As in attack_analysis a pseudonym's own client shares its uid
+    owned = nyms[nyms < total_clients]
+    own_rank[owned] = rows[owned - start, owned]
+    if top_k <= 0:
+      rank[nyms] = rows
+      continue
+    # Rank of members only, highest first and lowest uid among equals
+    values = numpy.where(sets.members[nyms], rows, -numpy.inf)
+    order = numpy.argsort(-values, axis=1, kind="mergesort")[:, :top_k]
+    chosen = numpy.take_along_axis(values, order, axis=1)
+    top_clients[nyms] = numpy.where(numpy.isinf(chosen), -1, order)
+    top_ranks[nyms] = numpy.where(numpy.isinf(chosen), 0, chosen)
+
+  arrays["own_rank"] = own_rank
+  if top_k > 0:
+    arrays["top_clients"] = top_clients
+    arrays["top_ranks"] = top_ranks
+  else:
+    arrays["rank"] = rank
+
+  output = open(filename, "wb")
+  numpy.savez(output, **arrays)
+  output.close()
+
+def load_results(filename):
+  """ Returns the arrays of a results file as a dict, memory mapped """
+  archive = zipfile.ZipFile(filename)
+  f = open(filename, "rb")
+  arrays = {}
+  try:
+    for info in archive.infolist():
+      name = info.filename[:-len(".npy")]
+      if info.compress_type != zipfile.ZIP_STORED:
+        arrays[name] = numpy.load(io.BytesIO(archive.read(info)))
+        continue
+      # The data follows the local file header and its variable fields
+      f.seek(info.header_offset + 26)
+      name_length, extra_length = struct.unpack("<HH", f.read(4))
+      f.seek(info.header_offset + 30 + name_length + extra_length)
+      arrays[name] = map_array(filename, f)
+  finally:
+    f.close()
+    archive.close()
+  return arrays
+
+def map_array(filename, f):
+  """ Memory maps the .npy array starting at the current position of f """
+  start = f.tell()
+  version = numpy.lib.format.read_magic(f)
+  if version == (1, 0):
+    shape, fortran, dtype = numpy.lib.format.read_array_header_1_0(f)
+  else:
+    shape, fortran, dtype = numpy.lib.format.read_array_header_2_0(f)
+  if len(shape) == 0 or numpy.prod(shape) == 0:
+    f.seek(start)
+    return numpy.lib.format.read_array(f)
+  return numpy.memmap(filename, dtype=dtype, mode="r", offset=f.tell(),
+      shape=shape, order="F" if fortran else "C")
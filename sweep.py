@@ -0,0 +1,259 @@
+#!/usr/bin/python2
+
+"""
+Parameter sweeps for the AnonymitySimulator
+
+The data set is parsed once, then every combination of the grid is simulated
+over a pool of worker processes.  It is memory mapped in the columnar format,
+a pickled data set being converted into a temporary columnar file first, so
+the workers forked after parsing share its pages rather than each holding
+the events.
+With --multiplex=K, up to K runs that share round_time_span and start_time
+are simulated together by a worker in a single pass over the events, see
+multiplex.py, and the run_time of each is the time spent in its simulator.
+
+python2 sweep.py [--input=data] [--grid=min_anon=0,2,4] [--grid=...]
+                 [--grid_file=grid.json] [--processes=0] [--multiplex=1]
+                 [--output=sweep.tsv]
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+import anon_sim
+from columnar_dataset import is_columnar, read_pickle, write_columnar
+from multiplex import Multiplexer
+
+# Simulator knobs that can be swept, along with their type and default
+PARAMETERS = [
+    ("policy", str, "min_anon"),
+    ("min_anon", int, 0),
+    ("pseudonyms_per_client", int, 1),
+    ("round_time_span", float, 2.0),
+    ("start_time", float, 0.0),
+    ("trainer", str, None),
+    ("split_size", int, 1),
+    ("rank_mode", str, "auto"),
+    ]
+
+RESULTS = ["delivered", "delayed", "lost", "avg_delay", "std_delay",
+    "p50_delay", "p90_delay", "p99_delay", "max_delay", "run_time", "error"]
+
+# Set in the parent before the pool is created so forked workers inherit it
+_dataset = None
+
+def main():
+  parser = argparse.ArgumentParser(description="Runs the AnonymitySimulator "
+      "over a grid of parameters")
+  parser.add_argument("-i", "--input", default="data",
+      help="input dataset")
+  parser.add_argument("-e", "--end", type=float, default=-1,
+      help="specifies the end time for evaluation (default: all / -1)")
+  parser.add_argument("-g", "--grid", action="append", default=[],
+      help="a swept parameter and its comma separated values, "
+      "e.g. min_anon=0,2,4, may be repeated")
+  parser.add_argument("--grid_file", default=None,
+      help="JSON object mapping parameters to lists of values")
+  parser.add_argument("-j", "--processes", type=int, default=0,
+      help="worker processes (default: one per cpu / 0)")
+  parser.add_argument("-k", "--multiplex", type=int, default=1,
+      help="runs simulated together in one pass over the events "
+      "(default: 1)")
+  parser.add_argument("-o", "--output", default="sweep.tsv",
+      help="where the results table is written (default: sweep.tsv)")
+  parser.add_argument("-d", "--debug", dest="log_level", action="store_const",
+      const=logging.DEBUG, help="sets the logging level to 'debug'")
+  parser.add_argument("--info", dest="log_level", action="store_const",
+      const=logging.INFO, help="sets the logging level to 'info'")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=args.log_level)
+
+  grid = {}
+  if args.grid_file:
+    f = open(args.grid_file, "r")
+    grid.update(json.load(f))
+    f.close()
+  for spec in args.grid:
+    name, values = parse_spec(spec)
+    grid[name] = values
+
+  runs = expand(grid)
+  for params in runs:
+    error = anon_sim.rank_mode_error(params["policy"], params["rank_mode"])
+    if error is not None:
+      parser.error(error)
+
+  start = time.time()
+  converted = load(args.input, args.end)
+  try:
+    parse_time = time.time() - start
+    logging.info("Parsed %s events from %s in %fs" % \
+        (_dataset.dataset.length(args.end), args.input, parse_time))
+
+    results = sweep(runs, args.processes, args.multiplex)
+  finally:
+    if converted is not None:
+      os.remove(converted)
+  write_table(args.output, runs, results)
+  print "Parse time: %f" % (parse_time, )
+  print "Runs: %s" % (len(runs), )
+  print "Failed runs: %s" % (len([r for r in results if r["error"]]), )
+
+def parse_spec(spec):
+  """ Parses name=v1,v2,... into the parameter name and its typed values """
+  name, _, values = spec.partition("=")
+  types = dict((param, ptype) for param, ptype, default in PARAMETERS)
+  if name not in types:
+    raise ValueError("Unknown parameter: %s" % (name, ))
+  return name, [convert(types[name], value) for value in values.split(",")]
+
+def convert(ptype, value):
+  if value is None or value == "None":
+    return None
+  return ptype(value)
+
+def expand(grid):
+  """ Returns a dict of parameters for every combination in the grid """
+  types = dict((param, ptype) for param, ptype, default in PARAMETERS)
+  for name in grid:
+    if name not in types:
+      raise ValueError("Unknown parameter: %s" % (name, ))
+
+  names = [param for param, ptype, default in PARAMETERS]
+  values = []
+  for param, ptype, default in PARAMETERS:
+    values.append([convert(ptype, value) for value in grid[param]] \
+        if param in grid else [default])
+  return [dict(zip(names, combination)) \
+      for combination in itertools.product(*values)]
+
+def load(filename, end):
+  """ Opens the data set for the workers as a columnar DefaultParse.  A
+  pickled data set is converted up to end into a temporary file, whose name
+  is returned for the caller to remove, None if there is none. """
+  global _dataset
+  converted = None
+  if not is_columnar(filename):
+    handle, converted = tempfile.mkstemp(suffix=".col")
+    os.close(handle)
+    try:
+      write_columnar(converted, itertools.takewhile(
+          lambda event: end <= 0 or event[0] <= end, read_pickle(filename)))
+    except:
+      os.remove(converted)
+      raise
+    filename = converted
+  _dataset = anon_sim.DefaultParse(filename=filename, end=end)
+  return converted
+
+def sweep(runs, processes = 0, multiplex = 1):
+  """ Simulates every run, returns their results in the same order """
+  if multiplex > 1:
+    groups = multiplexed_groups(runs, multiplex)
+    grouped = sweep_tasks(simulate_group, [[runs[idx] for idx in group] \
+        for group in groups], processes)
+    results = [None] * len(runs)
+    for group, group_results in zip(groups, grouped):
+      for idx, result in zip(group, group_results):
+        results[idx] = result
+    return results
+  return sweep_tasks(simulate, runs, processes)
+
+def sweep_tasks(function, tasks, processes):
+  if processes <= 0:
+    processes = multiprocessing.cpu_count()
+  processes = min(processes, len(tasks))
+  if processes <= 1:
+    return [function(task) for task in tasks]
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    return pool.map(function, tasks, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+def multiplexed_groups(runs, size):
+  """ Indices of the runs, in groups of at most size sharing
+  round_time_span and start_time """
+  keys = []
+  by_key = {}
+  for idx, params in enumerate(runs):
+    key = (params["round_time_span"], params["start_time"])
+    if key not in by_key:
+      keys.append(key)
+      by_key[key] = []
+    by_key[key].append(idx)
+  groups = []
+  for key in keys:
+    indices = by_key[key]
+    groups.extend(indices[start:start + size] \
+        for start in range(0, len(indices), size))
+  return groups
+
+def simulate(params):
+  """ Runs a single simulation over the shared data set """
+  msg_parser = _dataset
+  result = dict((name, "") for name in RESULTS)
+  start = time.time()
+  try:
+    sim = anon_sim.create_simulator(params["policy"], len(msg_parser.users),
+        msg_parser.events(),
+        **dict((k, v) for k, v in params.items() if k != "policy"))
+    sim.run()
+    fill_result(result, sim)
+  except Exception, e:
+    logging.debug(traceback.format_exc())
+    result["error"] = error_message(e)
+  result["run_time"] = time.time() - start
+  logging.info("Finished %s in %fs" % (params, result["run_time"]))
+  return result
+
+def simulate_group(runs):
+  """ Runs several simulations in a single pass over the shared data set """
+  msg_parser = _dataset
+  multiplexer = Multiplexer(len(msg_parser.users), msg_parser.events(),
+      [(params["policy"], dict((k, v) for k, v in params.items() \
+      if k != "policy")) for params in runs])
+  multiplexer.run()
+  results = []
+  for params, sim, error, run_time in zip(runs, multiplexer.sims,
+      multiplexer.errors, multiplexer.times):
+    result = dict((name, "") for name in RESULTS)
+    if sim is not None:
+      fill_result(result, sim)
+    else:
+      result["error"] = error_message(error)
+    result["run_time"] = run_time
+    logging.info("Finished %s in %fs" % (params, result["run_time"]))
+    results.append(result)
+  return results
+
+def fill_result(result, sim):
+  result["delivered"] = sim.on_time
+  result["lost"] = len(sim.lost_messages)
+  for name, value in sim.delays.summary():
+    result["delayed" if name == "count" else name + "_delay"] = value
+
+def error_message(e):
+  return ("%s: %s" % (type(e).__name__, e)).replace("\t", " ")
+
+def write_table(filename, runs, results):
+  """ Writes one tab separated row of parameters and results per run """
+  names = [param for param, ptype, default in PARAMETERS]
+  output = open(filename, "w+")
+  output.write("\t".join(names + RESULTS) + "\n")
+  for params, result in zip(runs, results):
+    row = [params[name] for name in names] + [result[name] for name in RESULTS]
+    output.write("\t".join(str(value) for value in row) + "\n")
+  output.close()
+
+if __name__ == "__main__":
+  main()
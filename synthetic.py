@@ -0,0 +1,124 @@
+#!/usr/bin/python2
+
+"""
+Synthetic data sets for the AnonymitySimulator
+
+Users arrive one after another, then alternate between online sessions and
+offline gaps until the end of the trace, posting messages at a fixed rate
+while online.  Arrivals, sessions and gaps are drawn from configurable
+distributions so the population size and churn can be controlled, and a
+seed makes every data set reproducible.
+
+python2 synthetic.py [--users=100] [--duration=86400] [--session=3600]
+                     [--offline=7200] [--arrival=60] [--message_rate=0.005]
+                     [--*_dist=exponential] [--seed=0] [--columnar] output
+"""
+
+import argparse
+import heapq
+import math
+import pickle
+import random
+from columnar_dataset import write_columnar
+
+DISTRIBUTIONS = ["exponential", "pareto", "lognormal", "fixed"]
+
+def main():
+  parser = argparse.ArgumentParser(description="Generates a synthetic data "
+      "set for the AnonymitySimulator")
+  parser.add_argument("output", help="where the data set is written")
+  parser.add_argument("-u", "--users", type=int, default=100,
+      help="number of users (default: 100)")
+  parser.add_argument("-l", "--duration", type=float, default=86400.0,
+      help="length of the trace in seconds (default: 86400.0)")
+  parser.add_argument("--arrival", type=float, default=60.0,
+      help="mean seconds between two users first joining (default: 60.0)")
+  parser.add_argument("--session", type=float, default=3600.0,
+      help="mean length of an online session in seconds (default: 3600.0)")
+  parser.add_argument("--offline", type=float, default=7200.0,
+      help="mean length of an offline gap in seconds (default: 7200.0)")
+  for name in ["arrival", "session", "offline"]:
+    parser.add_argument("--%s_dist" % (name, ), default="exponential",
+        choices=DISTRIBUTIONS,
+        help="distribution of the %s times (default: exponential)" % \
+        (name, ))
+  parser.add_argument("-m", "--message_rate", type=float, default=0.005,
+      help="messages per second of a user online (default: 0.005)")
+  parser.add_argument("--seed", type=int, default=0,
+      help="seed of the random generator (default: 0)")
+  parser.add_argument("--columnar", default=False, action="store_const",
+      const=True, help="write a columnar data set instead of pickles")
+  args = parser.parse_args()
+
+  events = generate(args.users, args.duration,
+      arrival = (args.arrival_dist, args.arrival),
+      session = (args.session_dist, args.session),
+      offline = (args.offline_dist, args.offline),
+      message_rate = args.message_rate, seed = args.seed)
+  write(args.output, events, args.columnar)
+
+def sample(rand, distribution):
+  """ Draws a positive value from a (name, mean) distribution """
+  name, mean = distribution
+  if mean <= 0:
+    return 0.0
+  if name == "exponential":
+    return rand.expovariate(1.0 / mean)
+  elif name == "pareto":
+    # Shape 1.5 heavy tail, scaled to the mean
+    alpha = 1.5
+    return rand.paretovariate(alpha) * mean * (alpha - 1) / alpha
+  elif name == "lognormal":
+    sigma = 1.0
+    return rand.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+  elif name == "fixed":
+    return mean
+  raise ValueError("Unknown distribution: %s" % (name, ))
+
+def generate(users, duration, arrival = ("exponential", 60.0),
+    session = ("exponential", 3600.0), offline = ("exponential", 7200.0),
+    message_rate = 0.005, seed = 0):
+  """ Yields the time ordered events of a synthetic data set, each
+  distribution is a (name, mean) pair """
+  rand = random.Random(seed)
+  first_join = 0.0
+  streams = []
+  for uid in range(users):
+    streams.append(user_events(random.Random(rand.random()), uid, first_join,
+        duration, session, offline, message_rate))
+    first_join += sample(rand, arrival)
+  # Ties are broken by user and then by the order within a user
+  for event in heapq.merge(*streams):
+    yield event[0], event[2], event[3]
+
+def user_events(rand, uid, start, duration, session, offline, message_rate):
+  """ Yields (time, uid, type, data) for a single user """
+  ctime = start
+  seq = 0
+  while ctime < duration:
+    yield (ctime, uid, "join", uid)
+    end = ctime + max(sample(rand, session), 1e-3)
+    msg_time = ctime
+    while message_rate > 0:
+      msg_time += rand.expovariate(message_rate)
+      if msg_time >= min(end, duration):
+        break
+      seq += 1
+      yield (msg_time, uid, "msg", (uid, "m%d" % (seq, )))
+    if end >= duration:
+      return
+    yield (end, uid, "quit", uid)
+    ctime = end + max(sample(rand, offline), 1e-3)
+
+def write(filename, events, columnar = False):
+  """ Writes events as pickles or as a columnar data set """
+  if columnar:
+    write_columnar(filename, events)
+    return
+  output = open(filename, "wb")
+  for event in events:
+    output.write(pickle.dumps(event))
+  output.close()
+
+if __name__ == "__main__":
+  main()
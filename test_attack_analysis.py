@@ -0,0 +1,100 @@
+#!/usr/bin/python2
+
+"""
+De-anonymization attack of attack_analysis
+
+python2 -m unittest test_attack_analysis
+"""
+
+import itertools
+import unittest
+import numpy
+from attack_analysis import AttackAnalysis
+
+def pairwise(pseudonyms, ranks, members):
+  """ The original attack: every pseudonym suspects its top ranked member,
+  then of any two pseudonyms suspecting the same client the one with the
+  lower rank falls back to its next lower ranked member, until nothing
+  changes """
+  result = []
+  for idx, uid in enumerate(pseudonyms):
+    top, top_value = uid, ranks[idx][uid] if members[idx][uid] else 0.0
+    for cuid in numpy.flatnonzero(members[idx]):
+      if top_value < ranks[idx][cuid]:
+        top, top_value = cuid, ranks[idx][cuid]
+    result.append(top)
+
+  change = True
+  while change:
+    change = False
+    for idx0, idx1 in itertools.permutations(range(len(pseudonyms)), 2):
+      cuid = result[idx0]
+      if result[idx1] != cuid or ranks[idx1][cuid] >= ranks[idx0][cuid]:
+        continue
+      value = ranks[idx1][cuid]
+      next_value, next_cuid = 0, -1
+      for other in numpy.flatnonzero(members[idx1]):
+        if other != cuid and next_value < ranks[idx1][other] < value:
+          next_value, next_cuid = ranks[idx1][other], other
+      if next_cuid != -1:
+        result[idx1] = next_cuid
+        change = True
+  return result
+
+class AttackAnalysisTest(unittest.TestCase):
+  def random_case(self, rand):
+    count = rand.randint(1, 7)
+    total_clients = rand.randint(count, 9)
+    # Distinct ranks, the original attack breaks ties by dict order
+    ranks = rand.permutation(count * total_clients).reshape(count,
+        total_clients) + 1.0
+    members = rand.rand(count, total_clients) < 0.7
+    pseudonyms = rand.choice(total_clients, count, replace=False)
+    members[numpy.arange(count), pseudonyms] = True
+    return pseudonyms, ranks, members
+
+  def test_greedy_matches_pairwise(self):
+    rand = numpy.random.RandomState(0)
+    for trial in range(200):
+      pseudonyms, ranks, members = self.random_case(rand)
+      analysis = AttackAnalysis(pseudonyms, ranks, members, "greedy")
+      self.assertEqual(analysis.assignment.tolist(),
+          pairwise(pseudonyms, ranks, members))
+
+  def test_optimal_hand_checked(self):
+    # Both suspect client 0, pseudonym 1 outranks pseudonym 0 on it, which
+    # has no lower suspect left and keeps it.  Giving client 0 to pseudonym
+    # 0 and client 1 to pseudonym 1 totals 10 + 9 rather than 11 + 0.
+    pseudonyms = [0, 1]
+    ranks = numpy.array([[10.0, 0.0, 0.0], [11.0, 9.0, 0.0]])
+    members = numpy.array([[True, False, True], [True, True, True]])
+
+    greedy = AttackAnalysis(pseudonyms, ranks, members, "greedy")
+    self.assertEqual(greedy.assignment.tolist(), [0, 0])
+    self.assertEqual(greedy.found(), 1)
+    self.assertEqual(greedy.found_top(), 1)
+
+    optimal = AttackAnalysis(pseudonyms, ranks, members, "optimal")
+    self.assertEqual(optimal.assignment.tolist(), [0, 1])
+    self.assertEqual(optimal.found(), 2)
+
+  def test_optimal_matches_brute_force(self):
+    rand = numpy.random.RandomState(1)
+    for trial in range(100):
+      pseudonyms, ranks, members = self.random_case(rand)
+      count, total_clients = ranks.shape
+      best = None
+      for columns in itertools.permutations(range(total_clients), count):
+        if all(members[idx][cuid] for idx, cuid in enumerate(columns)):
+          total = sum(ranks[idx][cuid] for idx, cuid in enumerate(columns))
+          best = total if best is None else max(best, total)
+      if best is None:
+        continue
+      assignment = AttackAnalysis(pseudonyms, ranks, members,
+          "optimal").assignment
+      self.assertEqual(len(set(assignment.tolist())), count)
+      self.assertTrue(members[numpy.arange(count), assignment].all())
+      self.assertEqual(ranks[numpy.arange(count), assignment].sum(), best)
+
+if __name__ == "__main__":
+  unittest.main()
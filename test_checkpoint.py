@@ -0,0 +1,79 @@
+#!/usr/bin/python2
+
+"""
+Checkpoint and resume of the AnonymitySimulator
+
+python2 -m unittest test_checkpoint
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import anon_sim
+
+# A's message is sent before the first round ends, so it is handed back to
+# the first round by the bootstrap, and stays pending until A rejoins after
+# the end of the evaluation
+EVENTS = [
+    (0, "join", "A"),
+    (0.5, "msg", ("A", "hi")),
+    (1, "join", "B"),
+    (1.5, "quit", "A"),
+    (3, "msg", ("B", "x")),
+    (5000, "join", "C"),
+    (10000, "join", "A"),
+    (10001, "msg", ("A", "y")),
+    ]
+
+class CheckpointTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.data = os.path.join(self.directory, "data")
+    self.checkpoint = os.path.join(self.directory, "checkpoint.npz")
+    output = open(self.data, "wb")
+    for event in EVENTS:
+      pickle.dump(event, output)
+    output.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def simulator(self, policy):
+    msg_parser = anon_sim.DefaultParse(filename=self.data, end=6000)
+    sim = anon_sim.create_simulator(policy, len(msg_parser.users),
+        msg_parser.events())
+    return msg_parser, sim
+
+  def results(self, sim):
+    return (sim.on_time, sim.delays.count, len(sim.lost_messages),
+        [sorted(nym.clients) for nym in sim.pseudonyms])
+
+  def check_resume(self, policy):
+    msg_parser, sim = self.simulator(policy)
+    sim.run()
+    expected = self.results(sim)
+
+    msg_parser, sim = self.simulator(policy)
+    sim.set_checkpoints(self.checkpoint, 3600.0)
+    sim.run()
+    self.assertEqual(self.results(sim), expected)
+    self.assertTrue(os.path.exists(self.checkpoint))
+
+    msg_parser, sim = self.simulator(policy)
+    sim.set_checkpoints(self.checkpoint, 3600.0)
+    sim.restore(self.checkpoint, msg_parser.events())
+    self.assertEqual([event[2][1] for event in sim.pending_messages()],
+        ["hi"])
+    sim.run()
+    self.assertEqual(self.results(sim), expected)
+
+  def test_resume_pending_prepended_message(self):
+    self.check_resume("min_anon")
+
+  def test_resume_pending_prepended_message_dynamic(self):
+    self.check_resume("dynamic_split")
+
+if __name__ == "__main__":
+  unittest.main()
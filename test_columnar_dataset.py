@@ -0,0 +1,100 @@
+#!/usr/bin/python2
+
+"""
+Columnar data sets against the pickled ones they are converted from
+
+python2 -m unittest test_columnar_dataset
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import anon_sim
+import synthetic
+from columnar_dataset import ColumnarDataset, read_pickle, write_columnar, \
+    write_pickle
+
+# Every kind of payload
+EVENTS = [
+    (0.0, "join", 7),
+    (0.5, "join", 3),
+    (1.0, "msg", (7, "plain")),
+    (1.5, "msg", (3, u"caf\xe9")),
+    (2.0, "msg", (7, None)),
+    (2.5, "msg", (3, ("pickled", 1))),
+    (3.0, "quit", 7),
+    (4.0, "join", 9),
+    (5.0, "quit", 3),
+    ]
+
+class ColumnarDatasetTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.columnar = os.path.join(self.directory, "data.col")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_round_trip(self):
+    write_columnar(self.columnar, EVENTS)
+    dataset = ColumnarDataset(self.columnar)
+    events = list(dataset.events())
+    self.assertEqual(events, EVENTS)
+    # Equal is not enough, uids must come back as the ints written
+    self.assertEqual([type(event[2]) for event in events if event[1] != "msg"],
+        [int] * 5)
+    self.assertEqual([type(event[2][0]) for event in events \
+        if event[1] == "msg"], [int] * 4)
+    self.assertEqual(type(events[3][2][1]), unicode)
+
+    pickled = os.path.join(self.directory, "data")
+    write_pickle(pickled, dataset.events())
+    self.assertEqual(list(read_pickle(pickled)), EVENTS)
+
+  def test_end(self):
+    write_columnar(self.columnar, EVENTS)
+    dataset = ColumnarDataset(self.columnar)
+    self.assertEqual(len(dataset), len(EVENTS))
+    self.assertEqual(dataset.length(2.5), 6)
+    self.assertEqual(dataset.message_count(2.5), 4)
+    self.assertEqual(dataset.message_count(1.0), 1)
+    self.assertEqual(dataset.join_order().tolist(), [7, 3, 9])
+    self.assertEqual(dataset.join_order(3.0).tolist(), [7, 3])
+    self.assertEqual(list(dataset.events(3.0, first=4)), EVENTS[4:7])
+
+  def test_user_names(self):
+    events = [(0.0, "join", "b"), (1.0, "join", "a"),
+        (2.0, "msg", ("a", "x")), (3.0, "quit", "b")]
+    write_columnar(self.columnar, events)
+    # Names are numbered in the order they first appear
+    self.assertEqual(list(ColumnarDataset(self.columnar).events()),
+        [(0.0, "join", 0), (1.0, "join", 1), (2.0, "msg", (1, "x")),
+        (3.0, "quit", 0)])
+    self.assertRaises(ValueError, write_columnar, self.columnar,
+        events + [(4.0, "join", 5)])
+
+  def test_default_parse(self):
+    pickled = os.path.join(self.directory, "data")
+    synthetic.write(pickled, synthetic.generate(20, 20000.0, seed=1))
+    write_columnar(self.columnar, read_pickle(pickled))
+    for end in [-1, 9000.0]:
+      expected = anon_sim.DefaultParse(filename=pickled, end=end)
+      msg_parser = anon_sim.DefaultParse(filename=self.columnar, end=end)
+      self.assertEqual(msg_parser.users, expected.users)
+      self.assertEqual(msg_parser.messages, expected.messages)
+      events = list(expected.events())
+      # Columnar messages are their index rather than their payload
+      columnar_events = list(msg_parser.events())
+      self.assertEqual(len(columnar_events), len(events))
+      for idx, (event, expected_event) in enumerate(zip(columnar_events,
+          events)):
+        if event[1] == "msg":
+          self.assertEqual(event[2][0], expected_event[2][0])
+          self.assertEqual(msg_parser.dataset.message(event[2][1]),
+              expected_event[2][1])
+        else:
+          self.assertEqual(event, expected_event)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python2
+
+"""
+Streaming statistics of message delays
+
+python2 -m unittest test_delays
+"""
+
+import math
+import random
+import unittest
+from delays import DelayStats, GROWTH, PERCENTILES
+
+class DelayStatsTest(unittest.TestCase):
+  def setUp(self):
+    rand = random.Random(0)
+    # (delay, msg_time) over several hours, some of them delivered at once
+    self.delays = []
+    for idx in range(5000):
+      delay = 0.0 if idx % 50 == 0 else rand.lognormvariate(3.0, 1.5)
+      self.delays.append((delay, rand.uniform(0, 6 * 3600.0)))
+
+  def stats(self, delays):
+    stats = DelayStats()
+    for delay, msg_time in delays:
+      stats.add(delay, msg_time)
+    return stats
+
+  def assertSameStats(self, stats, expected):
+    self.assertEqual(stats.count, expected.count)
+    self.assertAlmostEqual(stats.average(), expected.average(), places=9)
+    self.assertAlmostEqual(stats.std_dev(), expected.std_dev(), places=9)
+    self.assertEqual(stats.min, expected.min)
+    self.assertEqual(stats.max, expected.max)
+    self.assertEqual(stats.zeros, expected.zeros)
+    self.assertEqual(stats.buckets, expected.buckets)
+
+  def test_moments(self):
+    stats = self.stats(self.delays)
+    values = [delay for delay, msg_time in self.delays]
+    mean = sum(values) / len(values)
+    self.assertAlmostEqual(stats.average(), mean, places=9)
+    self.assertAlmostEqual(stats.std_dev(), math.sqrt(sum((value - mean) ** 2
+        for value in values) / len(values)), places=9)
+
+  def test_merge(self):
+    expected = self.stats(self.delays)
+    merged = DelayStats()
+    for part in range(4):
+      merged.merge(self.stats(self.delays[part::4]))
+    merged.merge(DelayStats())
+    self.assertSameStats(merged, expected)
+    self.assertEqual(sorted(merged.hours.keys()),
+        sorted(expected.hours.keys()))
+    for hour in expected.hours:
+      self.assertSameStats(merged.hours[hour], expected.hours[hour])
+
+  def test_percentile_error(self):
+    stats = self.stats(self.delays)
+    values = sorted(delay for delay, msg_time in self.delays)
+    # A percentile is read at the middle of its bucket
+    bound = math.sqrt(GROWTH) - 1
+    for percent in PERCENTILES + [1, 2, 25, 75, 100]:
+      rank = max(int(math.ceil(percent / 100.0 * len(values))), 1)
+      exact = values[rank - 1]
+      self.assertTrue(abs(stats.percentile(percent) - exact) <= \
+          bound * exact + 1e-12, (percent, stats.percentile(percent), exact))
+
+  def test_empty(self):
+    stats = DelayStats()
+    self.assertEqual(stats.average(), 0.0)
+    self.assertEqual(stats.std_dev(), 0.0)
+    self.assertEqual(stats.percentile(50), 0.0)
+
+if __name__ == "__main__":
+  unittest.main()
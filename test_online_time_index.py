@@ -0,0 +1,93 @@
+#!/usr/bin/python2
+
+"""
+The online time index of DynamicSplitting against a sorted scan
+
+python2 -m unittest test_online_time_index
+"""
+
+import random
+import unittest
+import anon_sim
+from anonymity_sets import AnonymitySets
+
+class OnlineTimeIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.total = 12
+    self.tracker = anon_sim.OnlineTracker(self.total)
+    anonymity_sets = AnonymitySets(self.total, self.total, 0)
+    self.clients = [anon_sim.AnonymitySimulator.Client(uid, anonymity_sets,
+        self.tracker) for uid in range(self.total)]
+    self.index = anon_sim.DynamicSplitting.OnlineTimeIndex(self.clients)
+    self.members = set()
+
+  def add(self, uid):
+    self.index.update(uid)
+    self.members.add(uid)
+
+  def remove(self, uid):
+    self.index.remove(uid)
+    self.members.discard(uid)
+
+  def scan(self, count, etime):
+    """ What the splitting sorted before the index """
+    return sorted(self.members, key=lambda uid: \
+        (self.clients[uid].get_online_time(etime), uid))[:count]
+
+  def check(self, etime):
+    self.assertEqual(len(self.index), len(self.members))
+    for count in range(len(self.members) + 2):
+      self.assertEqual(self.index.smallest(count, etime),
+          self.scan(count, etime))
+
+  def test_ties_by_uid(self):
+    for uid in range(self.total):
+      self.add(uid)
+    self.check(1.0)
+    self.tracker.join(1.0, 3)
+    self.index.update(3)
+    self.tracker.join(1.0, 5)
+    self.index.update(5)
+    self.check(4.0)
+
+  def test_remove_and_add_again(self):
+    for uid in range(4):
+      self.tracker.join(1.0, uid)
+      self.add(uid)
+    self.tracker.quit(2.0, 1)
+    self.index.update(1)
+    self.remove(1)
+    self.check(3.0)
+    # Its entries from before the removal must stay dead
+    self.tracker.join(3.0, 1)
+    self.add(1)
+    self.check(5.0)
+    self.remove(1)
+    self.remove(2)
+    self.check(6.0)
+    self.add(2)
+    self.check(6.0)
+
+  def test_random_churn(self):
+    rand = random.Random(0)
+    etime = 1.0
+    for step in range(3000):
+      etime += rand.choice([0.0, 0.5, 1.0, 7.0])
+      uid = rand.randrange(self.total)
+      action = rand.random()
+      if action < 0.4:
+        if self.clients[uid].get_online():
+          self.tracker.quit(etime, uid)
+        else:
+          self.tracker.join(etime, uid)
+        if uid in self.members:
+          self.index.update(uid)
+      elif action < 0.6:
+        self.remove(uid)
+      elif action < 0.8:
+        self.add(uid)
+      else:
+        self.check(etime)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python2
+
+"""
+Rank engines of the AnonymitySimulator against the matrix one
+
+python2 -m unittest test_ranks
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import anon_sim
+import synthetic
+
+class RankEngineTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.data = os.path.join(self.directory, "data")
+    synthetic.write(self.data, synthetic.generate(12, 20000.0,
+        arrival=("exponential", 300.0), session=("exponential", 1500.0),
+        offline=("exponential", 1500.0), message_rate=0.004, seed=3))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def simulate(self, policy, rank_mode, **params):
+    msg_parser = anon_sim.DefaultParse(filename=self.data, end=-1)
+    sim = anon_sim.create_simulator(policy, len(msg_parser.users),
+        msg_parser.events(), round_time_span=60.0, rank_mode=rank_mode,
+        **params)
+    sim.run()
+    return sim
+
+  def check_same_ranks(self, policy, rank_mode, **params):
+    expected = self.simulate(policy, "matrix", **params)
+    sim = self.simulate(policy, rank_mode, **params)
+    self.assertEqual(sim.on_time, expected.on_time)
+    self.assertEqual(len(sim.lost_messages), len(expected.lost_messages))
+    for nym, expected_nym in zip(sim.pseudonyms, expected.pseudonyms):
+      self.assertEqual(sorted(nym.clients), sorted(expected_nym.clients))
+      for ranks, expected_ranks in [
+          (nym.client_rank, expected_nym.client_rank),
+          (nym.client_subrank, expected_nym.client_subrank)]:
+        ranks = dict(ranks.items())
+        expected_ranks = dict(expected_ranks.items())
+        # Zero ranks may be left out
+        for cuid in set(ranks) | set(expected_ranks):
+          self.assertAlmostEqual(ranks.get(cuid, 0),
+              expected_ranks.get(cuid, 0), places=6)
+    return expected
+
+  def test_interval_min_anon(self):
+    sim = self.check_same_ranks("min_anon", "interval", min_anon=3)
+    # Not trivially equal
+    self.assertTrue(any(len(nym.client_rank) > 0 for nym in sim.pseudonyms))
+    self.assertTrue(sim.delays.count > 0)
+
+  def test_interval_pseudonyms(self):
+    self.check_same_ranks("min_anon", "interval", pseudonyms_per_client=2)
+
+  def test_interval_dynamic_split(self):
+    self.check_same_ranks("dynamic_split", "interval", split_size=3)
+
+  def test_group_dynamic_split(self):
+    self.check_same_ranks("dynamic_split", "group", split_size=3)
+
+  def test_group_static_split(self):
+    # The default trainer shuffles the clients at random
+    self.check_same_ranks("static_split", "group", split_size=3,
+        trainer="join")
+
+  def test_group_needs_splitting_policy(self):
+    self.assertNotEqual(anon_sim.rank_mode_error("min_anon", "group"), None)
+    self.assertEqual(anon_sim.rank_mode_error("dynamic_split", "group"),
+        None)
+    self.assertEqual(anon_sim.rank_mode_error("min_anon", "interval"), None)
+
+if __name__ == "__main__":
+  unittest.main()